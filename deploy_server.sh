@@ -27,7 +27,7 @@ cd /opt/mobile-proxy
 
 # 6. 下载服务器脚本 (偁E您已上传到服务器)
 echo "📄 复制服务器脚本..."
-# cp ~/mobile_proxy_server.py /opt/mobile-proxy/
+# cp ~/mobile_proxy_server.py ~/common.py /opt/mobile-proxy/
 # 或老E接在这里创建脚本
 
 # 7. 创建systemd服务
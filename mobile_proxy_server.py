@@ -9,6 +9,13 @@ import json
 import sqlite3
 import websockets
 import threading
+import time
+import queue
+import atexit
+import itertools
+import zlib
+import codecs
+import re
 from datetime import datetime
 from mitmproxy import http
 from mitmproxy.tools.main import mitmdump
@@ -16,13 +23,218 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.parse
 import ssl
 
+# 数据库批量写入配置
+DB_BATCH_SIZE = 500          # 单个事务最多写入的行数
+DB_FLUSH_INTERVAL = 0.2      # 首条记录入队后最长等待多久刷新（秒）
+DB_QUEUE_MAXSIZE = 20000     # 写入队列上限，队列满时生产者阻塞（背压，不丢数据）
+
+# body 抓取配置（先在字节上切片再解码，大 body 不会被整体解压/转换为文本）
+BODY_TEXT_LIMIT = 4096       # 保存的请求/响应体最大字节数
+BODY_DECODE_CHUNK = 16384    # 解压时每次输入的最大字节数
+BODY_SKIP_TYPES = ('image/', 'video/', 'audio/', 'font/')  # 只记录大小
+
+# SQLite 连接配置（WAL 模式 + 调优后的 PRAGMA）
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'        # WAL 下 NORMAL 只在检查点时 fsync
+SQLITE_CACHE_SIZE = -64000           # 页缓存大小，负数单位为 KiB（约64MB）
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024 # 内存映射读取的上限（字节）
+SQLITE_BUSY_TIMEOUT = 5000           # 锁等待超时（毫秒）
+
+# 可选：brotli / zstandard 用于解压 br / zstd 编码的 body（未安装时只记录大小）
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+class ConnectionManager:
+    """SQLite连接管理器
+
+    WAL 模式下读写互不阻塞：整个进程只保留一个长连接写入者
+    （由批量写入线程独占），每个读线程各自持有一个只读长连接。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+        self.writer = self._connect()
+
+    def _connect(self, read_only=False):
+        """创建连接并应用 PRAGMA 配置"""
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT / 1000,
+                               check_same_thread=False)
+        conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size={int(SQLITE_CACHE_SIZE)}")
+        conn.execute(f"PRAGMA mmap_size={int(SQLITE_MMAP_SIZE)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def reader(self):
+        """获取当前线程的只读连接（首次调用时创建）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    def close(self):
+        """关闭所有连接"""
+        with self._lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+class BatchWriter:
+    """后台批量写入器
+
+    写操作先进入有界队列，由专用线程按批次取出，
+    同一批次在一个事务内用 executemany 提交，避免每行一次 fsync。
+    达到 batch_size 或等待超过 flush_interval 即刷新。
+    """
+
+    _STOP = object()
+
+    def __init__(self, conn, batch_size=DB_BATCH_SIZE,
+                 flush_interval=DB_FLUSH_INTERVAL, max_queue=DB_QUEUE_MAXSIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+
+        # 统计信息
+        self.total_rows = 0
+        self.total_batches = 0
+        self.failed_rows = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+        self.thread = threading.Thread(target=self._run, name='db-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, sql, params):
+        """提交一条写操作（队列满时阻塞，形成背压）"""
+        if self.closed:
+            raise RuntimeError("BatchWriter已关闭")
+        self.queue.put((sql, params))
+
+    def close(self, timeout=10):
+        """停止写入线程，刷新队列中剩余的数据"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(self._STOP)
+        self.thread.join(timeout)
+
+    def stats(self):
+        """返回写入器统计信息"""
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'total_rows': self.total_rows,
+            'total_batches': self.total_batches,
+            'failed_rows': self.failed_rows,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'avg_batch_size': round(self.total_rows / self.total_batches, 1) if self.total_batches else 0,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.total_batches, 2) if self.total_batches else 0
+        }
+
+    def _collect_batch(self, first):
+        """以 first 为首条记录收集一个批次，返回 (batch, stopping)"""
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        """写入线程主循环（独占写连接，连接由 ConnectionManager 负责关闭）"""
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            batch, stopping = self._collect_batch(item)
+            self._flush(self.conn, batch)
+
+        # 关闭前把队列里剩余的数据全部写完
+        remaining = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.batch_size):
+            self._flush(self.conn, remaining[start:start + self.batch_size])
+
+    def _flush(self, conn, batch):
+        """在一个事务内写入整个批次（相邻的相同SQL合并为一次 executemany）"""
+        started = time.perf_counter()
+        try:
+            with conn:
+                for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+                    conn.executemany(sql, [params for _, params in group])
+            self.total_rows += len(batch)
+        except Exception as e:
+            self.failed_rows += len(batch)
+            print(f"❌ 批量写入失败({len(batch)}条): {e}")
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.total_batches += 1
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+
 class TrafficDatabase:
     def __init__(self, db_path='mobile_traffic.db'):
         self.db_path = db_path
+        self.connections = ConnectionManager(db_path)
         self.init_database()
+        self.writer = BatchWriter(self.connections.writer)
+        atexit.register(self.close)
     
     def init_database(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connections.writer
         conn.execute('''
             CREATE TABLE IF NOT EXISTS traffic_logs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -40,11 +252,10 @@ class TrafficDatabase:
             )
         ''')
         conn.commit()
-        conn.close()
     
     def save_traffic(self, data):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute('''
+        # 写入批量队列，由后台线程统一提交
+        self.writer.submit('''
             INSERT INTO traffic_logs 
             (timestamp, method, url, host, request_headers, request_body, 
              response_status, response_headers, response_body, device_id)
@@ -55,20 +266,65 @@ class TrafficDatabase:
             data['response_status'], json.dumps(data['response_headers']),
             data['response_body'], data['device_id']
         ))
-        conn.commit()
-        conn.close()
+    
+    def close(self):
+        # 刷新批量写入器并关闭所有连接
+        if self.writer.closed:
+            return
+        self.writer.close()
+        self.connections.close()
     
     def get_traffic(self, device_id, limit=100):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute('''
+        cursor = self.connections.reader().execute('''
             SELECT * FROM traffic_logs 
             WHERE device_id = ? 
             ORDER BY created_at DESC 
             LIMIT ?
         ''', (device_id, limit))
-        results = cursor.fetchall()
-        conn.close()
-        return results
+        return cursor.fetchall()
+
+def decode_body_prefix(content, encoding, limit):
+    """分块解压 body，得到前 limit 字节就停止；不支持的编码返回 None"""
+    view = memoryview(content)
+    prefix = bytearray()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        if encoding == 'deflate':
+            wbits = zlib.MAX_WBITS if content[:1] == b'\x78' else -zlib.MAX_WBITS
+        else:
+            wbits = 16 + zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits)
+        for start in range(0, len(view), BODY_DECODE_CHUNK):
+            prefix += decompressor.decompress(view[start:start + BODY_DECODE_CHUNK], limit - len(prefix))
+            if len(prefix) >= limit or decompressor.eof:
+                break
+        return prefix
+    if encoding == 'br' and BROTLI_AVAILABLE:
+        decompress = brotli.Decompressor().process
+    elif encoding == 'zstd' and ZSTD_AVAILABLE:
+        decompress = zstandard.ZstdDecompressor().decompressobj().decompress
+    else:
+        return None
+    # brotli / zstd 没有输出上限参数，用小块输入控制单次输出
+    step = BODY_DECODE_CHUNK // 16
+    for start in range(0, len(view), step):
+        prefix += decompress(bytes(view[start:start + step]))
+        if len(prefix) >= limit:
+            break
+    return prefix[:limit]
+
+
+def decode_body_text(data, content_type):
+    """按 Content-Type 声明的 charset 解码（未声明或无法识别时按 UTF-8）
+
+    增量解码器不输出末尾被截断的半个多字节字符。
+    """
+    match = re.search(r'charset=["\']?([\w.:-]+)', content_type)
+    try:
+        decoder = codecs.getincrementaldecoder(match.group(1) if match else 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    return decoder.decode(bytes(data), final=False)
+
 
 class MobileProxyAddon:
     def __init__(self):
@@ -99,10 +355,10 @@ class MobileProxyAddon:
                 'url': flow.request.pretty_url,
                 'host': flow.request.pretty_host,
                 'request_headers': dict(flow.request.headers),
-                'request_body': self.safe_get_text(flow.request)[:4096],
+                'request_body': self.safe_get_text(flow.request),
                 'response_status': flow.response.status_code,
                 'response_headers': dict(flow.response.headers),
-                'response_body': self.safe_get_text(flow.response)[:4096],
+                'response_body': self.safe_get_text(flow.response),
                 'device_id': device_id
             }
             
@@ -117,11 +373,26 @@ class MobileProxyAddon:
         except Exception as e:
             print(f"处理流量数据失败: {e}")
     
-    def safe_get_text(self, message):
+    def safe_get_text(self, message, limit=BODY_TEXT_LIMIT):
+        # 只解码前 limit 字节：未压缩的 body 直接切片，压缩的 body 分块解压到够 limit 字节为止
+        content = message.raw_content
+        if not content:
+            return ''
+        binary = f'<Binary data: {len(content)} bytes>'
+        content_type = message.headers.get('content-type', '').lower()
+        if content_type.startswith(BODY_SKIP_TYPES):
+            return binary
         try:
-            return message.text or ''
-        except:
-            return f'<Binary data: {len(message.raw_content)} bytes>'
+            encoding = message.headers.get('content-encoding', '').strip().lower()
+            if encoding in ('', 'identity'):
+                prefix = memoryview(content)[:limit]
+            else:
+                prefix = decode_body_prefix(content, encoding, limit)
+            if prefix is None:
+                return binary
+            return decode_body_text(prefix, content_type)
+        except Exception:
+            return binary
     
     def get_device_id(self, flow):
         # 从请求头或IP识别设备
@@ -176,6 +447,7 @@ class APIHandler(BaseHTTPRequestHandler):
                 status = {
                     'status': 'running',
                     'active_connections': len(proxy_addon.websocket_clients),
+                    'db_writer': proxy_addon.db.writer.stats(),
                     'timestamp': datetime.now().isoformat()
                 }
                 
@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+服务器性能基准测试工具
+在临时目录中启动被测组件并压测，不会影响正在运行的服务和数据库
+
+用法:
+    python3 benchmark_server.py api [--rows 5000] [--clients 16] [--duration 10] [--slow-clients 1] [--idle-clients 64]
+    python3 benchmark_server.py pcap [--packets 200000] [--file capture.pcap]
+    python3 benchmark_server.py headers [--flows 50000]
+    python3 benchmark_server.py workers [--workers 1,2,4] [--clients 64] [--duration 10] [--tls]
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import ssl
+import struct
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_server_module(name):
+    """在临时目录中导入服务器脚本（数据库文件会建在临时目录里）"""
+    workdir = tempfile.mkdtemp(prefix='traffic_bench_')
+    os.chdir(workdir)
+    sys.path.insert(0, SCRIPT_DIR)
+    module = __import__(name)
+    if hasattr(module, 'init_services'):
+        module.init_services()
+    print(f"📁 临时目录: {workdir}")
+    return module
+
+
+def percentile(values, ratio):
+    """计算分位数（毫秒）"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def run_http_load(port, paths, clients, duration, keepalive):
+    """并发请求 paths 中的接口，返回每个路径的延迟列表和错误数"""
+    latencies = {path: [] for path in paths}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(index):
+        conn = None
+        local = {path: [] for path in paths}
+        count = 0
+        while time.monotonic() < deadline:
+            path = paths[count % len(paths)]
+            count += 1
+            started = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                headers = {} if keepalive else {'Connection': 'close'}
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if not keepalive:
+                    conn.close()
+                    conn = None
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+                continue
+            local[path].append((time.perf_counter() - started) * 1000)
+        if conn is not None:
+            conn.close()
+        with lock:
+            for path, values in local.items():
+                latencies[path].extend(values)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def hold_slow_clients(port, count, duration):
+    """模拟网络很差的客户端：只发送半个请求然后一直不发完"""
+    sockets = []
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(b'GET /api/traffic HTTP/1.1\r\nHost: bench\r\n')
+        sockets.append(sock)
+
+    def release():
+        time.sleep(duration)
+        for sock in sockets:
+            sock.close()
+
+    threading.Thread(target=release, daemon=True).start()
+
+
+def hold_idle_clients(port, count, duration, interval):
+    """模拟空闲的 keep-alive 客户端：每隔 interval 秒在同一连接上发一个请求，其余时间连接空闲"""
+    connections = [http.client.HTTPConnection('127.0.0.1', port, timeout=30) for _ in range(count)]
+    deadline = time.monotonic() + duration
+
+    def run():
+        while time.monotonic() < deadline:
+            for conn in connections:
+                try:
+                    conn.request('GET', '/api/status')
+                    conn.getresponse().read()
+                except Exception:
+                    conn.close()
+            time.sleep(interval)
+        for conn in connections:
+            conn.close()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def print_http_report(title, latencies, errors, duration):
+    """打印压测结果"""
+    total = sum(len(values) for values in latencies.values())
+    print(f"\n📊 {title}")
+    print(f"   总请求: {total}  错误: {errors}  吞吐: {total / duration:.1f} req/s")
+    for path, values in latencies.items():
+        print(f"   {path:<32} n={len(values):<6} "
+              f"p50={percentile(values, 0.50):7.2f}ms  "
+              f"p99={percentile(values, 0.99):7.2f}ms  "
+              f"max={max(values) if values else 0:7.2f}ms")
+
+
+def bench_api(args):
+    """对比单线程 HTTPServer 与线程池 API 服务器"""
+    server = load_server_module('mobile_proxy_server')
+    import common
+
+    print(f"📝 写入 {args.rows} 条测试流量...")
+    body = '{"items": [' + ','.join('{"id": %d, "name": "item"}' % i for i in range(50)) + ']}'
+    for index in range(args.rows):
+        server.traffic_db.save_traffic((
+            server.now_ms(), 'GET', f'https://api{index % 20}.example.com/v1/items',
+            f'api{index % 20}.example.com', '/v1/items', 200,
+            ((b'User-Agent', b'bench'),), ((b'Content-Type', b'application/json'),),
+            '', body, 'application/json', len(body), f'device_{index % 4}'
+        ))
+    while server.traffic_db.writer.queue.qsize():
+        time.sleep(0.1)
+    time.sleep(common.DB_FLUSH_INTERVAL * 2)
+
+    paths = ['/api/traffic', '/api/traffic', '/api/traffic', '/api/status']
+    candidates = [
+        ('HTTPServer（单线程，逐个连接）', HTTPServer, False),
+        (f'ThreadPoolHTTPServer（{common.API_WORKERS} 线程，keep-alive）', server.ThreadPoolHTTPServer, True),
+    ]
+    for title, server_class, keepalive in candidates:
+        httpd = server_class(('127.0.0.1', 0), server.APIHandler)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        hold_slow_clients(httpd.server_address[1], args.slow_clients, args.duration)
+        latencies, errors = run_http_load(httpd.server_address[1], paths,
+                                          args.clients, args.duration, keepalive)
+        httpd.shutdown()
+        httpd.server_close()
+        print_http_report(title, latencies, errors, args.duration)
+
+    # 空闲 keep-alive 连接比工作线程多时，/api/status 的延迟应与没有空闲连接时持平
+    for idle_clients in (0, args.idle_clients):
+        httpd = server.ThreadPoolHTTPServer(('127.0.0.1', 0), server.APIHandler)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        hold_idle_clients(httpd.server_address[1], idle_clients, args.duration,
+                          common.API_KEEPALIVE_TIMEOUT * 0.8)
+        # 探测请求每次新建连接（类似健康检查），需要一个空闲的工作线程才能得到处理
+        latencies, errors = run_http_load(httpd.server_address[1], ['/api/status'],
+                                          args.clients, args.duration, False)
+        httpd.shutdown()
+        httpd.server_close()
+        print_http_report(f'ThreadPoolHTTPServer（{common.API_WORKERS} 线程）+ {idle_clients} 个空闲 keep-alive 连接',
+                          latencies, errors, args.duration)
+
+    server.traffic_db.close()
+
+
+def write_synthetic_pcap(path, count):
+    """生成 raw IP 链路类型的测试抓包：IPv4/IPv6 的 TCP 和 UDP 混合流量"""
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, 101))
+        for index in range(count):
+            payload = b'x' * (index % 200)
+            if index % 2:
+                transport = struct.pack('!HHIIBBHHH', 40000 + index % 1000, 443, index, 0,
+                                        0x50, 0x18, 65535, 0, 0) + payload
+                protocol = 6
+            else:
+                transport = struct.pack('!HHHH', 50000 + index % 1000, 53, 8 + len(payload), 0) + payload
+                protocol = 17
+            if index % 5 == 0:
+                packet = struct.pack('!IHBB', 6 << 28, len(transport), protocol, 64)
+                packet += socket.inet_pton(socket.AF_INET6, 'fd00::2')
+                packet += socket.inet_pton(socket.AF_INET6, '2001:db8::%x' % (index % 500 + 1))
+            else:
+                packet = struct.pack('!BBHHHBBH', 0x45, 0, 20 + len(transport), index & 0xFFFF, 0,
+                                     64, protocol, 0)
+                packet += socket.inet_aton('10.66.66.2') + socket.inet_aton(f'93.184.{index % 250}.1')
+            packet += transport
+            f.write(struct.pack('<IIII', 1700000000 + index // 1000, index % 1000 * 1000,
+                                len(packet), len(packet)))
+            f.write(packet)
+
+
+def bench_pcap(args):
+    """回放 pcap，分别测量读取、头部解析和转换为流量记录的吞吐"""
+    server = load_server_module('vpn_traffic_server')
+    path = args.file
+    if not path:
+        path = os.path.join(os.getcwd(), 'synthetic.pcap')
+        write_synthetic_pcap(path, args.packets)
+        print(f"📼 生成测试抓包: {args.packets} 个数据包")
+
+    emitted = []
+    flow_table = server.FlowTable(lambda flow, finished: emitted.append(finished))
+
+    def aggregate(timestamp, data, wire_length):
+        packet = server.parse_ip_packet(data, timestamp, wire_length)
+        if packet is not None:
+            flow_table.update(packet)
+
+    stages = [
+        ('仅读取 (mmap + memoryview)', lambda timestamp, data, wire_length: None),
+        ('读取 + 头部解析',
+         lambda timestamp, data, wire_length: server.parse_ip_packet(data, timestamp, wire_length)),
+        ('读取 + 解析 + 流表聚合', aggregate),
+    ]
+    print("\n📊 pcap 回放吞吐")
+    for title, stage in stages:
+        started = time.perf_counter()
+        count = 0
+        for timestamp, data, wire_length in server.read_pcap(path):
+            stage(timestamp, data, wire_length)
+            count += 1
+        elapsed = time.perf_counter() - started
+        print(f"   {title:<28} {count} 包  {elapsed:6.2f}s  {count / elapsed:10.0f} pps")
+
+    flow_table.flush()
+    print(f"   流表: {flow_table.stats()}")
+    print(f"   写入数据库的记录: {emitted.count(True)} 条连接 + {emitted.count(False)} 次中间更新"
+          f"（逐包写入需要 {count} 行）")
+    server.traffic_db.close()
+
+
+USER_AGENTS = [
+    b'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) '
+    b'Chrome/124.0.6367.82 Mobile Safari/537.36',
+    b'Mozilla/5.0 (Linux; Android 13; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) '
+    b'Chrome/123.0.6312.99 Mobile Safari/537.36',
+    b'okhttp/4.12.0',
+    b'Dalvik/2.1.0 (Linux; U; Android 14; Pixel 8 Build/UQ1A.240205.004)',
+    b'com.example.shop/5.2.1 (Android 14; Pixel 8)',
+]
+CONTENT_TYPES = [b'application/json; charset=utf-8', b'text/html; charset=utf-8', b'image/webp',
+                 b'application/javascript', b'text/css', b'image/png', b'application/x-protobuf']
+SERVERS = [b'nginx', b'cloudflare', b'AmazonS3', b'gws', b'Tengine', b'openresty']
+
+
+def synthetic_headers(rng, index):
+    """生成一条接近真实抓包的请求头和响应头（常见头部的取值高度重复，少数头部每条都不同）"""
+    host = f'api{rng.randrange(40)}.example{rng.randrange(5)}.com'.encode()
+    request = [
+        (b'Host', host),
+        (b'User-Agent', rng.choice(USER_AGENTS)),
+        (b'Accept', rng.choice([b'*/*', b'application/json', b'text/html,application/xhtml+xml,'
+                                b'application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8'])),
+        (b'Accept-Encoding', b'gzip, deflate, br'),
+        (b'Accept-Language', rng.choice([b'zh-CN,zh;q=0.9,en;q=0.8', b'en-US,en;q=0.9'])),
+        (b'Connection', b'keep-alive'),
+        (b'Cookie', b'session=%032x; uid=%d' % (rng.getrandbits(128), rng.randrange(1000))),
+    ]
+    if index % 3 == 0:
+        request.append((b'Authorization', b'Bearer %064x' % rng.getrandbits(256)))
+    if index % 2 == 0:
+        request.append((b'Referer', b'https://' + host + b'/home'))
+    length = rng.randrange(100, 200000)
+    response = [
+        (b'Server', rng.choice(SERVERS)),
+        (b'Date', time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(1700000000 + index // 10)).encode()),
+        (b'Content-Type', rng.choice(CONTENT_TYPES)),
+        (b'Content-Length', str(length).encode()),
+        (b'Connection', b'keep-alive'),
+        (b'Cache-Control', rng.choice([b'no-cache', b'max-age=3600', b'public, max-age=31536000'])),
+        (b'Vary', b'Accept-Encoding'),
+        (b'Strict-Transport-Security', b'max-age=31536000; includeSubDomains'),
+        (b'Access-Control-Allow-Origin', b'*'),
+        (b'ETag', b'"%016x"' % rng.getrandbits(64)),
+        (b'X-Request-Id', b'%032x' % rng.getrandbits(128)),
+    ]
+    if index % 4 == 0:
+        response.append((b'Set-Cookie', b'sid=%024x; Path=/; HttpOnly; Secure' % rng.getrandbits(96)))
+    return request, response
+
+
+def database_bytes(db_path):
+    """检查点后数据库文件的大小"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return os.path.getsize(db_path)
+
+
+def bench_headers(args):
+    """对比逐条 JSON 与字典编码两种头部存储的体积和写入开销"""
+    server = load_server_module('mobile_proxy_server')
+    server.traffic_db.close()
+    rng = random.Random(1)
+    flows = [synthetic_headers(rng, index) for index in range(args.flows)]
+    raw_bytes = sum(len(name) + len(value) for request, response in flows
+                    for name, value in request + response)
+    print(f"📝 生成 {args.flows} 条流量的头部，原始大小 {raw_bytes / 1024 / 1024:.1f} MB")
+
+    print("\n📊 头部存储对比")
+    for title, enabled in (('JSON 文本', False), ('字典编码', True)):
+        server.HEADER_DICTIONARY_ENABLED = enabled
+        db_path = os.path.join(os.getcwd(), f'headers_{int(enabled)}.db')
+        db = server.TrafficDatabase(db_path)
+
+        # 编码开销单独计时（在工作线程中发生，影响抓包吞吐）
+        started = time.perf_counter()
+        if enabled:
+            for request, response in flows:
+                db.headers.encode(request)
+                db.headers.encode(response)
+        else:
+            for request, response in flows:
+                server.headers_to_json(request)
+                server.headers_to_json(response)
+        encode_us = (time.perf_counter() - started) / args.flows * 1e6
+
+        started = time.perf_counter()
+        for index, (request, response) in enumerate(flows):
+            db.save_traffic((1700000000000 + index, 'GET', 'https://example.com/', 'example.com', '/',
+                             200, request, response, '', '', 'application/json', 0, 'bench'))
+        db.close()
+        elapsed = time.perf_counter() - started
+
+        conn = sqlite3.connect(db_path)
+        column_bytes = conn.execute(
+            "SELECT SUM(COALESCE(length(request_headers), 0) + COALESCE(length(response_headers), 0) "
+            "+ COALESCE(length(request_header_refs), 0) + COALESCE(length(response_header_refs), 0)) "
+            "FROM traffic_logs").fetchone()[0]
+        dictionary_bytes = conn.execute(
+            "SELECT (SELECT COALESCE(SUM(length(name)), 0) FROM header_names) + "
+            "(SELECT COALESCE(SUM(length(value) + 8), 0) FROM header_values)").fetchone()[0]
+        values = conn.execute("SELECT COUNT(*) FROM header_values").fetchone()[0]
+        conn.close()
+        print(f"   {title:<8} 每条头部 {column_bytes / args.flows:7.1f} B  字典 {dictionary_bytes / 1024:8.1f} KB "
+              f"({values} 个取值)  数据库文件 {database_bytes(db_path) / 1024 / 1024:7.1f} MB  "
+              f"编码 {encode_us:6.1f} µs/条  写入 {args.flows / elapsed:8.0f} 条/s")
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """代理压测的上游服务：固定返回约 2KB 的 JSON"""
+
+    protocol_version = 'HTTP/1.1'
+    body = ('{"items": [' + ','.join('{"id": %d, "name": "item"}' % i for i in range(80)) + ']}').encode()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_upstream(port, certfile):
+    """在独立进程中运行上游服务（certfile 不为空时使用 HTTPS）"""
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), UpstreamHandler)
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile)
+        httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    httpd.serve_forever()
+
+
+def free_port():
+    """分配一个空闲的本地端口"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    """等待端口开始监听"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def proxy_client_process(proxy_port, upstream_port, threads, duration, tls, keepalive, results):
+    """客户端进程：多个线程经代理请求上游，结果 (成功数, 失败数) 放入 results"""
+    deadline = time.monotonic() + duration
+    counts = [0, 0]
+    lock = threading.Lock()
+    context = ssl._create_unverified_context()
+
+    def connect():
+        if tls:
+            conn = http.client.HTTPSConnection('127.0.0.1', proxy_port, timeout=10, context=context)
+            conn.set_tunnel('127.0.0.1', upstream_port)
+        else:
+            conn = http.client.HTTPConnection('127.0.0.1', proxy_port, timeout=10)
+        return conn
+
+    def worker(index):
+        conn = None
+        ok = failed = 0
+        target = '/items/' if tls else f'http://127.0.0.1:{upstream_port}/items/'
+        while time.monotonic() < deadline:
+            try:
+                if conn is None:
+                    conn = connect()
+                conn.request('GET', f'{target}{index}-{ok}')
+                response = conn.getresponse()
+                response.read()
+                ok += 1
+                if not keepalive:
+                    conn.close()
+                    conn = None
+            except Exception:
+                failed += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+        with lock:
+            counts[0] += ok
+            counts[1] += failed
+
+    pool = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(tuple(counts))
+
+
+def bench_workers(args):
+    """多进程代理：不同工作进程数下经 mitmproxy 抓包并写库的吞吐（条/s）"""
+    server = load_server_module('mobile_proxy_server')
+    if not server.MITMPROXY_AVAILABLE:
+        print("❌ 需要安装 mitmproxy")
+        return
+
+    confdir = os.path.join(os.getcwd(), 'mitmproxy')
+    server.ensure_mitmproxy_ca(confdir)
+    context = multiprocessing.get_context('spawn')
+    upstream_port = free_port()
+    certfile = os.path.join(confdir, 'mitmproxy-ca.pem') if args.tls else None
+    upstream = context.Process(target=serve_upstream, args=(upstream_port, certfile), daemon=True)
+    upstream.start()
+    wait_for_port(upstream_port)
+
+    mode = f"{'HTTPS (TLS 解密)' if args.tls else 'HTTP'}，{'keep-alive' if args.keepalive else '每个请求新建连接'}"
+    print(f"🔁 {args.clients} 个客户端线程 / {args.client_processes} 个进程，{mode}，每轮 {args.duration:g}s，"
+          f"CPU 核数 {os.cpu_count()}")
+    baseline = None
+    for workers in [int(value) for value in args.workers.split(',')]:
+        port = free_port()
+        pool = server.ProxyWorkerPool(workers)
+        pool.start('127.0.0.1', port, confdir, ssl_insecure=True, flow_detail=0, termlog_verbosity='error')
+        if not wait_for_port(port):
+            print(f"❌ {workers} 个工作进程未能在端口 {port} 上启动")
+            pool.stop()
+            continue
+
+        results = context.Queue()
+        threads = max(1, args.clients // args.client_processes)
+        clients = [context.Process(target=proxy_client_process,
+                                   args=(port, upstream_port, threads, args.duration, args.tls,
+                                         args.keepalive, results))
+                   for _ in range(args.client_processes)]
+        received_before = pool.stats()['received']
+        started = time.monotonic()
+        for client in clients:
+            client.start()
+        counts = [results.get() for _ in clients]
+        elapsed = time.monotonic() - started
+        stored = pool.stats()['received'] - received_before
+        for client in clients:
+            client.join()
+        pool.stop()
+
+        ok = sum(count[0] for count in counts)
+        failed = sum(count[1] for count in counts)
+        rate = stored / elapsed
+        baseline = baseline or rate
+        print(f"   {workers} 个工作进程  请求 {ok / elapsed:8.0f} 次/s  写库 {rate:8.0f} 条/s  "
+              f"失败 {failed:5d}  相对 1 进程 {rate / baseline:5.2f}x")
+
+    upstream.terminate()
+    server.traffic_db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='移动抓包服务器性能基准测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    api = subparsers.add_parser('api', help='API服务器吞吐与延迟')
+    api.add_argument('--rows', type=int, default=5000, help='预先写入的流量条数')
+    api.add_argument('--clients', type=int, default=16, help='并发客户端数')
+    api.add_argument('--duration', type=float, default=10, help='每轮压测时长（秒）')
+    api.add_argument('--slow-clients', type=int, default=1, help='同时存在的慢速客户端数')
+    api.add_argument('--idle-clients', type=int, default=64, help='空闲 keep-alive 连接数（应多于 API 工作线程数）')
+    api.set_defaults(func=bench_api)
+
+    pcap = subparsers.add_parser('pcap', help='抓包解析吞吐（离线回放 pcap）')
+    pcap.add_argument('--packets', type=int, default=200000, help='生成的测试数据包数量')
+    pcap.add_argument('--file', help='使用已有的 pcap 文件代替生成的测试数据')
+    pcap.set_defaults(func=bench_pcap)
+
+    headers = subparsers.add_parser('headers', help='头部字典编码的存储与写入开销')
+    headers.add_argument('--flows', type=int, default=50000, help='生成的流量条数')
+    headers.set_defaults(func=bench_headers)
+
+    workers = subparsers.add_parser('workers', help='多进程代理（SO_REUSEPORT）的抓包吞吐随工作进程数的变化')
+    workers.add_argument('--workers', default='1,2,4', help='逗号分隔的工作进程数')
+    workers.add_argument('--clients', type=int, default=64, help='并发客户端线程总数')
+    workers.add_argument('--client-processes', type=int, default=4, help='客户端进程数（避免压测端受 GIL 限制）')
+    workers.add_argument('--duration', type=float, default=10, help='每轮压测时长（秒）')
+    workers.add_argument('--tls', action='store_true', help='经 CONNECT 访问 HTTPS 上游（测量 TLS 解密开销）')
+    workers.add_argument('--keepalive', action='store_true', help='客户端复用连接（默认每个请求新建连接）')
+    workers.set_defaults(func=bench_workers)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1899 @@
+# -*- coding: utf-8 -*-
+"""
+mobile_proxy_server.py 与 vpn_traffic_server.py 共用的组件
+
+SQLite 连接与批量写入、epoch 毫秒时间戳工具、明细分页查询、时间序列汇总、数据保留策略、
+时间戳迁移、WebSocket 事件推送和 HTTP API 服务器基础设施。部署时与服务器脚本放在同一目录。
+"""
+
+import asyncio
+import json
+import sqlite3
+import ssl
+import os
+import websockets
+import traceback
+import threading
+import time
+import queue
+import selectors
+import socket
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import re
+import fnmatch
+import urllib.parse
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# 可选：msgpack 用于紧凑的二进制推送编码
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+# 数据库批量写入配置
+DB_BATCH_SIZE = 500          # 单个事务最多写入的行数
+DB_FLUSH_INTERVAL = 0.2      # 首条记录入队后最长等待多久刷新（秒）
+DB_QUEUE_MAXSIZE = 20000     # 写入队列上限，队列满时生产者阻塞（背压，不丢数据）
+
+# SQLite 连接配置（WAL 模式 + 调优后的 PRAGMA）
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'        # WAL 下 NORMAL 只在检查点时 fsync
+SQLITE_CACHE_SIZE = -64000           # 页缓存大小，负数单位为 KiB（约64MB）
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024 # 内存映射读取的上限（字节）
+SQLITE_BUSY_TIMEOUT = 5000           # 锁等待超时（毫秒）
+SQLITE_AUTO_VACUUM = 'INCREMENTAL'   # 新建数据库时启用，删除后可分步归还空间（已有数据库需停机 VACUUM 一次才生效）
+
+# 数据保留策略（后台线程定期删除最旧的记录并回收空间；设为 None 表示不限制）
+RETENTION_MAX_AGE_DAYS = 30                  # 最长保留天数
+RETENTION_MAX_ROWS = 5000000                 # 明细表最大行数
+RETENTION_MAX_DB_BYTES = 4 * 1024 ** 3       # 数据实际占用（不含空闲页）的上限
+RETENTION_SIZE_TARGET = 0.9                  # 超出大小上限时删到上限的该比例，避免每轮只删一点
+RETENTION_ROLLUP_DAYS = {'minute': 14, 'hour': 400}  # 汇总表各粒度的保留天数
+RETENTION_INTERVAL = 600                     # 两轮清理的间隔（秒）
+RETENTION_INITIAL_DELAY = 60                 # 启动后首轮清理的延迟（秒）
+RETENTION_DELETE_BATCH = 2000                # 每个删除事务的行数，批量写入线程最多等待一个小事务
+RETENTION_BATCH_PAUSE = 0.05                 # 两个删除事务之间让出写锁的时间（秒）
+RETENTION_VACUUM_PAGES = 1000                # 每次 incremental_vacuum 归还的页数
+
+# 时间戳以 epoch 毫秒整数存储；旧版本数据库的 ISO 字符串列由后台任务分批转换
+SCHEMA_VERSION = 1                   # PRAGMA user_version，达到该版本表示时间戳已全部迁移
+TIMESTAMP_MIGRATION_BATCH = 5000     # 每个迁移事务转换的行数
+TIMESTAMP_MIGRATION_PAUSE = 0.05     # 两个迁移事务之间让出写锁的时间（秒）
+
+# HTTP API 服务器配置
+API_WORKERS = 16             # 处理请求的工作线程数
+API_MAX_PENDING = 64         # 等待工作线程的连接数上限，超出后暂停 accept
+API_KEEPALIVE_TIMEOUT = 5    # keep-alive 连接空闲超时（秒），也是读取单个请求的超时
+API_MAX_IDLE_CONNECTIONS = 1024  # 等待下一个请求的空闲 keep-alive 连接上限，超出后关闭最早空闲的连接
+API_METRICS_WINDOW = 1000    # 每个路由保留最近多少次请求用于计算延迟分位数
+API_CACHE_ENTRIES = 256      # 预编码响应缓存的条目上限（按 URL 区分）
+API_STATUS_CACHE_TTL = 2     # 状态类接口（含运行指标）的缓存秒数
+
+# WebSocket 事件中心配置
+HUB_MAX_PENDING = 50000      # 等待投递到 WebSocket 事件循环的事件上限，超出即丢弃并计数
+SUBSCRIBER_QUEUE_SIZE = 1000 # 每个客户端的发送队列上限
+SUBSCRIBER_SAMPLE_RATE = 10  # 队列满后降级为每 N 条推送一条
+SUBSCRIBER_EVICT_AFTER = 30  # 持续降级超过该秒数则断开客户端
+WS_BATCH_INTERVAL_MS = 100   # batch 模式默认合并间隔（毫秒）
+WS_BATCH_MAX_EVENTS = 100    # batch 模式默认每帧最多事件数
+WS_COMPRESSION = 'deflate'   # permessage-deflate（客户端握手时协商），None 表示禁用
+
+# /api/traffic 分页与流式导出
+TRAFFIC_PAGE_DEFAULT = 100
+TRAFFIC_PAGE_MAX = 1000
+TRAFFIC_STREAM_MAX = 1000000       # 流式导出时单次请求的最大行数
+TRAFFIC_STREAM_CHUNK_ROWS = 500    # 流式导出时每次从游标读取的行数
+API_STREAM_CHUNK_BYTES = 64 * 1024 # 流式响应每个 chunk 的目标大小
+
+# 时间序列查询
+TIMESERIES_DEFAULT_SPAN = {'minute': timedelta(hours=1), 'hour': timedelta(days=7)}
+TIMESERIES_MAX_ROWS = 10000      # /api/stats/timeseries 单次返回的最大行数
+
+
+class ConnectionManager:
+    """SQLite连接管理器
+
+    WAL 模式下读写互不阻塞：整个进程只保留一个长连接写入者
+    （由批量写入线程独占），每个读线程各自持有一个只读长连接。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+        self.writer = self._connect()
+
+    def _connect(self, read_only=False):
+        """创建连接并应用 PRAGMA 配置"""
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT / 1000,
+                               check_same_thread=False)
+        if not read_only:
+            # auto_vacuum 必须在切换 WAL 和建表之前设置，对已有数据库不会改变现有模式
+            conn.execute(f"PRAGMA auto_vacuum={SQLITE_AUTO_VACUUM}")
+        conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size={int(SQLITE_CACHE_SIZE)}")
+        conn.execute(f"PRAGMA mmap_size={int(SQLITE_MMAP_SIZE)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def connect(self):
+        """创建一个独立的读写连接（供维护任务使用，由调用方负责关闭）"""
+        return self._connect()
+
+    def reader(self):
+        """获取当前线程的只读连接（首次调用时创建）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    def close(self):
+        """关闭所有连接"""
+        with self._lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class BatchWriter:
+    """后台批量写入器
+
+    写操作先进入有界队列，由专用线程按批次取出，
+    同一批次在一个事务内用 executemany 提交，避免每行一次 fsync。
+    达到 batch_size 或等待超过 flush_interval 即刷新。
+    """
+
+    _STOP = object()
+
+    def __init__(self, conn, batch_size=DB_BATCH_SIZE,
+                 flush_interval=DB_FLUSH_INTERVAL, max_queue=DB_QUEUE_MAXSIZE, on_flush=None):
+        self.conn = conn
+        # on_flush(conn) 在每个批次的同一事务内、批次写入之后调用
+        self.on_flush = on_flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+
+        # 统计信息
+        self.total_rows = 0
+        self.total_batches = 0
+        self.failed_rows = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        # 数据版本号：每成功提交一个批次或一个维护事务加一，用于API响应缓存和ETag
+        self.data_version = 0
+        self._version_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, name='db-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, sql, params, on_commit=None, on_failure=None):
+        """提交一条写操作（队列满时阻塞，形成背压）
+
+        on_commit / on_failure 在这条写操作所在的批次提交成功 / 失败后由写入线程调用（无参数）；
+        提交成功的回调在 data_version 增加之前执行。
+        """
+        if self.closed:
+            raise RuntimeError("BatchWriter已关闭")
+        self.queue.put((sql, params, on_commit, on_failure))
+
+    def bump_version(self):
+        """数据版本号加一（维护任务在自己的连接上提交删除/更新后调用，使缓存的响应失效）"""
+        with self._version_lock:
+            self.data_version += 1
+
+    def close(self, timeout=10):
+        """停止写入线程，刷新队列中剩余的数据"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(self._STOP)
+        self.thread.join(timeout)
+
+    def stats(self):
+        """返回写入器统计信息"""
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'total_rows': self.total_rows,
+            'total_batches': self.total_batches,
+            'data_version': self.data_version,
+            'failed_rows': self.failed_rows,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'avg_batch_size': round(self.total_rows / self.total_batches, 1) if self.total_batches else 0,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.total_batches, 2) if self.total_batches else 0
+        }
+
+    def _collect_batch(self, first):
+        """以 first 为首条记录收集一个批次，返回 (batch, stopping)"""
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        """写入线程主循环（独占写连接，连接由 ConnectionManager 负责关闭）"""
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            batch, stopping = self._collect_batch(item)
+            self._flush(self.conn, batch)
+
+        # 关闭前把队列里剩余的数据全部写完
+        remaining = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.batch_size):
+            self._flush(self.conn, remaining[start:start + self.batch_size])
+
+    def _flush(self, conn, batch):
+        """在一个事务内写入整个批次（相邻的相同SQL合并为一次 executemany）"""
+        started = time.perf_counter()
+        try:
+            with conn:
+                for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+                    conn.executemany(sql, [item[1] for item in group])
+                if self.on_flush is not None:
+                    self.on_flush(conn)
+            self.total_rows += len(batch)
+            self._run_callbacks(item[2] for item in batch)
+            self.bump_version()
+        except Exception as e:
+            self.failed_rows += len(batch)
+            print(f"❌ 批量写入失败({len(batch)}条): {e}")
+            self._run_callbacks(item[3] for item in batch)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.total_batches += 1
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+
+    @staticmethod
+    def _run_callbacks(callbacks):
+        """执行批次回调（回调出错不影响写入线程）"""
+        for callback in callbacks:
+            if callback is None:
+                continue
+            try:
+                callback()
+            except Exception as e:
+                print(f"❌ 批次回调失败: {e}")
+
+
+def now_ms():
+    """当前时间（epoch 毫秒）"""
+    return int(time.time() * 1000)
+
+
+def ms_to_iso(ms):
+    """epoch 毫秒转换为带时区偏移的本地 ISO 时间字符串（None 原样返回）"""
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(ms / 1000).astimezone().isoformat(timespec='milliseconds')
+
+
+def ms_to_legacy_text(ms):
+    """epoch 毫秒转换为旧版本字符串时间列的格式（不带时区的本地时间），用于与未迁移的记录比较"""
+    return datetime.fromtimestamp(ms / 1000).isoformat()
+
+
+def ms_to_bucket(ms, width):
+    """epoch 毫秒向下取整为汇总表的时间桶起点（width 为时间桶宽度，单位毫秒）
+
+    时间桶按绝对时间划分，夏令时回拨的重复小时不会合并；输出时用 ms_to_iso 格式化。
+    """
+    return ms - ms % width
+
+
+def parse_time_ms(value):
+    """解析 epoch 毫秒整数或 ISO 时间字符串（不带时区按本地时间），返回 epoch 毫秒
+
+    查询字符串中的 "+08:00" 会被解码成空格，这里先还原。
+    """
+    value = value.strip()
+    if value.lstrip('-').isdigit():
+        return int(value)
+    value = re.sub(r'(\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?) (\d{2}:?\d{2})$', r'\1+\2', value)
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        raise ValueError(f"invalid time: {value}")
+
+
+def row_to_record(columns, row, timestamp_columns):
+    """查询结果转换为 API 输出的字典：毫秒列另外输出为 ISO 字符串
+
+    timestamp_columns 为 {毫秒列: ISO 字段}；尚未迁移的旧记录毫秒列为空，沿用原来的字符串列。
+    """
+    record = dict(zip(columns, row))
+    for ms_column, iso_column in timestamp_columns.items():
+        if record.get(ms_column) is not None:
+            record[iso_column] = ms_to_iso(record[ms_column])
+    return record
+
+
+class TrafficStore:
+    """明细表的游标分页查询（两个服务器的 TrafficDatabase 共用）
+
+    子类提供 connections 和 writer，并用类属性指定明细表名、列表接口读取的字段、
+    过滤参数对应的列、毫秒时间列和汇总表配置。
+    """
+
+    table = None
+    list_columns = '*'
+    traffic_filters = {}     # API 过滤参数名 -> (列名, 参数转换函数)
+    timestamp_columns = {}   # epoch 毫秒列 -> API 输出的 ISO 字段
+    rollup_tables = {}       # 时间序列汇总表配置（同 RollupAccumulator）
+    rollup_dimensions = ()
+    rollup_measures = ()
+    retention_columns = ()   # 保留策略删除明细时额外读取、传给 on_rows_deleted 的列
+    retention_counters = ()  # on_rows_deleted 累加的清理报告计数项
+    retention_age_columns = ('ts_ms',)  # 保留策略判断记录新旧的毫秒列（取第一个非空值）
+
+    def _load_next_id(self):
+        """读取下一个可用的 id（AUTOINCREMENT 不复用已删除的 id，所以同时参考 sqlite_sequence）"""
+        try:
+            cursor = self.connections.writer.cursor()
+            max_id = cursor.execute(f"SELECT MAX(id) FROM {self.table}").fetchone()[0] or 0
+            row = cursor.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = ?", (self.table,)).fetchone()
+            return max(max_id, row[0] if row else 0) + 1
+        except Exception as e:
+            print(f"❌ 读取流量id失败: {e}")
+            return 1
+
+    def close(self):
+        """刷新批量写入器并关闭所有连接"""
+        if self.writer.closed:
+            return
+        self.writer.close()
+        self.connections.close()
+
+    def _query_traffic_page(self, limit, before_id=None, after_id=None, filters=None):
+        """直接从 SQLite 按 id 游标分页查询（结果按 id 从新到旧排列）"""
+        try:
+            cursor, order = self._traffic_cursor(limit, before_id, after_id, filters)
+            rows = cursor.fetchall()
+            # after_id 从游标处向新的方向扫描，取完再翻转为从新到旧
+            if order == "ASC":
+                rows.reverse()
+
+            # 转换为字典格式
+            columns = [description[0] for description in cursor.description]
+            result = []
+            for row in rows:
+                result.append(self._to_record(columns, row))
+
+            return result
+        except Exception as e:
+            print(f"❌ 获取流量数据失败: {e}")
+            return []
+
+    def iter_traffic(self, limit, before_id=None, after_id=None, filters=None,
+                     chunk_size=TRAFFIC_STREAM_CHUNK_ROWS):
+        """逐块从游标读取流量记录，内存占用与结果总量无关
+
+        只有 after_id 时按 id 从旧到新输出，其余情况从新到旧（不做整体翻转）。
+        """
+        cursor, _ = self._traffic_cursor(limit, before_id, after_id, filters)
+        columns = [description[0] for description in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield self._to_record(columns, row)
+
+    def get_timeseries(self, resolution='minute', since=None, until=None, group_by=None, filters=None):
+        """从汇总表查询时间序列（时间桶范围走主键，不扫描明细表）
+
+        resolution: minute / hour
+        group_by:   None 或 rollup_dimensions 中的一个维度
+        filters:    维度 -> 值 的等值过滤
+        """
+        table, width = self.rollup_tables[resolution]
+        if since is None:
+            since = now_ms() - int(TIMESERIES_DEFAULT_SPAN[resolution].total_seconds() * 1000)
+        where = ["bucket >= ?"]
+        params = [ms_to_bucket(since, width)]
+        if until is not None:
+            where.append("bucket < ?")
+            params.append(ms_to_bucket(until, width))
+        for dimension, value in (filters or {}).items():
+            where.append(f"{dimension} = ?")
+            params.append(value)
+
+        select = ['bucket'] + ([group_by] if group_by else [])
+        sums = ', '.join(f"SUM({m}) AS {m}" for m in self.rollup_measures)
+        sql = (f"SELECT {', '.join(select)}, {sums} FROM {table} WHERE {' AND '.join(where)} "
+               f"GROUP BY {', '.join(select)} ORDER BY bucket LIMIT ?")
+        params.append(TIMESERIES_MAX_ROWS)
+
+        cursor = self.connections.reader().cursor()
+        cursor.execute(sql, params)
+        columns = [description[0] for description in cursor.description]
+        return [{'bucket': ms_to_iso(row[0]), 'bucket_ms': row[0], **dict(zip(columns[1:], row[1:]))}
+                for row in cursor.fetchall()]
+
+    def _traffic_cursor(self, limit, before_id, after_id, filters):
+        """执行游标分页查询，返回 (cursor, 扫描方向)"""
+        where, params = self._build_filters(filters or {})
+        if before_id is not None:
+            where.append("id < ?")
+            params.append(before_id)
+        if after_id is not None:
+            where.append("id > ?")
+            params.append(after_id)
+
+        order = "ASC" if after_id is not None and before_id is None else "DESC"
+        sql = f"SELECT {self.list_columns} FROM {self.table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY id {order} LIMIT ?"
+        params.append(limit)
+
+        cursor = self.connections.reader().cursor()
+        cursor.execute(sql, params)
+        return cursor, order
+
+    def _to_record(self, columns, row):
+        """查询结果转换为 API 输出的字典"""
+        return row_to_record(columns, row, self.timestamp_columns)
+
+    def delete_dependents(self, conn, ids):
+        """保留策略删除明细的同一事务内调用，删除依附于这些记录的数据（ids 为 [(id,), ...]）"""
+
+    def on_rows_deleted(self, conn, rows, report):
+        """保留策略的一批删除提交后调用（rows 为 (id, *retention_columns)，report 为本轮清理报告）"""
+
+    def _build_filters(self, filters):
+        """把过滤条件转换为 WHERE 子句（均可命中 init_database 中创建的索引）"""
+        where = []
+        params = []
+        # 全部使用等值匹配：范围条件会让 SQLite 放弃按索引顺序输出而额外排序
+        for key, (column, _) in self.traffic_filters.items():
+            if filters.get(key) not in (None, ''):
+                where.append(f"{column} = ?")
+                params.append(filters[key])
+        # 迁移完成前的旧记录 ts_ms 为空，按原来的字符串时间列比较
+        if filters.get('since') is not None:
+            where.append("(ts_ms >= ? OR (ts_ms IS NULL AND timestamp >= ?))")
+            params.extend((filters['since'], ms_to_legacy_text(filters['since'])))
+        if filters.get('until') is not None:
+            where.append("(ts_ms < ? OR (ts_ms IS NULL AND timestamp < ?))")
+            params.extend((filters['until'], ms_to_legacy_text(filters['until'])))
+        return where, params
+
+
+class RollupAccumulator:
+    """时间序列汇总的增量累加器
+
+    生产者写入明细时在内存中按 (表, 时间桶, 维度) 累加增量，写入线程刷新批次时
+    在同一事务内把累加结果一次性 upsert 进汇总表，每个批次每个键只写一行。
+    """
+
+    def __init__(self, tables, dimensions, measures):
+        self.tables = list(tables.values())
+        self.dimensions = dimensions
+        self.measures = measures
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._sql = {}
+        for table, _ in self.tables:
+            key_columns = ', '.join(('bucket',) + dimensions)
+            columns = ', '.join(('bucket',) + dimensions + measures)
+            placeholders = ', '.join('?' * (1 + len(dimensions) + len(measures)))
+            updates = ', '.join(f"{m} = {m} + excluded.{m}" for m in measures)
+            self._sql[table] = (f"INSERT INTO {table} ({columns}) VALUES ({placeholders}) "
+                                f"ON CONFLICT({key_columns}) DO UPDATE SET {updates}")
+
+    def create_tables(self, cursor):
+        """创建汇总表（时间桶在主键最前面，按时间范围查询走主键），返回新建的 (表名, 时间桶宽度)
+
+        旧版本以本地时间字符串作时间桶的汇总表会原地转换为 epoch 毫秒时间桶。
+        """
+        existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        created = []
+        for table, width in self.tables:
+            if table not in existing:
+                self._create_table(cursor, table)
+                created.append((table, width))
+                continue
+            bucket_type = next(row[2] for row in cursor.execute(f"PRAGMA table_info({table})") if row[1] == 'bucket')
+            if bucket_type.upper() != 'INTEGER':
+                self._convert_text_buckets(cursor, table, width)
+        return created
+
+    def _create_table(self, cursor, table):
+        dimension_columns = ', '.join(f"{d} TEXT NOT NULL" for d in self.dimensions)
+        measure_columns = ', '.join(f"{m} INTEGER NOT NULL DEFAULT 0" for m in self.measures)
+        cursor.execute(f"""
+            CREATE TABLE {table} (
+                bucket INTEGER NOT NULL, {dimension_columns}, {measure_columns},
+                PRIMARY KEY (bucket, {', '.join(self.dimensions)})
+            ) WITHOUT ROWID
+        """)
+
+    def _convert_text_buckets(self, cursor, table, width):
+        """把旧的字符串时间桶（本地时间 "YYYY-MM-DDTHH:MM" 或 "YYYY-MM-DDTHH"）转换为 epoch 毫秒
+
+        旧数据中夏令时回拨的重复小时已经合并在同一个桶里，转换后仍是一个桶。
+        """
+        legacy = f"{table}_text_buckets"
+        cursor.execute(f"DROP TABLE IF EXISTS {legacy}")
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        self._create_table(cursor, table)
+        dimensions = ', '.join(self.dimensions)
+        cursor.execute(f"""
+            INSERT INTO {table} (bucket, {dimensions}, {', '.join(self.measures)})
+            SELECT bucket_ms / {width} * {width}, {dimensions}, {', '.join(f"SUM({m})" for m in self.measures)}
+            FROM (SELECT CAST(strftime('%s', substr(bucket || ':00', 1, 16), 'utc') AS INTEGER) * 1000 AS bucket_ms, *
+                  FROM {legacy})
+            WHERE bucket_ms IS NOT NULL
+            GROUP BY 1, {dimensions}
+        """)
+        cursor.execute(f"DROP TABLE {legacy}")
+        print(f"🔄 汇总表 {table} 的时间桶已转换为 epoch 毫秒")
+
+    def add(self, ts_ms, dimensions, measures):
+        """累加一条明细的增量（ts_ms 为 epoch 毫秒，维度中的 None 记为空字符串）"""
+        if not ts_ms:
+            return
+        dimensions = tuple('' if value is None else str(value) for value in dimensions)
+        with self._lock:
+            for table, width in self.tables:
+                key = (table, ms_to_bucket(ts_ms, width)) + dimensions
+                current = self._pending.get(key)
+                if current is None:
+                    self._pending[key] = list(measures)
+                else:
+                    for index, value in enumerate(measures):
+                        current[index] += value
+
+    def flush(self, conn):
+        """把累加的增量合并进汇总表（由写入线程在批次事务内调用）"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+        rows = {}
+        for key, values in pending.items():
+            rows.setdefault(key[0], []).append(key[1:] + tuple(values))
+        for table, params in rows.items():
+            conn.executemany(self._sql[table], params)
+
+
+class EncodedEvent:
+    """一个待推送事件的各种编码形式，按需生成且每种只生成一次"""
+
+    __slots__ = ('event', '_json', '_packed')
+
+    def __init__(self, event, json_text=None):
+        self.event = event
+        self._json = json_text
+        self._packed = None
+
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(self.event)
+        return self._json
+
+    def packed(self):
+        if self._packed is None:
+            self._packed = msgpack.packb(self.event, use_bin_type=True)
+        return self._packed
+
+
+def msgpack_array_header(count):
+    """msgpack 数组头，用于把已编码的元素直接拼接成数组"""
+    if count < 16:
+        return bytes([0x90 | count])
+    if count < 0x10000:
+        return b'\xdc' + count.to_bytes(2, 'big')
+    return b'\xdd' + count.to_bytes(4, 'big')
+
+
+def parse_stream_options(path):
+    """解析客户端连接时在 URL 查询参数中协商的推送方式
+
+    mode=event（默认，每个事件一帧）| batch（合并为数组帧）
+    interval_ms / max_events：batch 模式下每隔多少毫秒或攒够多少事件发送一帧
+    encoding=json（默认）| msgpack（二进制帧，需安装 msgpack）
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(path or '/').query)
+
+    def first(name, default):
+        values = query.get(name)
+        return values[0] if values else default
+
+    def bounded_int(name, default, low, high):
+        try:
+            return max(low, min(int(first(name, default)), high))
+        except ValueError:
+            return default
+
+    encoding = first('encoding', 'json').lower()
+    if encoding == 'msgpack' and not MSGPACK_AVAILABLE:
+        encoding = 'json'
+    return {
+        'negotiated': bool(query),
+        'mode': 'batch' if first('mode', 'event').lower() == 'batch' else 'event',
+        'interval_ms': bounded_int('interval_ms', WS_BATCH_INTERVAL_MS, 10, 5000),
+        'max_events': bounded_int('max_events', WS_BATCH_MAX_EVENTS, 1, 1000),
+        'encoding': 'msgpack' if encoding == 'msgpack' else 'json'
+    }
+
+
+def get_websocket_path(websocket, path=None):
+    """取得 WebSocket 握手请求的路径（兼容新旧版本 websockets 库）"""
+    if path:
+        return path
+    request = getattr(websocket, 'request', None)
+    if request is not None and getattr(request, 'path', None):
+        return request.path
+    return getattr(websocket, 'path', '/') or '/'
+
+
+class SubscriptionFilter:
+    """客户端订阅过滤条件（编译一次，在序列化之前对每个事件求值）
+
+    支持的条件（均可省略，多个条件之间为"与"关系）：
+      hosts:         主机名通配符列表，如 ["*.game.com", "api.example.com"]
+      device_ids:    设备标识列表
+      methods:       请求方法列表
+      status:        状态码或范围列表，如 [200, [300, 399], "5xx"]
+      content_types: 内容类型前缀列表，如 ["application/json", "image/"]
+    """
+
+    KEYS = ('hosts', 'device_ids', 'methods', 'status', 'content_types')
+
+    def __init__(self, spec, fields):
+        # fields: 过滤条件 -> 事件字段名（两个服务器的事件字段不同）
+        self.fields = fields
+        unknown = set(spec) - set(self.KEYS) - {'device_id'}
+        if unknown:
+            raise ValueError(f"unknown filter keys: {', '.join(sorted(unknown))}")
+        self.spec = spec
+        
+        hosts = self._as_list(spec.get('hosts'))
+        self.host_pattern = re.compile(
+            '|'.join(fnmatch.translate(host.lower()) for host in hosts)
+        ) if hosts else None
+        device_ids = self._as_list(spec.get('device_ids')) + self._as_list(spec.get('device_id'))
+        self.device_ids = set(device_ids) or None
+        self.methods = {method.upper() for method in self._as_list(spec.get('methods'))} or None
+        self.status_ranges = [self._parse_status(item) for item in self._as_list(spec.get('status'))] or None
+        self.content_types = tuple(ct.lower() for ct in self._as_list(spec.get('content_types'))) or None
+
+    @staticmethod
+    def _as_list(value):
+        if value is None:
+            return []
+        return list(value) if isinstance(value, (list, tuple)) else [value]
+
+    @staticmethod
+    def _parse_status(item):
+        """把 200 / [200, 299] / "2xx" 统一转换为闭区间 (low, high)"""
+        if isinstance(item, (list, tuple)) and len(item) == 2:
+            return int(item[0]), int(item[1])
+        text = str(item).lower()
+        if len(text) == 3 and text.endswith('xx') and text[0].isdigit():
+            return int(text[0]) * 100, int(text[0]) * 100 + 99
+        code = int(text)
+        return code, code
+
+    def match(self, event):
+        """判断事件是否满足过滤条件"""
+        if self.host_pattern is not None:
+            host = event.get(self.fields['host']) or ''
+            if not self.host_pattern.match(host.lower()):
+                return False
+        if self.device_ids is not None and event.get(self.fields['device_id']) not in self.device_ids:
+            return False
+        if self.methods is not None and event.get(self.fields['method']) not in self.methods:
+            return False
+        if self.status_ranges is not None:
+            status = event.get(self.fields['status_code'])
+            if status is None or not any(low <= status <= high for low, high in self.status_ranges):
+                return False
+        if self.content_types is not None:
+            content_type = (event.get(self.fields['content_type']) or '').lower()
+            if not content_type.startswith(self.content_types):
+                return False
+        return True
+
+
+class Subscriber:
+    """单个 WebSocket 订阅者
+
+    每个订阅者有独立的有界发送队列和发送任务，慢速客户端只会拖慢自己。
+    队列满时降级为抽样投递（每 SUBSCRIBER_SAMPLE_RATE 条投递一条），
+    队列回落到低水位后恢复全量；持续降级超过 SUBSCRIBER_EVICT_AFTER 秒则断开连接。
+    batch 模式下每 interval_ms 毫秒或攒够 max_events 个事件合并为一个数组帧发送。
+    """
+
+    def __init__(self, websocket, hub, options=None, max_queue=SUBSCRIBER_QUEUE_SIZE):
+        self.websocket = websocket
+        self.hub = hub
+        self.options = options or parse_stream_options('/')
+        self.batch = self.options['mode'] == 'batch'
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.filter = None
+        self.sampled = False
+        self.sample_counter = 0
+        self.over_limit_since = None
+        self.connected_at = time.time()
+        
+        # 统计信息
+        self.sent = 0
+        self.frames = 0
+        self.dropped = 0
+        self.filtered = 0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        
+        self.task = asyncio.ensure_future(self._sender())
+
+    def set_filter(self, spec):
+        """设置（或清除）订阅过滤条件，无需重新连接"""
+        self.filter = SubscriptionFilter(spec, self.hub.filter_fields) if spec else None
+
+    def accepts(self, event):
+        """在序列化之前判断事件是否需要推送给该订阅者"""
+        if self.filter is None or self.filter.match(event):
+            return True
+        self.filtered += 1
+        return False
+
+    def offer(self, encoded):
+        """把 EncodedEvent 放入发送队列（在 hub 的事件循环中调用）"""
+        if self.sampled:
+            self.sample_counter += 1
+            if self.sample_counter % SUBSCRIBER_SAMPLE_RATE:
+                self.dropped += 1
+                return
+        
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            now = time.monotonic()
+            if not self.sampled:
+                self.sampled = True
+                self.over_limit_since = now
+                print(f"⚠️ WebSocket客户端过慢，降级为抽样推送: {self.websocket.remote_address}")
+            elif now - self.over_limit_since > SUBSCRIBER_EVICT_AFTER:
+                self.hub.evict(self)
+            return
+        
+        self.queue.append((encoded, time.monotonic()))
+        self.wakeup.set()
+        if self.batch and len(self.queue) >= self.options['max_events']:
+            self.batch_full.set()
+
+    def stats(self):
+        """返回该订阅者的推送延迟统计"""
+        return {
+            'remote_address': str(self.websocket.remote_address),
+            'connected_at': datetime.fromtimestamp(self.connected_at).isoformat(),
+            'mode': self.options['mode'],
+            'encoding': self.options['encoding'],
+            'queue_depth': len(self.queue),
+            'sampled': self.sampled,
+            'sent': self.sent,
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'filtered': self.filtered,
+            'filters': self.filter.spec if self.filter else None,
+            'last_lag_ms': round(self.last_lag_ms, 2),
+            'max_lag_ms': round(self.max_lag_ms, 2)
+        }
+
+    def _encode_frame(self, items):
+        """把若干事件编码为一帧"""
+        if self.options['encoding'] == 'msgpack':
+            if not self.batch:
+                return items[0].packed()
+            return msgpack_array_header(len(items)) + b''.join(item.packed() for item in items)
+        if not self.batch:
+            return items[0].json()
+        return '[' + ','.join(item.json() for item in items) + ']'
+
+    async def _sender(self):
+        """发送任务：按顺序把队列中的事件发给客户端"""
+        try:
+            while True:
+                while not self.queue:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                
+                count = 1
+                if self.batch:
+                    # 等待攒够一批或到达合并间隔
+                    if len(self.queue) < self.options['max_events']:
+                        self.batch_full.clear()
+                        try:
+                            await asyncio.wait_for(self.batch_full.wait(),
+                                                   self.options['interval_ms'] / 1000)
+                        except asyncio.TimeoutError:
+                            pass
+                    count = min(len(self.queue), self.options['max_events'])
+                
+                items = [self.queue.popleft() for _ in range(count)]
+                await self.websocket.send(self._encode_frame([encoded for encoded, _ in items]))
+                self.sent += count
+                self.frames += 1
+                self.last_lag_ms = (time.monotonic() - items[0][1]) * 1000
+                self.max_lag_ms = max(self.max_lag_ms, self.last_lag_ms)
+                
+                if self.sampled and len(self.queue) <= self.max_queue // 4:
+                    self.sampled = False
+                    self.over_limit_since = None
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.hub.send_errors += 1
+            self.hub.unsubscribe(self.websocket)
+
+
+class EventHub:
+    """跨线程/跨事件循环的发布订阅中心
+
+    publish() 可以在任意线程或事件循环中调用：事件先放入加锁的缓冲区，
+    再通过 call_soon_threadsafe 调度到 WebSocket 服务器所在的事件循环统一投递。
+    同一轮调度中到达的事件合并处理，高频发布时不会为每个事件唤醒一次事件循环。
+    每个事件只序列化一次，再分发到各订阅者自己的发送队列。
+    """
+
+    def __init__(self, filter_fields, max_pending=HUB_MAX_PENDING):
+        self.loop = None
+        self.subscribers = {}
+        self.filter_fields = filter_fields
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+        
+        # 统计信息
+        self.published = 0
+        self.dropped = 0
+        self.send_errors = 0
+        self.evicted = 0
+
+    def attach(self, loop):
+        """绑定 WebSocket 服务器的事件循环（在该循环所在线程中调用）"""
+        self.loop = loop
+
+    def subscribe(self, websocket, options=None):
+        """添加订阅者并返回 Subscriber（仅在 hub 的事件循环中调用）"""
+        subscriber = Subscriber(websocket, self, options)
+        self.subscribers[websocket] = subscriber
+        return subscriber
+
+    def unsubscribe(self, websocket):
+        """移除订阅者并停止其发送任务（仅在 hub 的事件循环中调用）"""
+        subscriber = self.subscribers.pop(websocket, None)
+        if subscriber is not None:
+            subscriber.task.cancel()
+
+    def evict(self, subscriber):
+        """断开长期跟不上推送速度的订阅者"""
+        self.evicted += 1
+        self.unsubscribe(subscriber.websocket)
+        print(f"🔌 WebSocket客户端持续过慢，已断开: {subscriber.websocket.remote_address}")
+        asyncio.ensure_future(subscriber.websocket.close(code=1013, reason='slow consumer'))
+
+    def publish(self, event):
+        """线程安全地发布事件，返回是否已接收"""
+        loop = self.loop
+        if loop is None or not self.subscribers:
+            return False
+        
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending.append(event)
+            self.published += 1
+            if self._scheduled:
+                return True
+            self._scheduled = True
+        
+        try:
+            loop.call_soon_threadsafe(self._drain)
+        except RuntimeError:
+            # 事件循环已关闭
+            with self._lock:
+                self._pending.clear()
+                self._scheduled = False
+            return False
+        return True
+
+    def stats(self):
+        """返回 hub 统计信息（含每个客户端的推送延迟）"""
+        subscribers = list(self.subscribers.values())
+        return {
+            'subscribers': len(subscribers),
+            'pending': len(self._pending),
+            'published': self.published,
+            'dropped': self.dropped,
+            'send_errors': self.send_errors,
+            'evicted': self.evicted,
+            'clients': [subscriber.stats() for subscriber in subscribers]
+        }
+
+    def _drain(self):
+        """在 hub 的事件循环中取出缓冲区内的全部事件，序列化一次后分发给各订阅者"""
+        with self._lock:
+            events = list(self._pending)
+            self._pending.clear()
+            self._scheduled = False
+        
+        for event in events:
+            if not self.subscribers:
+                break
+            # 先按各订阅者的过滤条件筛选，没人需要的事件不会被序列化
+            encoded = EncodedEvent(event)
+            for subscriber in list(self.subscribers.values()):
+                if subscriber.accepts(event):
+                    subscriber.offer(encoded)
+
+
+class RetentionManager:
+    """数据保留策略（后台线程定期执行）
+
+    按最长保留时间、最大行数、最大数据量计算需要删除的最旧记录，每个事务只删除
+    RETENTION_DELETE_BATCH 行并在事务之间让出写锁，批量写入线程最多等待一个小事务；
+    按保留天数清理汇总表，并在 auto_vacuum=INCREMENTAL 时分步归还空闲页。
+    明细表和汇总表由 db（TrafficStore）的类属性指定，依附于明细的数据由
+    db.delete_dependents / db.on_rows_deleted 清理。
+    """
+
+    def __init__(self, db, interval=RETENTION_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self.thread = None
+        self._stop = threading.Event()
+        self.passes = 0
+        self.report = None
+        self.last_report = None
+
+    def start(self):
+        """启动清理线程"""
+        self.thread = threading.Thread(target=self._run, name='retention')
+        self.thread.daemon = True
+        self.thread.start()
+        print(f"✅ 数据保留策略已启用（每 {self.interval} 秒检查一次）")
+
+    def stop(self):
+        """停止清理线程（正在进行的一轮会在当前小事务结束后退出）"""
+        self._stop.set()
+        if self.thread:
+            self.thread.join(30)
+
+    def stats(self):
+        """返回保留策略配置和最近一轮的清理报告"""
+        return {
+            'max_age_days': RETENTION_MAX_AGE_DAYS,
+            'max_rows': RETENTION_MAX_ROWS,
+            'max_db_bytes': RETENTION_MAX_DB_BYTES,
+            'interval': self.interval,
+            'passes': self.passes,
+            'last_report': self.last_report
+        }
+
+    def _run(self):
+        if self._stop.wait(RETENTION_INITIAL_DELAY):
+            return
+        while not self._stop.is_set():
+            try:
+                self.run_pass()
+            except Exception as e:
+                print(f"❌ 数据清理失败: {e}")
+            self._stop.wait(self.interval)
+
+    def _file_size(self):
+        """数据库文件加 WAL 文件的总大小"""
+        total = 0
+        for path in (self.db.db_path, self.db.db_path + '-wal'):
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def run_pass(self):
+        """执行一轮清理并返回报告"""
+        started = time.perf_counter()
+        size_before = self._file_size()
+        self.report = {
+            'started_at': datetime.now().isoformat(),
+            'deleted_rows': {'age': 0, 'rows': 0, 'size': 0},
+            **{counter: 0 for counter in self.db.retention_counters},
+            'rollup_rows': 0,
+            'vacuumed_pages': 0
+        }
+        conn = self.db.connections.connect()
+        try:
+            if RETENTION_MAX_AGE_DAYS:
+                cutoff = now_ms() - RETENTION_MAX_AGE_DAYS * 86400 * 1000
+                # 尚未迁移的旧记录按字符串时间列判断，连字符串时间都没有的记录无法判断新旧，一并删除
+                age = self._first_value(self.db.retention_age_columns)
+                legacy_age = self._first_value(
+                    [self.db.timestamp_columns[column] for column in self.db.retention_age_columns])
+                self.report['deleted_rows']['age'] = self._delete_oldest(
+                    conn, f"{age} < ? OR ({age} IS NULL AND ({legacy_age} IS NULL OR {legacy_age} < ?))",
+                    (cutoff, ms_to_legacy_text(cutoff)))
+            
+            if RETENTION_MAX_ROWS:
+                excess = conn.execute(f"SELECT COUNT(*) FROM {self.db.table}").fetchone()[0] - RETENTION_MAX_ROWS
+                if excess > 0:
+                    self.report['deleted_rows']['rows'] = self._delete_oldest(conn, "1", (), excess)
+            
+            if RETENTION_MAX_DB_BYTES:
+                excess_rows = self._rows_over_size_limit(conn)
+                if excess_rows > 0:
+                    self.report['deleted_rows']['size'] = self._delete_oldest(conn, "1", (), excess_rows)
+            
+            self._prune_rollups(conn)
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if auto_vacuum == 2:
+                self._incremental_vacuum(conn)
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            self.report.update({
+                'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(auto_vacuum, auto_vacuum),
+                'free_bytes': conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+            })
+        finally:
+            conn.close()
+        
+        size_after = self._file_size()
+        self.report.update({
+            'file_bytes': size_after,
+            'reclaimed_bytes': max(0, size_before - size_after),
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+        self.passes += 1
+        self.last_report, self.report = self.report, None
+        
+        deleted = sum(self.last_report['deleted_rows'].values())
+        print(f"🧹 数据清理完成: 删除 {deleted} 条记录，回收 {self.last_report['reclaimed_bytes'] / 1024 / 1024:.1f} MB，"
+              f"耗时 {self.last_report['duration_ms'] / 1000:.1f}s")
+        if self.last_report['auto_vacuum'] == 'none' and self.passes == 1:
+            print("⚠️ 数据库未启用 incremental auto_vacuum：删除的空间会被复用但文件不会缩小，"
+                  "可在停机后执行 PRAGMA auto_vacuum=INCREMENTAL; VACUUM; 转换")
+        return self.last_report
+
+    @staticmethod
+    def _first_value(columns):
+        """多个列中第一个非空值的 SQL 表达式"""
+        return columns[0] if len(columns) == 1 else f"COALESCE({', '.join(columns)})"
+
+    def _rows_over_size_limit(self, conn):
+        """按平均行大小估算需要删除多少行，才能把实际数据量降到上限的 RETENTION_SIZE_TARGET"""
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        used = (conn.execute("PRAGMA page_count").fetchone()[0]
+                - conn.execute("PRAGMA freelist_count").fetchone()[0]) * page_size
+        if used <= RETENTION_MAX_DB_BYTES:
+            return 0
+        rows = conn.execute(f"SELECT COUNT(*) FROM {self.db.table}").fetchone()[0]
+        if not rows:
+            return 0
+        excess = used - RETENTION_MAX_DB_BYTES * RETENTION_SIZE_TARGET
+        return min(rows, int(excess / (used / rows)) + 1)
+
+    def _delete_oldest(self, conn, where, params, limit=None):
+        """按 id 从旧到新分批删除满足条件的记录，返回删除的行数"""
+        total = 0
+        while not self._stop.is_set() and (limit is None or total < limit):
+            size = RETENTION_DELETE_BATCH if limit is None else min(RETENTION_DELETE_BATCH, limit - total)
+            columns = ', '.join(('id',) + self.db.retention_columns)
+            rows = conn.execute(
+                f"SELECT {columns} FROM {self.db.table} WHERE {where} ORDER BY id LIMIT ?", params + (size,)
+            ).fetchall()
+            if not rows:
+                break
+            ids = [(row[0],) for row in rows]
+            with conn:
+                conn.executemany(f"DELETE FROM {self.db.table} WHERE id = ?", ids)
+                self.db.delete_dependents(conn, ids)
+            self.db.on_rows_deleted(conn, rows, self.report)
+            self.db.writer.bump_version()
+            total += len(rows)
+            time.sleep(RETENTION_BATCH_PAUSE)
+        return total
+
+    def _prune_rollups(self, conn):
+        """按保留天数删除汇总表中过旧的时间桶（每个事务删除若干个时间桶）"""
+        for resolution, days in RETENTION_ROLLUP_DAYS.items():
+            if not days:
+                continue
+            table, width = self.db.rollup_tables[resolution]
+            cutoff = ms_to_bucket(now_ms() - days * 86400 * 1000, width)
+            while not self._stop.is_set():
+                with conn:
+                    deleted = conn.execute(
+                        f"DELETE FROM {table} WHERE bucket IN "
+                        f"(SELECT DISTINCT bucket FROM {table} WHERE bucket < ? ORDER BY bucket LIMIT 60)",
+                        (cutoff,)
+                    ).rowcount
+                if not deleted:
+                    break
+                self.db.writer.bump_version()
+                self.report['rollup_rows'] += deleted
+                time.sleep(RETENTION_BATCH_PAUSE)
+
+    def _incremental_vacuum(self, conn):
+        """分步归还空闲页，每步只持有写锁很短的时间"""
+        while not self._stop.is_set():
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_pages:
+                break
+            # executescript 会把语句执行到底；execute 只执行一步，每次只归还一页
+            conn.executescript(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})")
+            self.report['vacuumed_pages'] += free_pages - conn.execute("PRAGMA freelist_count").fetchone()[0]
+            time.sleep(RETENTION_BATCH_PAUSE)
+
+
+class TimestampMigration:
+    """把旧版本的 ISO 时间字符串列在线转换为 epoch 毫秒整数列（后台线程执行）
+
+    按 id 顺序分批读取，每个事务转换 TIMESTAMP_MIGRATION_BATCH 行并在事务之间让出写锁，
+    服务照常读写；尚未转换的记录输出时沿用原字符串。无法解析的时间沿用按 id 排在前面的
+    记录的时间，保证迁移后每一行都有毫秒值。全部完成后删除旧的时间索引并把
+    PRAGMA user_version 设为 SCHEMA_VERSION，之后启动不再检查。
+    """
+
+    def __init__(self, db, tables, old_indexes=()):
+        self.db = db
+        self.tables = tables          # 表名 -> {毫秒列: 字符串列}
+        self.old_indexes = old_indexes
+        self.thread = None
+        self._stop = threading.Event()
+        self.state = 'pending'
+        self.converted = 0
+        self.failed = 0
+        self.duration_ms = None
+
+    def needed(self):
+        """数据库是否还有未迁移的时间戳"""
+        version = self.db.connections.reader().execute("PRAGMA user_version").fetchone()[0]
+        return version < SCHEMA_VERSION
+
+    def start(self):
+        """需要迁移时启动后台线程"""
+        if not self.needed():
+            self.state = 'done'
+            return
+        self.state = 'running'
+        self.thread = threading.Thread(target=self._run, name='timestamp-migration')
+        self.thread.daemon = True
+        self.thread.start()
+        print("🔄 正在后台把时间戳迁移为毫秒整数...")
+
+    def stop(self):
+        """停止迁移（已转换的批次保留，下次启动从头扫描并跳过已转换的行）"""
+        self._stop.set()
+        if self.thread:
+            self.thread.join(30)
+
+    def stats(self):
+        """返回迁移进度"""
+        return {
+            'state': self.state,
+            'converted_rows': self.converted,
+            'failed_rows': self.failed,
+            'duration_ms': self.duration_ms
+        }
+
+    def _run(self):
+        started = time.perf_counter()
+        conn = self.db.connections.connect()
+        try:
+            for table, columns in self.tables.items():
+                self._migrate_table(conn, table, columns)
+                if self._stop.is_set():
+                    self.state = 'stopped'
+                    return
+            for index in self.old_indexes:
+                conn.execute(f"DROP INDEX IF EXISTS {index}")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+            self.state = 'done'
+            self.duration_ms = round((time.perf_counter() - started) * 1000, 1)
+            print(f"✅ 时间戳迁移完成: 转换 {self.converted} 行，无法解析 {self.failed} 行（沿用相邻记录的时间），"
+                  f"耗时 {self.duration_ms / 1000:.1f}s")
+        except Exception as e:
+            self.state = 'failed'
+            print(f"❌ 时间戳迁移失败: {e}")
+        finally:
+            conn.close()
+
+    def _migrate_table(self, conn, table, columns):
+        """按 id 游标分批转换一张表（新写入的行已有毫秒值，COALESCE 保证不被旧值覆盖）"""
+        ms_columns = list(columns)
+        text_columns = [columns[column] for column in ms_columns]
+        assignments = [f"{column} = COALESCE({column}, ?)" for column in ms_columns]
+        assignments += [f"{column} = NULL" for column in text_columns]
+        sql = f"UPDATE {table} SET {', '.join(assignments)} WHERE id = ?"
+        
+        last_id = 0
+        # 每列按 id 顺序最近一次的毫秒值（id 按写入顺序分配，可作为无法解析的时间的近似值）
+        previous = [0] * len(ms_columns)
+        while not self._stop.is_set():
+            rows = conn.execute(
+                f"SELECT id, {', '.join(ms_columns + text_columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, TIMESTAMP_MIGRATION_BATCH)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for row in rows:
+                ms_values = row[1:1 + len(ms_columns)]
+                text_values = row[1 + len(ms_columns):]
+                if all(value is None for value in text_values):
+                    previous = [old if value is None else value for old, value in zip(previous, ms_values)]
+                    continue
+                converted = []
+                unparsable = False
+                for index, (ms_value, text_value) in enumerate(zip(ms_values, text_values)):
+                    if ms_value is None and text_value is not None:
+                        try:
+                            ms_value = parse_time_ms(text_value)
+                        except ValueError:
+                            # 无法解析的时间沿用前一行的时间，否则保留策略和时间过滤永远覆盖不到这一行
+                            ms_value = previous[index]
+                            unparsable = True
+                    if ms_value is not None:
+                        previous[index] = ms_value
+                    converted.append(ms_value)
+                self.failed += unparsable
+                updates.append(tuple(converted) + (row[0],))
+            if updates:
+                with conn:
+                    conn.executemany(sql, updates)
+                self.db.writer.bump_version()
+                self.converted += len(updates)
+                time.sleep(TIMESTAMP_MIGRATION_PAUSE)
+
+
+def handle_client_message(subscriber, message):
+    """处理客户端发来的控制消息，返回需要回复的内容
+
+    {"type": "subscribe", "filters": {...}} 设置过滤条件（替换原有条件）
+    {"type": "unsubscribe"}                清除过滤条件，恢复接收全部事件
+    """
+    try:
+        request = json.loads(message)
+        if not isinstance(request, dict):
+            raise ValueError("message must be a JSON object")
+        message_type = request.get('type')
+        if message_type == 'subscribe':
+            filters = request.get('filters') or {}
+            if not isinstance(filters, dict):
+                raise ValueError("filters must be a JSON object")
+            subscriber.set_filter(filters)
+            return {'type': 'subscribed', 'filters': filters}
+        if message_type == 'unsubscribe':
+            subscriber.set_filter(None)
+            return {'type': 'subscribed', 'filters': {}}
+        if message_type == 'ping':
+            return {'type': 'pong'}
+        raise ValueError(f"unknown message type: {message_type}")
+    except (ValueError, TypeError) as e:
+        return {'type': 'error', 'message': str(e)}
+
+
+def websocket_ssl_context():
+    """加载 WebSocket 服务器的 Let's Encrypt 证书，证书不存在时返回 None（使用 ws）"""
+    le_cert = '/etc/letsencrypt/live/bigjj.site/fullchain.pem'
+    le_key = '/etc/letsencrypt/live/bigjj.site/privkey.pem'
+    if not (os.path.exists(le_cert) and os.path.exists(le_key)):
+        print(f"⚠️ Let's Encrypt 证书不存在，WebSocket将使用HTTP")
+        return None
+    try:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(le_cert, le_key)
+        print(f"✅ WebSocket服务器使用 Let's Encrypt 证书")
+        return ssl_context
+    except Exception as e:
+        print(f"❌ 加载WebSocket证书失败: {e}")
+        return None
+
+
+def run_websocket_server(handler, hub, port=8765, ssl_context=None):
+    """在当前线程的新事件循环中运行WebSocket服务器，并把事件中心绑定到该事件循环"""
+    try:
+        async def run_server():
+            # 根据SSL状态决定协议
+            protocol = "wss" if ssl_context else "ws"
+            print(f"🚀 启动WebSocket服务器: {protocol}://0.0.0.0:{port}")
+            
+            server = await websockets.serve(
+                handler, 
+                "0.0.0.0", 
+                port,
+                ssl=ssl_context,
+                compression=WS_COMPRESSION
+            )
+            
+            print(f"✅ WebSocket服务器启动成功: {protocol}://bigjj.site:{port}")
+            await server.wait_closed()
+        
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        hub.attach(loop)
+        loop.run_until_complete(run_server())
+    except Exception as e:
+        print(f"❌ WebSocket服务器启动失败: {e}")
+        traceback.print_exc()
+
+
+class RequestMetrics:
+    """API请求延迟统计（按路由汇总，保留最近 window 次请求用于计算分位数）"""
+
+    def __init__(self, window=API_METRICS_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, elapsed_ms, status):
+        """记录一次请求"""
+        with self._lock:
+            entry = self._routes.get(route)
+            if entry is None:
+                entry = self._routes[route] = {
+                    'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'recent': deque(maxlen=self.window)
+                }
+            entry['count'] += 1
+            if status >= 500:
+                entry['errors'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            entry['recent'].append(elapsed_ms)
+
+    def stats(self):
+        """返回各路由的请求数、错误数和延迟分位数"""
+        with self._lock:
+            snapshot = {route: dict(entry, recent=sorted(entry['recent']))
+                        for route, entry in self._routes.items()}
+        
+        def percentile(values, ratio):
+            return round(values[min(len(values) - 1, int(len(values) * ratio))], 2) if values else 0
+        
+        result = {}
+        for route, entry in snapshot.items():
+            recent = entry['recent']
+            result[route] = {
+                'count': entry['count'],
+                'errors': entry['errors'],
+                'avg_ms': round(entry['total_ms'] / entry['count'], 2),
+                'max_ms': round(entry['max_ms'], 2),
+                'p50_ms': percentile(recent, 0.50),
+                'p95_ms': percentile(recent, 0.95),
+                'p99_ms': percentile(recent, 0.99)
+            }
+        return result
+
+
+CachedResponse = namedtuple('CachedResponse', ['version', 'etag', 'body', 'headers'])
+
+
+class ResponseCache:
+    """按数据版本缓存预编码的API响应
+
+    条目以 URL 为键，只有版本号一致时才命中；数据没有变化的轮询只需一次字典查找，
+    不再查询数据库和序列化JSON。ETag 由进程启动标记和版本号组成，重启后不会误判为未修改。
+    """
+
+    def __init__(self, max_entries=API_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.epoch = format(int(time.time() * 1000), 'x')
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def make_etag(self, version):
+        """根据版本号生成 ETag（version 可以是整数或元组）"""
+        if isinstance(version, tuple):
+            version = '.'.join(str(part) for part in version)
+        return f'"{self.epoch}-{version}"'
+
+    def get(self, key, version):
+        """返回与当前版本一致的缓存条目，没有则返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, body, headers=None):
+        """保存预编码的响应体，超出容量时淘汰最久未使用的条目"""
+        entry = CachedResponse(version, self.make_etag(version), body, headers or {})
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        """返回缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0
+            }
+
+
+def etag_matches(header, etag):
+    """判断 If-None-Match 头是否包含 etag（支持 * 和弱校验前缀 W/）"""
+    if not header:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+def status_cache_version(db):
+    """状态类接口的缓存版本：数据版本 + 时间片，运行指标最多滞后 API_STATUS_CACHE_TTL 秒"""
+    return (db.writer.data_version, int(time.monotonic() // API_STATUS_CACHE_TTL))
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """使用有界线程池处理请求的HTTP服务器
+
+    accept 循环只负责接受连接，请求交给固定大小的工作线程池处理，
+    慢客户端不会阻塞状态接口和健康检查。处理中和排队的连接总数
+    超过 workers + max_pending 时 accept 循环暂停，形成背压。
+
+    keep-alive 连接在两个请求之间不占用工作线程：处理器处理完已到达的请求后
+    把连接交还给服务器，由 selector 线程统一等待，下一个请求到达时再交给线程池。
+    空闲超过 idle_timeout 或空闲连接数超过 max_idle 时关闭最早空闲的连接。
+    """
+
+    # 处理器据此决定请求处理完后是返回（由服务器等待下一个请求）还是阻塞读取
+    waits_for_idle_connections = True
+
+    def __init__(self, server_address, handler_class,
+                 workers=API_WORKERS, max_pending=API_MAX_PENDING,
+                 max_idle=API_MAX_IDLE_CONNECTIONS, idle_timeout=API_KEEPALIVE_TIMEOUT):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api-worker')
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        
+        # 空闲连接 -> (客户端地址, 过期时间)，按进入空闲的先后排列，只在 selector 线程中访问
+        self.idle = {}
+        # 工作线程交还、等待 selector 线程登记的连接
+        self.returned = []
+        self.returned_lock = threading.Lock()
+        self.closing = False
+        self.selector = selectors.DefaultSelector()
+        self.waker, self.wake_writer = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+        self.idle_thread = threading.Thread(target=self._watch_idle, name='api-idle')
+        self.idle_thread.daemon = True
+        self.idle_thread.start()
+
+    def process_request(self, request, client_address):
+        """把连接交给线程池处理"""
+        self.slots.acquire()
+        try:
+            self.executor.submit(self._process, request, client_address)
+        except RuntimeError:
+            # 线程池已关闭
+            self.slots.release()
+            self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        """处理连接上已到达的请求，返回连接是否空闲并应保持打开等待下一个请求"""
+        handler = self.RequestHandlerClass(request, client_address, self)
+        return getattr(handler, 'idle', False)
+
+    def _process(self, request, client_address):
+        idle = False
+        try:
+            idle = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.slots.release()
+            if not (idle and self._return_idle(request, client_address)):
+                self.shutdown_request(request)
+
+    def _return_idle(self, request, client_address):
+        """工作线程把空闲连接交给 selector 线程，服务器已关闭时返回 False"""
+        with self.returned_lock:
+            if self.closing:
+                return False
+            self.returned.append((request, client_address))
+        self._wake()
+        return True
+
+    def _wake(self):
+        try:
+            self.wake_writer.send(b'\0')
+        except OSError:
+            # 唤醒字节已填满缓冲区，selector 线程必然会醒来
+            pass
+
+    def _watch_idle(self):
+        """selector 线程：等待空闲连接上的下一个请求并交回线程池，关闭超时的空闲连接"""
+        while True:
+            with self.returned_lock:
+                returned, self.returned = self.returned, []
+                closing = self.closing
+            for request, client_address in returned:
+                if closing:
+                    self.shutdown_request(request)
+                    continue
+                if len(self.idle) >= self.max_idle:
+                    self._close_idle(next(iter(self.idle)))
+                self.idle[request] = (client_address, time.monotonic() + self.idle_timeout)
+                self.selector.register(request, selectors.EVENT_READ)
+            if closing:
+                break
+            
+            timeout = None
+            if self.idle:
+                _, expires = next(iter(self.idle.values()))
+                timeout = max(0, expires - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.waker:
+                    try:
+                        while self.waker.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                # 下一个请求（或连接关闭）已到达，交回线程池；线程池满时在这里等待，形成背压
+                request = key.fileobj
+                self.selector.unregister(request)
+                client_address, _ = self.idle.pop(request)
+                self.process_request(request, client_address)
+            
+            now = time.monotonic()
+            while self.idle:
+                request = next(iter(self.idle))
+                if self.idle[request][1] > now:
+                    break
+                self._close_idle(request)
+        
+        for request in list(self.idle):
+            self._close_idle(request)
+        self.selector.close()
+        self.waker.close()
+        self.wake_writer.close()
+
+    def _close_idle(self, request):
+        self.selector.unregister(request)
+        del self.idle[request]
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        with self.returned_lock:
+            self.closing = True
+        self._wake()
+        self.executor.shutdown(wait=False)
+
+
+class TrafficAPIHandler(BaseHTTPRequestHandler):
+    """两个服务器的 HTTP API 处理器的公共基类（keep-alive 连接、按版本缓存的响应和 /api/traffic）
+
+    子类用 traffic_filters 指定过滤参数配置、response_cache 指定响应缓存，
+    并以 db 属性返回服务器的 TrafficDatabase。
+    """
+    
+    traffic_filters = {}
+    response_cache = None
+    db = None
+    
+    # HTTP/1.1 支持 keep-alive 连接复用（所有响应都带 Content-Length）
+    protocol_version = 'HTTP/1.1'
+    timeout = API_KEEPALIVE_TIMEOUT
+    # 头部和body分两次写出，关闭 Nagle 避免与延迟ACK叠加出约40ms的停顿
+    disable_nagle_algorithm = True
+    
+    def log_message(self, format, *args):
+        """禁用默认日志输出"""
+        pass
+    
+    def handle(self):
+        """处理连接上已到达的请求
+
+        服务器能等待空闲连接时（ThreadPoolHTTPServer），连接上没有下一个请求的数据就置 idle 并返回，
+        由服务器等待下一个请求，工作线程不会阻塞在空闲的 keep-alive 连接上。
+        """
+        self.idle = False
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if getattr(self.server, 'waits_for_idle_connections', False) and not self.request_pending():
+                self.idle = True
+                return
+            self.handle_one_request()
+    
+    def request_pending(self):
+        """不阻塞地检查连接上（含 rfile 缓冲区）是否已有下一个请求的数据"""
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+    
+    def send_response(self, code, message=None):
+        """记录响应状态码用于统计"""
+        self.response_status = code
+        super().send_response(code, message)
+    
+    def send_payload(self, body, content_type='application/json', headers=None):
+        """发送完整的200响应（带 Content-Length，以便 HTTP/1.1 连接复用）"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_cached(self, version, build):
+        """发送按版本缓存的响应：If-None-Match 命中时返回304，否则返回缓存的响应体
+
+        build() 返回 (body, headers)，只在缓存未命中时调用。
+        """
+        entry = self.response_cache.get(self.path, version)
+        if entry is None:
+            body, headers = build()
+            entry = self.response_cache.put(self.path, version, body, headers)
+        
+        if etag_matches(self.headers.get('If-None-Match'), entry.etag):
+            self.send_response(304)
+            self.send_header('ETag', entry.etag)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+        self.send_payload(entry.body, headers=dict(entry.headers, ETag=entry.etag))
+    
+    def get_stream_format(self, query):
+        """判断是否使用流式响应：?format=ndjson / Accept: application/x-ndjson 为 NDJSON，
+        ?stream=1 为流式 JSON 数组；否则返回 None"""
+        requested = (query.get('format') or [''])[0].lower()
+        accept = self.headers.get('Accept', '')
+        if requested == 'ndjson' or 'application/x-ndjson' in accept or 'application/ndjson' in accept:
+            return 'ndjson'
+        if (query.get('stream') or [''])[0].lower() in ('1', 'true', 'yes'):
+            return 'json'
+        return None
+    
+    def send_chunked(self, chunks, content_type, headers=None):
+        """以 chunked 编码边生成边发送响应，chunks 为 bytes 迭代器"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            # HTTP/1.0 客户端不支持 chunked，以关闭连接表示响应结束
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        
+        def write(data):
+            if chunked:
+                self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+            else:
+                self.wfile.write(data)
+        
+        buffer = []
+        buffered = 0
+        try:
+            for piece in chunks:
+                buffer.append(piece)
+                buffered += len(piece)
+                if buffered >= API_STREAM_CHUNK_BYTES:
+                    write(b''.join(buffer))
+                    buffer = []
+                    buffered = 0
+            if buffer:
+                write(b''.join(buffer))
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # 响应头已发出，无法再返回错误码，只能中断连接让客户端感知
+            print(f"❌ 流式响应中断: {e}")
+            self.close_connection = True
+    
+    def stream_traffic_data(self, stream_format, limit, before_id, after_id, filters):
+        """流式输出流量数据（NDJSON 或 JSON 数组），服务端内存占用与结果大小无关"""
+        rows = self.db.iter_traffic(limit, before_id, after_id, filters)
+        order = 'asc' if after_id is not None and before_id is None else 'desc'
+        
+        if stream_format == 'ndjson':
+            chunks = (json.dumps(row).encode('utf-8') + b'\n' for row in rows)
+            content_type = 'application/x-ndjson'
+        else:
+            def json_array():
+                yield b'['
+                for index, row in enumerate(rows):
+                    yield (b',\n' if index else b'\n') + json.dumps(row).encode('utf-8')
+                yield b'\n]'
+            chunks = json_array()
+            content_type = 'application/json'
+        
+        self.send_chunked(chunks, content_type, headers={'X-Order': order})
+    
+    def serve_timeseries(self, query):
+        """提供按分钟/小时汇总的时间序列（来自汇总表，按数据版本缓存）"""
+        try:
+            resolution, since, until, group_by, filters = parse_timeseries_query(query, self.db.rollup_tables, self.db.rollup_dimensions)
+        except ValueError as e:
+            self.send_error(400, f"Invalid query: {e}")
+            return
+        
+        def build():
+            series = self.db.get_timeseries(resolution, since, until, group_by, filters)
+            result = {'resolution': resolution, 'group_by': group_by, 'series': series}
+            return json.dumps(result, indent=2).encode('utf-8'), {}
+        
+        try:
+            self.send_cached(self.db.writer.data_version, build)
+        except Exception as e:
+            print(f"❌ 获取时间序列失败: {e}")
+            self.send_error(500, "Failed to get timeseries")
+    
+    def serve_traffic_data(self, query):
+        """提供流量数据（支持 before_id/after_id 游标分页和过滤）"""
+        stream_format = self.get_stream_format(query)
+        try:
+            max_limit = TRAFFIC_STREAM_MAX if stream_format else TRAFFIC_PAGE_MAX
+            limit, before_id, after_id, filters = parse_traffic_query(query, self.traffic_filters, max_limit)
+        except ValueError as e:
+            self.send_error(400, f"Invalid query: {e}")
+            return
+        
+        if stream_format:
+            self.stream_traffic_data(stream_format, limit, before_id, after_id, filters)
+            return
+        
+        def build():
+            traffic_data = self.db.get_traffic_page(limit, before_id, after_id, filters)
+            
+            # 分页游标：继续向旧翻页用 X-Next-Before-Id，轮询新数据用 X-Prev-After-Id
+            headers = {}
+            if traffic_data:
+                headers['X-Next-Before-Id'] = str(traffic_data[-1]['id'])
+                headers['X-Prev-After-Id'] = str(traffic_data[0]['id'])
+            return json.dumps(traffic_data, indent=2).encode('utf-8'), headers
+        
+        try:
+            # 先读取版本号再查询，查询期间有新批次提交时只会让缓存提前失效
+            self.send_cached(self.db.writer.data_version, build)
+        except Exception as e:
+            print(f"❌ 获取流量数据失败: {e}")
+            self.send_error(500, "Failed to get traffic data")
+
+
+def parse_timeseries_query(query, tables, dimensions):
+    """解析 /api/stats/timeseries 的查询参数，返回 (resolution, since, until, group_by, filters)
+
+    tables / dimensions 为服务器的汇总表配置（ROLLUP_TABLES / ROLLUP_DIMENSIONS）。
+    """
+    def first(name):
+        values = query.get(name)
+        return values[0] if values else None
+    
+    resolution = first('resolution') or 'minute'
+    if resolution not in tables:
+        raise ValueError(f"resolution must be one of {', '.join(tables)}")
+    group_by = first('group_by') or None
+    if group_by is not None and group_by not in dimensions:
+        raise ValueError(f"group_by must be one of {', '.join(dimensions)}")
+    filters = {dimension: first(dimension) for dimension in dimensions if first(dimension)}
+    since = parse_time_ms(first('since')) if first('since') else None
+    until = parse_time_ms(first('until')) if first('until') else None
+    return resolution, since, until, group_by, filters
+
+
+
+def parse_traffic_query(query, traffic_filters, max_limit=TRAFFIC_PAGE_MAX):
+    """解析 /api/traffic 的查询参数，返回 (limit, before_id, after_id, filters)
+
+    traffic_filters 为服务器的过滤参数配置（TRAFFIC_FILTERS），空值的过滤参数记为 None。
+    """
+    def first(name):
+        values = query.get(name)
+        return values[0] if values else None
+    
+    def optional_int(name):
+        value = first(name)
+        if value in (None, ''):
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"{name} must be an integer")
+    
+    limit = optional_int('limit') or TRAFFIC_PAGE_DEFAULT
+    limit = max(1, min(limit, max_limit))
+    filters = {}
+    for name, (_, convert) in traffic_filters.items():
+        value = first(name)
+        try:
+            filters[name] = convert(value) if value else None
+        except ValueError:
+            # 只有整数参数会转换失败
+            raise ValueError(f"{name} must be an integer")
+    filters['since'] = parse_time_ms(first('since')) if first('since') else None
+    filters['until'] = parse_time_ms(first('until')) if first('until') else None
+    return limit, optional_int('before_id'), optional_int('after_id'), filters
@@ -96,12 +96,21 @@ else
     exit 1
 fi
 
+# 下载两个服务器共用的模块（必须与主脚本放在同一目录）
+wget -q --show-progress -O common.py "$GITHUB_RAW_URL/remote_server/common.py"
+if [ $? -eq 0 ]; then
+    echo "✅ common.py 下载成功"
+else
+    echo "❌ 下载 common.py 失败"
+    exit 1
+fi
+
 # 下载README斁E
 wget -q -O README.md "$GITHUB_RAW_URL/remote_server/README.md" 2>/dev/null
 echo "📄 README.md 下载完E"
 
 # 验证Python脚本语況Eecho "🔍 验证E本语況E.."
-python3 -m py_compile mobile_proxy_server.py
+python3 -m py_compile common.py mobile_proxy_server.py
 if [ $? -eq 0 ]; then
     echo "✁E脚本语法验证E迁E
 else
@@ -128,22 +137,25 @@ cd /opt/mobile-proxy
 
 # 夁E当前版本
 cp mobile_proxy_server.py mobile_proxy_server.py.backup.\$(date +%Y%m%d_%H%M%S)
+cp common.py common.py.backup.\$(date +%Y%m%d_%H%M%S) 2>/dev/null
 
 # 下载最新版本
 echo "📥 下载最新版本..."
-wget -q -O mobile_proxy_server.py.new "$GITHUB_RAW_URL/remote_server/mobile_proxy_server.py"
+wget -q -O mobile_proxy_server.py.new "$GITHUB_RAW_URL/remote_server/mobile_proxy_server.py" && \
+    wget -q -O common.py.new "$GITHUB_RAW_URL/remote_server/common.py"
 
 if [ \$? -eq 0 ]; then
-    # 验证语況E    python3 -m py_compile mobile_proxy_server.py.new
+    # 验证语況E    python3 -m py_compile mobile_proxy_server.py.new common.py.new
     if [ \$? -eq 0 ]; then
         mv mobile_proxy_server.py.new mobile_proxy_server.py
+        mv common.py.new common.py
         echo "✁E更新成功E重启服务..."
         sudo systemctl restart mobile-proxy
         sudo systemctl restart mitmweb
         echo "🎉 服务已重启"
     else
         echo "❁E新版本语法错误E保持原版本"
-        rm mobile_proxy_server.py.new
+        rm -f mobile_proxy_server.py.new common.py.new
     fi
 else
     echo "❁E下载失败"
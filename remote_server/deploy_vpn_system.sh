@@ -35,7 +35,7 @@ echo "🔧 配置WireGuard..."
 
 # 4. 部署流量监控服务
 echo "📋 部署流量监控服务..."
-cp vpn_traffic_server.py $DEPLOY_DIR/
+cp vpn_traffic_server.py common.py $DEPLOY_DIR/
 chmod +x $DEPLOY_DIR/vpn_traffic_server.py
 
 # 5. 创建systemd服务文件
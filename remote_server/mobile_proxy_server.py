@@ -6,21 +6,160 @@ import json
 import sqlite3
 import ssl
 import os
-import websockets
 import socket
 import traceback
 import sys
 import threading
-from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.parse
 import signal
 import time
+import queue
+import atexit
+import itertools
+import re
+import fnmatch
+import hashlib
+import zlib
+import multiprocessing
+from collections import OrderedDict, deque, namedtuple
+
+# 两个服务器共用的组件（common.py 与本脚本部署在同一目录）
+from common import (
+    SCHEMA_VERSION, TRAFFIC_STREAM_MAX, ConnectionManager, BatchWriter, now_ms, ms_to_iso, TrafficStore,
+    RollupAccumulator, EncodedEvent, parse_stream_options, get_websocket_path, EventHub,
+    TimestampMigration, handle_client_message, websocket_ssl_context, run_websocket_server,
+    RequestMetrics, ResponseCache, status_cache_version, ThreadPoolHTTPServer, TrafficAPIHandler,
+    RetentionManager,
+)
 
 # WebSocket/API 是否启用 SSL（用于页面与状态展示）
 WS_USE_SSL = False
 API_USE_SSL = False
 
+# 订阅过滤条件对应的事件字段
+FILTER_FIELDS = {
+    'host': 'host',
+    'device_id': 'device_id',
+    'method': 'method',
+    'status_code': 'status_code',
+    'content_type': 'content_type',
+}
+
+# /api/traffic 过滤使用的索引
+TRAFFIC_INDEXES = [
+    ('idx_traffic_host', 'host'),
+    ('idx_traffic_method', 'method'),
+    ('idx_traffic_status', 'status_code'),
+    ('idx_traffic_content_type', 'content_type'),
+    ('idx_traffic_device', 'device_id'),
+    ('idx_traffic_ts', 'ts_ms'),
+]
+# 列表接口只读取的小字段（不含请求/响应体）
+TRAFFIC_LIST_COLUMNS = (
+    'id, ts_ms, timestamp, method, url, host, path, status_code, request_headers, response_headers, '
+    'request_header_refs, response_header_refs, '
+    'content_type, size, device_id, request_body_hash, response_body_hash'
+)
+# API 过滤参数名 -> (traffic_logs 列名, 参数转换函数)
+TRAFFIC_FILTERS = {
+    'host': ('host', str),
+    'method': ('method', str.upper),
+    'status_code': ('status_code', int),
+    'content_type': ('content_type', str),
+    'device_id': ('device_id', str),
+}
+# epoch 毫秒列 -> API 输出的 ISO 字段（同名的字符串列只在旧版本数据库的未迁移记录中有值）
+TIMESTAMP_COLUMNS = {'ts_ms': 'timestamp'}
+
+# 最近流量的内存环形缓冲区：历史回放和最新N条查询直接命中内存，更旧的数据才查 SQLite
+RECENT_BUFFER_RECORDS = 5000                 # 最多保留的记录条数（0 表示关闭）
+RECENT_BUFFER_BYTES = 16 * 1024 * 1024       # 记录摘要占用的近似字节数上限
+
+# 时间序列汇总表（按分钟/小时聚合；写入线程在每个批次的事务中增量更新）
+# 表名 -> 时间桶宽度（毫秒；时间桶为向下取整后的 epoch 毫秒）
+ROLLUP_TABLES = {
+    'minute': ('traffic_rollup_minute', 60 * 1000),
+    'hour': ('traffic_rollup_hour', 60 * 60 * 1000),
+}
+ROLLUP_DIMENSIONS = ('host', 'device_id', 'status_class', 'content_type')
+ROLLUP_MEASURES = ('requests', 'bytes')
+
+# 请求/响应体存储（按内容哈希去重并压缩，与 traffic_logs 分表存放）
+BODY_COMPRESS_LEVEL = 6        # zlib 压缩级别
+BODY_MIN_COMPRESS_SIZE = 64    # 小于该字节数的 body 不压缩
+BODY_DEDUP_CACHE_SIZE = 50000  # 进程内记住的已存储哈希数量，命中时跳过压缩和写入
+
+# 请求/响应头字典编码（头部名和可复用的取值各存一份，每条记录只保存紧凑的引用列表）
+HEADER_DICTIONARY_ENABLED = True   # False 时退回逐条保存 JSON 文本（用于对比存储和写入开销）
+HEADER_CACHE_SIZE = 50000          # 进程内 (名称, 取值) -> 编码片段 的 LRU 条目数
+HEADER_INTERN_MAX_LEN = 256        # 超过该长度的取值直接内联，不进入字典
+HEADER_INLINE_NAMES = frozenset({  # 几乎每条都不同的头部，取值直接内联，避免字典无限增长
+    'date', 'expires', 'last-modified', 'if-modified-since', 'age', 'content-length', 'content-range',
+    'etag', 'if-none-match', 'cookie', 'set-cookie', 'authorization', 'location', 'content-md5',
+    'x-request-id', 'x-amz-request-id', 'x-amz-cf-id', 'x-amzn-requestid', 'x-amzn-trace-id',
+    'cf-ray', 'traceparent', 'tracestate', 'x-b3-traceid', 'x-b3-spanid', 'x-trace-id',
+})
+
+# 抓包流水线配置（mitmproxy 钩子只做快照入队，序列化与存储在工作线程完成）
+CAPTURE_PIPELINE_ENABLED = True  # False 时退回在钩子内同步处理（用于对比钩子延迟）
+CAPTURE_WORKERS = 2              # 序列化/存储工作线程数
+CAPTURE_QUEUE_MAXSIZE = 10000    # 待处理流量上限，队列满时丢弃并计数，绝不阻塞事件循环
+CAPTURE_BODY_LIMIT = 10000       # 默认保存的请求/响应体最大字节数（先切片再解码）
+
+# 抓包策略：按 Content-Type / host 决定 body 的处理方式（fnmatch 模式，按顺序匹配第一条）
+# 取值：保留的最大字节数、'hash'（只记录 sha256 和真实大小）或 'skip'（只记录真实大小）
+CAPTURE_TYPE_RULES = (
+    ('video/*', 'skip'),
+    ('audio/*', 'skip'),
+    ('image/*', 'hash'),
+    ('font/*', 'hash'),
+    ('application/octet-stream', 'hash'),
+    ('application/vnd.android.package-archive', 'hash'),
+    ('application/zip', 'hash'),
+    ('application/x-protobuf', 'hash'),
+    ('application/grpc*', 'hash'),
+    ('application/json', 64 * 1024),
+    ('*+json', 64 * 1024),
+)
+CAPTURE_HOST_RULES = (            # host 规则优先于类型规则，例如 ('*.googlevideo.com', 'skip')
+)
+CAPTURE_DECODE_CHUNK = 64 * 1024  # 流式解压时每次输入/输出的最大字节数
+CAPTURE_STREAM_ENABLED = True     # 大响应和跳过/只记录哈希的类型改为流式转发，不在内存中缓冲完整 body
+CAPTURE_STREAM_THRESHOLD = 1024 * 1024  # Content-Length 超过该字节数的响应流式转发
+CAPTURE_SNIFF_BYTES = 512         # 未知类型时检查前多少字节是否含 NUL（判定为二进制后只记录哈希）
+CAPTURE_POLICY_CACHE_SIZE = 4096  # (host, 类型) -> 规则 的缓存条目上限
+
+# 多进程代理（大于 1 时以 spawn 方式启动多个 mitmproxy 工作进程，通过 SO_REUSEPORT 共同监听代理端口；
+# 工作进程处理 body 后经管道把记录批量发回主进程，SQLite 和 WebSocket 事件中心只在主进程中）
+PROXY_WORKERS = 1                 # mitmproxy 工作进程数，1 为单进程模式
+PROXY_FORWARD_BATCH = 200         # 工作进程每次发送的最多记录数
+PROXY_FORWARD_INTERVAL = 0.05     # 首条记录入队后最长等待多久发送（秒）
+PROXY_RESTART_DELAY = 1.0         # 工作进程异常退出后首次重启前的等待（秒），连续退出时指数退避
+PROXY_RESTART_MAX_DELAY = 30.0    # 重启等待的上限（秒）
+PROXY_RESTART_LIMIT = 5           # 同一工作进程在窗口内异常退出超过该次数即放弃，主进程退出交给 systemd 重启
+PROXY_RESTART_WINDOW = 300        # 统计异常退出次数的时间窗口（秒）
+PROXY_LISTEN_CHECK_TIMEOUT = 15   # 工作进程启动后等待 mitmproxy 开始监听的最长时间（秒）
+PROXY_WORKER_FATAL_EXIT = 3       # 工作进程的退出码：监听套接字未启用 SO_REUSEPORT，重启也无济于事
+
+# 全文检索（FTS5 索引 url/host/path 和文本类型的 body，与明细在同一批次事务中写入）
+SEARCH_TOKENIZER = 'unicode61 remove_diacritics 2'  # 改为 'trigram' 可做任意子串匹配，索引约大 3 倍
+SEARCH_FIELDS = {                  # 查询参数 fields 可用的字段名 -> 索引列
+    'url': ('url',),
+    'host': ('host',),
+    'path': ('path',),
+    'body': ('request_body', 'response_body'),
+    'request_body': ('request_body',),
+    'response_body': ('response_body',),
+}
+SEARCH_COLUMN_WEIGHTS = (4.0, 3.0, 3.0, 1.0, 1.0)  # bm25 权重：url, host, path, request_body, response_body
+SEARCH_BODY_CHARS = CAPTURE_BODY_LIMIT              # 每个 body 最多索引的字符数
+SEARCH_TEXT_TYPES = ('text/', 'application/json', 'application/xml', 'application/javascript',
+                     'application/x-www-form-urlencoded', 'application/graphql', '+json', '+xml')
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_SNIPPET_TOKENS = 16          # 摘要长度（词数）
+SEARCH_HIGHLIGHT = ('<mark>', '</mark>')
+
 # 尝试导入mitmproxy模块
 try:
     from mitmproxy import http, options
@@ -30,18 +169,455 @@ except ImportError:
     MITMPROXY_AVAILABLE = False
     print("⚠️ mitmproxy模块未安装，部分功能可能受限")
 
+# 可选：brotli / zstandard 用于流式解压 br / zstd 编码的 body（未安装时只记录哈希和大小）
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+
+class RecentFlowBuffer:
+    """最近流量摘要的环形缓冲区（同时按条数和近似字节数限制容量）
+
+    记录在所在批次提交成功后按 id 递增追加，缓冲区覆盖从最旧一条到最新一条之间
+    全部已提交的记录，因此落在这个范围内的分页查询可以完全由内存回答。写入失败的
+    批次在 id 序列中留下空洞，数据库中同样没有这些 id。
+    """
+
+    FILTER_KEYS = tuple(TRAFFIC_FILTERS)
+
+    def __init__(self, max_records=RECENT_BUFFER_RECORDS, max_bytes=RECENT_BUFFER_BYTES):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = deque()  # (row, nbytes)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _estimate_size(row):
+        """估算一条摘要占用的字节数（字符串长度 + 固定开销）"""
+        return 200 + sum(len(value) for value in row.values() if isinstance(value, (str, bytes)))
+
+    def append(self, row):
+        """追加一条记录（调用方保证 id 递增），超出容量时淘汰最旧的记录"""
+        if self.max_records <= 0:
+            return
+        nbytes = self._estimate_size(row)
+        with self._lock:
+            self._entries.append((row, nbytes))
+            self._bytes += nbytes
+            while self._entries and (len(self._entries) > self.max_records
+                                     or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popleft()
+                self._bytes -= evicted
+
+    def discard_through(self, max_id):
+        """淘汰 id 不大于 max_id 的记录（保留策略删除数据库记录后调用）"""
+        with self._lock:
+            while self._entries and self._entries[0][0]['id'] <= max_id:
+                _, evicted = self._entries.popleft()
+                self._bytes -= evicted
+
+    def _matches(self, row, filters):
+        """与 TrafficDatabase._build_filters 相同的过滤语义"""
+        for key in self.FILTER_KEYS:
+            value = filters.get(key)
+            if value not in (None, '') and row.get(key) != value:
+                return False
+        if filters.get('since') is not None and row['ts_ms'] < filters['since']:
+            return False
+        if filters.get('until') is not None and row['ts_ms'] >= filters['until']:
+            return False
+        return True
+
+    def query(self, limit, before_id=None, after_id=None, filters=None):
+        """在缓冲区中执行与 get_traffic_page 相同的查询
+
+        返回 (rows, complete, older_than)：complete 为 True 时 rows 就是完整结果；
+        否则 rows 是结果中较新的部分，剩余部分需要从 SQLite 查询 id < older_than 的记录。
+        """
+        filters = filters or {}
+        rows = []
+        with self._lock:
+            if not self._entries:
+                self.misses += 1
+                return rows, False, before_id
+            oldest_id = self._entries[0][0]['id']
+            covered = after_id is not None and after_id >= oldest_id - 1
+            
+            if after_id is not None and before_id is None:
+                # 从 after_id 向新的方向扫描，只有起点落在缓冲区内才能由内存回答
+                if not covered:
+                    self.misses += 1
+                    return rows, False, before_id
+                # id 可能有空洞，按 id 差算出的位置只是上界，回退到第一条 id 大于 after_id 的记录
+                start = min(after_id - oldest_id + 1, len(self._entries))
+                while start > 0 and self._entries[start - 1][0]['id'] > after_id:
+                    start -= 1
+                for row, _ in itertools.islice(self._entries, start, None):
+                    if self._matches(row, filters):
+                        rows.append(row)
+                        if len(rows) >= limit:
+                            break
+                rows.reverse()
+                self.hits += 1
+                return rows, True, None
+            
+            for row, _ in reversed(self._entries):
+                row_id = row['id']
+                if before_id is not None and row_id >= before_id:
+                    continue
+                if after_id is not None and row_id <= after_id:
+                    break
+                if self._matches(row, filters):
+                    rows.append(row)
+                    if len(rows) >= limit:
+                        break
+            
+            if len(rows) >= limit or covered:
+                self.hits += 1
+                return rows, True, None
+            self.misses += 1
+        older_than = oldest_id if before_id is None else min(before_id, oldest_id)
+        return rows, False, older_than
+
+    def stats(self):
+        """返回缓冲区统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'records': len(self._entries),
+                'bytes': self._bytes,
+                'max_records': self.max_records,
+                'max_bytes': self.max_bytes,
+                'oldest_id': self._entries[0][0]['id'] if self._entries else None,
+                'newest_id': self._entries[-1][0]['id'] if self._entries else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0
+            }
+
+
+def status_class(status_code):
+    """状态码分类（200 -> '2xx'），没有状态码时返回空字符串"""
+    return f'{status_code // 100}xx' if status_code else ''
+
+
+def normalize_content_type(content_type):
+    """去掉 charset 等参数并转为小写（与回填汇总表的 SQL 保持一致）"""
+    return (content_type or '').split(';')[0].strip().lower()
+
+
+def is_text_content_type(content_type):
+    """Content-Type 是否为可索引的文本类型（SEARCH_TEXT_TYPES）"""
+    media_type = normalize_content_type(content_type)
+    return any(media_type.startswith(t) if t.endswith('/') else t in media_type
+               for t in SEARCH_TEXT_TYPES)
+
+
+def searchable_text(text, content_type=None):
+    """返回写入全文索引的 body 文本：非文本类型、二进制占位和空 body 返回 None
+
+    content_type 为 None 时（请求体）不按类型过滤。
+    """
+    if not isinstance(text, str) or not text or text.startswith('[二进制数据:'):
+        return None
+    if content_type is not None and not is_text_content_type(content_type):
+        return None
+    return text[:SEARCH_BODY_CHARS]
+
+
+def searchable_blob_text(encoding, data, content_type):
+    """从 body_blobs 的一行提取索引文本（回填索引时注册为 SQL 函数使用）"""
+    if data is None:
+        return None
+    if encoding == 'zlib':
+        data = zlib.decompress(data)
+    return searchable_text(bytes(data).decode('utf-8', errors='ignore'), content_type)
+
 
-class TrafficDatabase:
+def build_search_match(text, fields=None):
+    """把用户输入转换为 FTS5 查询表达式
+
+    空白分隔的词按 AND 组合，"..." 为短语，词尾 * 为前缀匹配，大写 OR 表示或。
+    每个词都加引号，URL 片段里的 . / ? = 等字符不会被当作 FTS5 语法。
+    fields 为 SEARCH_FIELDS 中的字段名列表，用于限定匹配的列。
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text or ''):
+        if word == 'OR':
+            if terms and terms[-1] != 'OR':
+                terms.append('OR')
+            continue
+        prefix = bool(word) and word.endswith('*')
+        term = (phrase or word).rstrip('*') if prefix else (phrase or word)
+        if term.strip():
+            terms.append('"' + term.replace('"', '""') + '"' + ('*' if prefix else ''))
+    if terms and terms[-1] == 'OR':
+        terms.pop()
+    if not terms:
+        raise ValueError("q must contain at least one search term")
+    
+    expression = ' '.join(terms)
+    if fields:
+        columns = [column for field in fields for column in SEARCH_FIELDS[field]]
+        expression = f"{{{' '.join(columns)}}} : ({expression})"
+    return expression
+
+
+def encode_varint(value):
+    """无符号整数编码为 LEB128 varint"""
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, offset):
+    """从 offset 处读取一个 varint，返回 (值, 新的 offset)"""
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class HeaderDictionary:
+    """请求/响应头的字典编码
+
+    头部名存入 header_names，可复用的取值存入 header_values，每条记录只保存一串 varint：
+    每个头部先写 (名称id << 1 | 内联标志)，再写取值 id，或者内联取值的长度和 UTF-8 字节。
+    id 在进程内分配，新条目与引用它的记录经同一个批量写入队列按顺序提交；新条目入队
+    之后才放进缓存，所在批次写入失败时从缓存中丢弃，下次遇到时重新分配。
+    (名称, 取值) -> 编码片段 的 LRU 让热点路径只做字典查找和字节拼接。
+    """
+
+    def __init__(self, connections, submit, cache_size=HEADER_CACHE_SIZE):
+        self.connections = connections
+        self.submit = submit
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._segments = OrderedDict()  # (原始名称, 原始取值) -> 编码片段（只缓存字典取值）
+        self._raw_names = {}            # 原始名称 -> (名称id, 是否内联取值, 内联取值的编码前缀)
+        self._name_ids = {}             # 名称文本 -> 名称id
+        self._names = {}                # 名称id -> 名称文本（名称很少，全部常驻内存）
+        self._values = OrderedDict()    # 取值id -> 取值文本（解码用 LRU）
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        
+        reader = connections.reader()
+        for name_id, name in reader.execute("SELECT id, name FROM header_names"):
+            self._names[name_id] = name
+            self._name_ids[name] = name_id
+        self._next_name_id = max(self._names, default=0) + 1
+        self._next_value_id = (reader.execute("SELECT MAX(id) FROM header_values").fetchone()[0] or 0) + 1
+
+    @staticmethod
+    def _text(value):
+        return value.decode('utf-8', errors='replace') if isinstance(value, bytes) else value
+
+    @staticmethod
+    def _value_hash(value):
+        """取值的 64 位哈希（header_values 只索引哈希，不为长文本建索引）"""
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(),
+                              'big', signed=True)
+
+    def encode(self, fields):
+        """把头部字段 ((name, value), ...) 编码为引用列表
+
+        self._lock 只保护内存中的字典，从不在持锁时查询数据库或入队写操作，
+        写入队列的背压不会阻塞解码。
+        """
+        segments = self._segments
+        parts = []
+        missing = []
+        with self._lock:
+            for field in fields:
+                segment = segments.get(field)
+                if segment is not None:
+                    segments.move_to_end(field)
+                else:
+                    missing.append((len(parts), field))
+                parts.append(segment)
+            self.hits += len(parts) - len(missing)
+            self.misses += len(missing)
+        for index, (name, value) in missing:
+            parts[index] = self._encode_field(name, value)
+        return b''.join(parts)
+
+    def _encode_field(self, name, value):
+        """编码一个未命中缓存的头部（调用方不持有锁）"""
+        info = self._raw_names.get(name)
+        if info is None:
+            text = self._text(name)
+            name_id = self._name_id(text)
+            info = (name_id, text.lower() in HEADER_INLINE_NAMES, encode_varint(name_id << 1 | 1))
+            self._raw_names[name] = info
+        name_id, inline, inline_prefix = info
+        
+        # 内联取值按原始字节保存，不做解码
+        if inline or len(value) > HEADER_INTERN_MAX_LEN:
+            data = value if isinstance(value, bytes) else value.encode('utf-8')
+            return inline_prefix + encode_varint(len(data)) + data
+        
+        segment = encode_varint(name_id << 1) + encode_varint(self._value_id(self._text(value)))
+        with self._lock:
+            self._segments[(name, value)] = segment
+            if len(self._segments) > self.cache_size:
+                self._segments.popitem(last=False)
+        return segment
+
+    def _name_id(self, name):
+        """查找或分配名称 id（新名称在入队之后才对其他线程可见）"""
+        name_id = self._name_ids.get(name)
+        if name_id is not None:
+            return name_id
+        with self._lock:
+            name_id = self._next_name_id
+            self._next_name_id += 1
+        self.submit("INSERT INTO header_names (id, name) VALUES (?, ?)", (name_id, name),
+                    on_failure=lambda: self._forget(name_id=name_id))
+        with self._lock:
+            self._names[name_id] = name
+            self._name_ids[name] = name_id
+        return name_id
+
+    def _value_id(self, value):
+        """查找或分配取值 id
+
+        缓存淘汰后又遇到尚未提交的取值，或两个线程同时遇到同一个新取值时会再分配一个 id，
+        只多存一份，不影响正确性。
+        """
+        digest = self._value_hash(value)
+        self.lookups += 1
+        row = self.connections.reader().execute(
+            "SELECT id FROM header_values WHERE hash = ? AND value = ? LIMIT 1", (digest, value)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        with self._lock:
+            value_id = self._next_value_id
+            self._next_value_id += 1
+        self.submit("INSERT INTO header_values (id, hash, value) VALUES (?, ?, ?)",
+                    (value_id, digest, value), on_failure=lambda: self._forget(value_id=value_id))
+        with self._lock:
+            self._remember_value(value_id, value)
+        return value_id
+
+    def _remember_value(self, value_id, value):
+        self._values[value_id] = value
+        if len(self._values) > self.cache_size:
+            self._values.popitem(last=False)
+
+    def _forget(self, name_id=None, value_id=None):
+        """新条目所在批次写入失败时由写入线程调用：丢弃它的 id 和所有编码片段，之后重新分配"""
+        with self._lock:
+            self._segments.clear()
+            if name_id is not None:
+                name = self._names.pop(name_id, None)
+                if self._name_ids.get(name) == name_id:
+                    del self._name_ids[name]
+                self._raw_names.clear()
+            if value_id is not None:
+                self._values.pop(value_id, None)
+
+    def decode(self, data):
+        """把引用列表还原为头部字段 [(name, value), ...]"""
+        fields = []
+        offset = 0
+        while offset < len(data):
+            key, offset = decode_varint(data, offset)
+            name = self._names.get(key >> 1, '')
+            if key & 1:
+                length, offset = decode_varint(data, offset)
+                value = bytes(data[offset:offset + length]).decode('utf-8', errors='replace')
+                offset += length
+            else:
+                value_id, offset = decode_varint(data, offset)
+                value = self._value(value_id)
+            fields.append((name, value))
+        return fields
+
+    def _value(self, value_id):
+        with self._lock:
+            value = self._values.get(value_id)
+            if value is not None:
+                self._values.move_to_end(value_id)
+                return value
+        row = self.connections.reader().execute(
+            "SELECT value FROM header_values WHERE id = ?", (value_id,)).fetchone()
+        if row is None:
+            # 查不到的 id 不缓存（可能只是尚未提交）
+            return ''
+        with self._lock:
+            self._remember_value(value_id, row[0])
+        return row[0]
+
+    def stats(self):
+        """返回字典规模和缓存命中情况"""
+        total = self.hits + self.misses
+        return {
+            'names': len(self._names),
+            'values': self._next_value_id - 1,
+            'cached_fields': len(self._segments),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0,
+            'value_lookups': self.lookups
+        }
+
+
+class TrafficDatabase(TrafficStore):
+    table = 'traffic_logs'
+    list_columns = TRAFFIC_LIST_COLUMNS
+    traffic_filters = TRAFFIC_FILTERS
+    timestamp_columns = TIMESTAMP_COLUMNS
+    retention_columns = ('request_body_hash', 'response_body_hash')
+    retention_counters = ('deleted_bodies', 'body_bytes')
+    rollup_tables = ROLLUP_TABLES
+    rollup_dimensions = ROLLUP_DIMENSIONS
+    rollup_measures = ROLLUP_MEASURES
+    
     def __init__(self, db_path='mobile_traffic.db'):
         self.db_path = db_path
+        self.connections = ConnectionManager(db_path)
+        self.rollups = RollupAccumulator(ROLLUP_TABLES, ROLLUP_DIMENSIONS, ROLLUP_MEASURES)
+        self.search_enabled = False
         self.init_database()
+        self.writer = BatchWriter(self.connections.writer, on_flush=self.rollups.flush)
+        self.headers = HeaderDictionary(self.connections, self.writer.submit)
+        self._known_bodies = OrderedDict()
+        self._body_lock = threading.Lock()
+        # id 在进程内分配，内存缓冲区中的记录与数据库中的记录 id 一致
+        self.recent = RecentFlowBuffer()
+        self._id_lock = threading.Lock()
+        self._next_id = self._load_next_id()
+        atexit.register(self.close)
 
     def init_database(self):
         """初始化数据库表"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.connections.writer
             cursor = conn.cursor()
+            fresh = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'traffic_logs'").fetchone() is None
             
+            # timestamp 是旧版本的 ISO 字符串列，新记录只写 ts_ms（epoch 毫秒）
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS traffic_logs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -56,257 +632,1022 @@ class TrafficDatabase:
                     request_body TEXT,
                     response_body TEXT,
                     content_type TEXT,
-                    size INTEGER
+                    size INTEGER,
+                    device_id TEXT
+                )
+            ''')
+            
+            # 内容寻址的 body 存储：相同内容只存一份
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS body_blobs (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER,
+                    encoding TEXT,
+                    data BLOB
+                ) WITHOUT ROWID
+            ''')
+            
+            # 头部字典：名称和可复用的取值各存一份（request_headers/response_headers 列只在旧记录中有值）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS header_names (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT
                 )
             ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS header_values (
+                    id INTEGER PRIMARY KEY,
+                    hash INTEGER,
+                    value TEXT
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_header_values_hash ON header_values(hash)")
+            
+            # 旧版本数据库缺少的列，按需补齐
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(traffic_logs)")}
+            for column, column_type in (('device_id', 'TEXT'), ('request_body_hash', 'TEXT'),
+                                        ('response_body_hash', 'TEXT'), ('ts_ms', 'INTEGER'),
+                                        ('request_header_refs', 'BLOB'), ('response_header_refs', 'BLOB')):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE traffic_logs ADD COLUMN {column} {column_type}")
+            if fresh:
+                cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            
+            # 过滤条件 + id 的复合索引，保证按游标分页时深页与首页代价相同
+            for name, column in TRAFFIC_INDEXES:
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON traffic_logs({column}, id)")
             
+            # 保留策略删除记录后按哈希检查 body 是否仍被引用
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_traffic_request_body ON traffic_logs(request_body_hash)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_traffic_response_body ON traffic_logs(response_body_hash)")
+            
+            # 汇总表：新建时用已有明细回填一次
+            for table, width in self.rollups.create_tables(cursor):
+                cursor.execute(f'''
+                    INSERT INTO {table} (bucket, host, device_id, status_class, content_type, requests, bytes)
+                    SELECT COALESCE(ts_ms, CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000) / {width} * {width},
+                           COALESCE(host, ''), COALESCE(device_id, ''),
+                           CASE WHEN status_code IS NULL OR status_code = 0 THEN '' ELSE (status_code / 100) || 'xx' END,
+                           lower(trim(CASE WHEN instr(content_type, ';') > 0
+                                           THEN substr(content_type, 1, instr(content_type, ';') - 1)
+                                           ELSE COALESCE(content_type, '') END)),
+                           COUNT(*), COALESCE(SUM(size), 0)
+                    FROM traffic_logs WHERE ts_ms IS NOT NULL OR strftime('%s', timestamp) IS NOT NULL
+                    GROUP BY 1, 2, 3, 4, 5
+                ''')
+            
+            self.search_enabled = self._init_search_index(cursor)
             conn.commit()
-            conn.close()
             print("✅ 数据库初始化完成")
         except Exception as e:
             print(f"❌ 数据库初始化失败: {e}")
 
+    def _init_search_index(self, cursor):
+        """创建全文索引（rowid 即 traffic_logs.id），新建时用已有记录回填一次
+
+        SQLite 未编译 FTS5 时返回 False，检索功能关闭但不影响抓包。
+        """
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'traffic_fts'").fetchone() is not None
+        try:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS traffic_fts USING fts5(
+                    url, host, path, request_body, response_body,
+                    tokenize = '{SEARCH_TOKENIZER}', prefix = '3'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ SQLite 不支持 FTS5，全文检索不可用: {e}")
+            return False
+        
+        # 排序函数保存在索引配置中，查询直接 ORDER BY rank
+        weights = ', '.join(str(weight) for weight in SEARCH_COLUMN_WEIGHTS)
+        cursor.execute("INSERT INTO traffic_fts (traffic_fts, rank) VALUES ('rank', ?)", (f'bm25({weights})',))
+        if not exists:
+            self.connections.writer.create_function('searchable_blob_text', 3, searchable_blob_text,
+                                                    deterministic=True)
+            cursor.execute('''
+                INSERT INTO traffic_fts (rowid, url, host, path, request_body, response_body)
+                SELECT t.id, t.url, t.host, t.path,
+                       COALESCE(searchable_blob_text(rb.encoding, rb.data, NULL), t.request_body),
+                       COALESCE(searchable_blob_text(sb.encoding, sb.data, t.content_type), t.response_body)
+                FROM traffic_logs t
+                LEFT JOIN body_blobs rb ON rb.hash = t.request_body_hash
+                LEFT JOIN body_blobs sb ON sb.hash = t.response_body_hash
+            ''')
+            if cursor.rowcount > 0:
+                print(f"🔎 全文索引已回填 {cursor.rowcount} 条记录")
+        return True
+
     def save_traffic(self, flow_data):
-        """保存流量数据到数据库"""
+        """保存流量数据到数据库（写入批量队列，由后台线程提交）
+
+        flow_data 的时间为 epoch 毫秒，头部为原始字段 ((name, value), ...)，按字典编码保存；
+        请求体/响应体写入 body_blobs，traffic_logs 只保存其哈希。
+        返回分配的记录 id，失败时返回 None。
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            (ts_ms, method, url, host, path, status_code, request_headers,
+             response_headers, request_body, response_body, content_type, size,
+             device_id) = flow_data
+            request_body_hash = self._store_body(request_body)
+            response_body_hash = self._store_body(response_body)
+            timestamp = ms_to_iso(ts_ms)
+            if HEADER_DICTIONARY_ENABLED:
+                request_refs = self.headers.encode(request_headers)
+                response_refs = self.headers.encode(response_headers)
+                request_headers = response_headers = None
+            else:
+                request_refs = response_refs = None
+                request_headers = headers_to_json(request_headers)
+                response_headers = headers_to_json(response_headers)
             
-            cursor.execute('''
-                INSERT INTO traffic_logs 
-                (timestamp, method, url, host, path, status_code, request_headers, 
-                 response_headers, request_body, response_body, content_type, size)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', flow_data)
+            # 汇总增量先于明细入队，与明细在同一批次（或更早的批次）提交
+            self.rollups.add(ts_ms, (host, device_id, status_class(status_code),
+                                         normalize_content_type(content_type)), (1, size or 0))
             
-            conn.commit()
-            conn.close()
+            # 分配 id 和入队在同一把锁内完成，批次按 id 顺序提交；
+            # 摘要在提交成功后才进入缓冲区，列表里不会出现查不到详情的记录
+            with self._id_lock:
+                row_id = self._next_id
+                self._next_id += 1
+                summary = {
+                    'id': row_id, 'ts_ms': ts_ms, 'timestamp': timestamp, 'method': method, 'url': url,
+                    'host': host, 'path': path, 'status_code': status_code,
+                    'request_headers': request_headers, 'response_headers': response_headers,
+                    'request_header_refs': request_refs, 'response_header_refs': response_refs,
+                    'content_type': content_type, 'size': size, 'device_id': device_id,
+                    'request_body_hash': request_body_hash,
+                    'response_body_hash': response_body_hash
+                }
+                self.writer.submit('''
+                    INSERT INTO traffic_logs 
+                    (id, ts_ms, method, url, host, path, status_code, request_headers, 
+                     response_headers, request_header_refs, response_header_refs,
+                     content_type, size, device_id, request_body_hash, response_body_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (row_id, ts_ms, method, url, host, path, status_code, request_headers,
+                      response_headers, request_refs, response_refs, content_type, size, device_id,
+                      request_body_hash, response_body_hash),
+                    on_commit=lambda: self.recent.append(summary))
+            if self.search_enabled:
+                self.writer.submit('''
+                    INSERT INTO traffic_fts (rowid, url, host, path, request_body, response_body)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (row_id, url, host, path, searchable_text(request_body),
+                      searchable_text(response_body, content_type)))
+            return row_id
         except Exception as e:
             print(f"❌ 保存流量数据失败: {e}")
+            return None
+
+    def _store_body(self, body):
+        """把 body 写入内容寻址存储并返回哈希，空 body 返回 None
+
+        BodyDigest（抓取策略决定只记录哈希的 body）不写入 body_blobs，直接返回其哈希。
+        """
+        if not body:
+            return None
+        if isinstance(body, BodyDigest):
+            return body.digest
+        data = body.encode('utf-8', errors='ignore') if isinstance(body, str) else bytes(body)
+        digest = hashlib.sha256(data).hexdigest()
+        
+        with self._body_lock:
+            if digest in self._known_bodies:
+                self._known_bodies.move_to_end(digest)
+                return digest
+            self._known_bodies[digest] = None
+            if len(self._known_bodies) > BODY_DEDUP_CACHE_SIZE:
+                self._known_bodies.popitem(last=False)
+        
+        encoding, payload = 'raw', data
+        if len(data) >= BODY_MIN_COMPRESS_SIZE:
+            compressed = zlib.compress(data, BODY_COMPRESS_LEVEL)
+            if len(compressed) < len(data):
+                encoding, payload = 'zlib', compressed
+        
+        # 其他进程/重启前可能已写入过同一内容，由 OR IGNORE 去重；
+        # 所在批次写入失败时从去重缓存中丢弃，下次遇到同一内容时重新写入
+        self.writer.submit('''
+            INSERT OR IGNORE INTO body_blobs (hash, size, encoding, data)
+            VALUES (?, ?, ?, ?)
+        ''', (digest, len(data), encoding, payload), on_failure=lambda: self._forget_body(digest))
+        return digest
+
+    def _forget_body(self, digest):
+        """body 所在批次写入失败时由写入线程调用，让之后的记录重新写入该 body"""
+        with self._body_lock:
+            self._known_bodies.pop(digest, None)
+
+    def delete_dependents(self, conn, ids):
+        """保留策略删除明细的同一事务内删除对应的全文索引"""
+        if self.search_enabled:
+            conn.executemany("DELETE FROM traffic_fts WHERE rowid = ?", ids)
+
+    def on_rows_deleted(self, conn, rows, report):
+        """保留策略删除一批明细后淘汰缓冲区中的记录，并清理不再被引用的 body"""
+        # 缓冲区必须覆盖连续的 id 区间，从最旧一端淘汰到本批删除的最大 id
+        self.recent.discard_through(rows[-1][0])
+        hashes = {digest for row in rows for digest in row[1:] if digest}
+        if hashes:
+            count, freed = self.delete_orphan_bodies(conn, hashes)
+            report['deleted_bodies'] += count
+            report['body_bytes'] += freed
+
+    def delete_orphan_bodies(self, conn, hashes):
+        """在维护连接上删除不再被任何记录引用的 body，返回 (删除数量, 释放的字节数)
+
+        检查和删除期间持有 _body_lock：仍在去重缓存中的哈希可能正被尚未提交的记录引用，
+        一律跳过；不在缓存中的哈希之后再被使用时会重新写入 body_blobs。
+        """
+        with self._body_lock:
+            orphans = []
+            for digest in hashes:
+                if digest in self._known_bodies:
+                    continue
+                referenced = conn.execute(
+                    "SELECT EXISTS(SELECT 1 FROM traffic_logs WHERE request_body_hash = ?) "
+                    "OR EXISTS(SELECT 1 FROM traffic_logs WHERE response_body_hash = ?)",
+                    (digest, digest)
+                ).fetchone()[0]
+                if not referenced:
+                    orphans.append((digest,))
+            if not orphans:
+                return 0, 0
+            freed = 0
+            with conn:
+                for (digest,) in orphans:
+                    row = conn.execute("SELECT length(data) FROM body_blobs WHERE hash = ?", (digest,)).fetchone()
+                    if row and row[0]:
+                        freed += row[0]
+                conn.executemany("DELETE FROM body_blobs WHERE hash = ?", orphans)
+            return len(orphans), freed
+
+    def get_body(self, digest):
+        """按哈希读取 body 原始字节，不存在时返回 None"""
+        row = self.connections.reader().execute(
+            "SELECT encoding, data FROM body_blobs WHERE hash = ?", (digest,)
+        ).fetchone()
+        if row is None:
+            return None
+        encoding, payload = row
+        return zlib.decompress(payload) if encoding == 'zlib' else bytes(payload)
+
+    def get_traffic_detail(self, traffic_id):
+        """获取单条流量的完整信息（按需加载请求体/响应体）"""
+        cursor = self.connections.reader().cursor()
+        cursor.execute("SELECT * FROM traffic_logs WHERE id = ?", (traffic_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        
+        record = self._to_record([description[0] for description in cursor.description], row)
+        for field in ('request_body', 'response_body'):
+            digest = record.get(f'{field}_hash')
+            # 旧记录的 body 仍内联在 traffic_logs 中
+            if digest:
+                data = self.get_body(digest)
+                record[field] = data.decode('utf-8', errors='replace') if data is not None else None
+        return record
+
+    def search_traffic(self, match, limit=SEARCH_PAGE_DEFAULT, after=None, order='rank'):
+        """全文检索，返回 (结果列表, 下一页游标)
+
+        match:  build_search_match 生成的 FTS5 表达式
+        after:  上一页的游标（rank 排序为 (rank, id)，recent 排序为 id）
+        order:  rank 按相关度（bm25）排序；recent 按 id 从新到旧
+        每条结果是列表字段加上 rank 和带高亮的 snippet。
+        """
+        where = ["traffic_fts MATCH ?"]
+        params = [match]
+        if order == 'rank':
+            if after is not None:
+                where.append("(rank > ? OR (rank = ? AND rowid > ?))")
+                params.extend((after[0], after[0], after[1]))
+            order_by = "rank, rowid"
+        else:
+            if after is not None:
+                where.append("rowid < ?")
+                params.append(after)
+            order_by = "rowid DESC"
+        
+        open_tag, close_tag = SEARCH_HIGHLIGHT
+        reader = self.connections.reader()
+        hits = reader.execute(
+            f"SELECT rowid, rank, snippet(traffic_fts, -1, ?, ?, '…', ?) FROM traffic_fts "
+            f"WHERE {' AND '.join(where)} ORDER BY {order_by} LIMIT ?",
+            [open_tag, close_tag, SEARCH_SNIPPET_TOKENS] + params + [limit]
+        ).fetchall()
+        if not hits:
+            return [], None
+        
+        cursor = reader.execute(
+            f"SELECT {TRAFFIC_LIST_COLUMNS} FROM traffic_logs WHERE id IN ({', '.join('?' * len(hits))})",
+            [hit[0] for hit in hits]
+        )
+        columns = [description[0] for description in cursor.description]
+        records = {row[0]: self._to_record(columns, row) for row in cursor.fetchall()}
+        results = []
+        for row_id, rank, snippet in hits:
+            record = records.get(row_id)
+            if record is not None:
+                record['rank'] = rank
+                record['snippet'] = snippet
+                results.append(record)
+        
+        if len(hits) < limit:
+            return results, None
+        last_id, last_rank = hits[-1][0], hits[-1][1]
+        return results, f"{last_rank!r}:{last_id}" if order == 'rank' else str(last_id)
 
     def get_recent_traffic(self, limit=100):
         """获取最近的流量记录"""
+        return self.get_traffic_page(limit)
+
+    def get_traffic_page(self, limit=100, before_id=None, after_id=None, filters=None):
+        """按 id 游标分页查询流量记录（结果按 id 从新到旧排列）
+
+        before_id: 返回 id 小于该值的较旧记录
+        after_id:  返回 id 大于该值的较新记录
+        filters:   host / method / status_code / content_type / device_id / since / until（epoch 毫秒）
+
+        先从内存缓冲区取，缓冲区覆盖不到的更旧部分再查询 SQLite。
+        """
+        rows, complete, older_than = self.recent.query(limit, before_id, after_id, filters or {})
+        # 缓冲区中的记录是共享的，解码头部时复制一份
+        rows = [self._decode_headers(dict(row)) for row in rows]
+        if complete:
+            return rows
+        if after_id is not None and before_id is None:
+            # 从 after_id 向新的方向扫描且起点早于缓冲区，整页交给 SQLite
+            return self._query_traffic_page(limit, before_id, after_id, filters)
+        # 其余情况结果从新到旧，缓冲区之后接着查询比缓冲区更旧的记录
+        return rows + self._query_traffic_page(limit - len(rows), older_than, after_id, filters)
+
+    def _to_record(self, columns, row):
+        """查询结果转换为 API 输出的字典（时间转为 ISO 字符串，头部引用还原为 JSON）"""
+        return self._decode_headers(super()._to_record(columns, row))
+
+    def _decode_headers(self, record):
+        """把 *_header_refs 还原为与旧版本相同的 JSON 文本（旧记录直接使用 JSON 列）"""
+        for prefix in ('request', 'response'):
+            refs = record.pop(f'{prefix}_header_refs', None)
+            if refs is not None:
+                record[f'{prefix}_headers'] = headers_to_json(self.headers.decode(refs))
+        return record
+
+# 全局数据库实例、数据保留策略和旧版本数据库的时间戳迁移
+# （由 init_services 在主进程中创建；代理工作进程导入本模块时不打开数据库、不启动写入线程）
+traffic_db = None
+retention_manager = None
+timestamp_migration = None
+
+# WebSocket 事件中心（生产者可在任意线程发布，投递在 WebSocket 服务器的事件循环中完成）
+event_hub = EventHub(FILTER_FIELDS)
+
+
+# mitmproxy 钩子中抓取的流量快照：只持有原始对象引用，不做任何编码/解码
+# （流式转发的响应 response_content 为 BodyStream，只含保留的前缀和计数）
+FlowRecord = namedtuple('FlowRecord', [
+    'timestamp', 'method', 'url', 'host', 'path', 'status_code',
+    'request_headers', 'response_headers', 'request_content', 'request_encoding',
+    'response_content', 'response_encoding', 'content_type', 'request_content_type',
+    'device_id', 'enqueued_at'
+])
+
+
+def headers_to_json(fields):
+    """把原始头部字段 ((name, value), ...) 序列化为 JSON（同名头部用 ", " 合并）"""
+    headers = {}
+    names = {}
+    for name, value in fields:
+        name = name.decode('utf-8', errors='replace') if isinstance(name, bytes) else name
+        value = value.decode('utf-8', errors='replace') if isinstance(value, bytes) else value
+        key = names.setdefault(name.lower(), name)
+        headers[key] = f"{headers[key]}, {value}" if key in headers else value
+    return json.dumps(headers)
+
+
+# 只记录哈希、不保存内容的 body（_store_body 直接返回其中的哈希）
+BodyDigest = namedtuple('BodyDigest', ['digest'])
+
+
+def _decompressor(content_encoding, content):
+    """按 Content-Encoding 创建流式解压器，返回 (类型, 解压器)；不支持的编码返回 (None, None)"""
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return 'zlib', zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        # 规范要求带 zlib 头，但不少服务器发送裸 deflate 流
+        wbits = zlib.MAX_WBITS if content[:1] == b'\x78' else -zlib.MAX_WBITS
+        return 'zlib', zlib.decompressobj(wbits)
+    if content_encoding == 'br' and BROTLI_AVAILABLE:
+        return 'brotli', brotli.Decompressor()
+    if content_encoding == 'zstd' and ZSTD_AVAILABLE:
+        return 'zstd', zstandard.ZstdDecompressor().decompressobj()
+    return None, None
+
+
+class BodyDecoder:
+    """增量解压 Content-Encoding：只保留前 limit 字节，其余输出只计数后丢弃
+
+    zlib 的每次输出都受 CAPTURE_DECODE_CHUNK 限制（压缩炸弹也不会占用大量内存），
+    brotli / zstd 没有输出上限参数，只能通过小块输入控制单次输出。
+    不支持的编码在构造时抛出 ValueError。
+    """
+
+    def __init__(self, content_encoding, limit):
+        self.content_encoding = content_encoding
+        self.limit = limit
+        self.kept = bytearray()
+        self.total = 0
+        self.kind = None
+        self.decompressor = None
+        if _decompressor(content_encoding, b'')[1] is None:
+            raise ValueError(f"不支持的 Content-Encoding: {content_encoding}")
+
+    def feed(self, content):
+        """输入一段压缩数据（可以是 memoryview）"""
+        if not content:
+            return
+        if self.decompressor is None:
+            # deflate 需要根据第一个字节判断是否带 zlib 头，所以延迟到收到数据时创建
+            self.kind, self.decompressor = _decompressor(self.content_encoding, bytes(content[:1]))
+        if self.kind == 'zlib' and self.decompressor.eof:
+            return
+        view = memoryview(content)
+        step = CAPTURE_DECODE_CHUNK if self.kind == 'zlib' else CAPTURE_DECODE_CHUNK // 16
+        for start in range(0, len(view), step):
+            data = view[start:start + step]
+            while data:
+                if self.kind == 'zlib':
+                    output = self.decompressor.decompress(data, CAPTURE_DECODE_CHUNK)
+                    data = self.decompressor.unconsumed_tail
+                elif self.kind == 'brotli':
+                    output = self.decompressor.process(bytes(data))
+                    data = None
+                else:
+                    output = self.decompressor.decompress(data)
+                    data = None
+                self.total += len(output)
+                if len(self.kept) < self.limit:
+                    self.kept += output[:self.limit - len(self.kept)]
+            if self.kind == 'zlib' and self.decompressor.eof:
+                break
+
+    @property
+    def prefix(self):
+        return bytes(self.kept)
+
+
+def decode_prefix(content, content_encoding, limit):
+    """解压完整的 body，返回 (前 limit 字节, 解压后的总字节数)；不支持的编码抛出 ValueError"""
+    decoder = BodyDecoder(content_encoding, limit)
+    decoder.feed(content)
+    return decoder.prefix, decoder.total
+
+
+class BodyStream:
+    """流式转发响应时的透传回调（赋值给 response.stream，在 mitmproxy 事件循环中调用）
+
+    每个数据块原样返回，只计数并按抓取规则保留前 N 字节：
+    'hash' 规则增量计算 sha256，压缩的 body 增量解压以得到真实大小。
+    回调绝不抛出异常，解压失败时只停止解压、继续计数（不影响转发）。
+    """
+
+    __slots__ = ('rule', 'wire_size', 'kept', 'hasher', 'decoder', 'failed')
+
+    def __init__(self, rule, content_encoding=None):
+        self.rule = rule
+        self.wire_size = 0
+        self.kept = bytearray()
+        self.hasher = None
+        self.decoder = None
+        self.failed = False
+        
+        encoded = (content_encoding or 'identity').strip().lower() != 'identity'
+        if rule == 'hash':
+            self.hasher = hashlib.sha256()
+        elif isinstance(rule, int) and rule > 0 and encoded:
+            try:
+                self.decoder = BodyDecoder(content_encoding, rule)
+            except ValueError:
+                # 无法解压：与 CapturePolicy.capture 一致，只记录原始字节的哈希
+                self.hasher = hashlib.sha256()
+                self.failed = True
+
+    def __call__(self, data):
+        if not data:
+            # 空数据块表示响应体结束
+            return data
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT * FROM traffic_logs 
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            ''', (limit,))
-            
-            rows = cursor.fetchall()
-            conn.close()
-            
-            # 转换为字典格式
-            columns = [description[0] for description in cursor.description]
-            result = []
-            for row in rows:
-                result.append(dict(zip(columns, row)))
-            
-            return result
-        except Exception as e:
-            print(f"❌ 获取流量数据失败: {e}")
-            return []
+            self.wire_size += len(data)
+            if self.hasher is not None:
+                self.hasher.update(data)
+            elif self.decoder is not None and not self.failed:
+                self.decoder.feed(data)
+            elif self.decoder is None and isinstance(self.rule, int) and len(self.kept) < self.rule:
+                self.kept += data[:self.rule - len(self.kept)]
+        except Exception:
+            self.failed = True
+        return data
+
+
+class CapturePolicy:
+    """body 抓取策略
+
+    按 host 规则、再按 Content-Type 规则（fnmatch，按顺序取第一条）决定每个 body：
+    保留前 N 字节（先在字节上切片再解码，不复制整个 body）、只记录 sha256，或直接跳过。
+    无论哪种处理方式都记录真实大小：未压缩的 body 即字节数，
+    压缩的 body 流式解压计数，内存占用只与保留上限有关，与 body 大小无关。
+    """
+
+    def __init__(self, type_rules=CAPTURE_TYPE_RULES, host_rules=CAPTURE_HOST_RULES,
+                 default_limit=CAPTURE_BODY_LIMIT):
+        self.type_rules = tuple(type_rules)
+        self.host_rules = tuple(host_rules)
+        self.default_limit = default_limit
+        self._cache = {}
+        self._lock = threading.Lock()
+        
+        # 统计信息
+        self.counts = {'kept': 0, 'truncated': 0, 'hashed': 0, 'skipped': 0, 'undecodable': 0}
+        self.bytes_seen = 0
+        self.bytes_kept = 0
+        self.streamed = 0
+        self.streamed_bytes = 0
+
+    def rule(self, host, content_type):
+        """返回 (host, Content-Type) 对应的规则：字节数、'hash' 或 'skip'"""
+        media_type = normalize_content_type(content_type)
+        key = (host, media_type)
+        rule = self._cache.get(key)
+        if rule is not None:
+            return rule
+        
+        rule = self.default_limit
+        for patterns, value in ((self.host_rules, host or ''), (self.type_rules, media_type)):
+            matched = next((action for pattern, action in patterns if fnmatch.fnmatchcase(value, pattern)), None)
+            if matched is not None:
+                rule = matched
+                break
+        
+        if len(self._cache) >= CAPTURE_POLICY_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = rule
+        return rule
+
+    def capture(self, host, content_type, content, content_encoding=None):
+        """按策略处理一个 body，返回 (body, 真实大小)
 
+        body 为保留的文本前缀、BodyDigest（只记录哈希）或 None（跳过）。
+        """
+        if not content:
+            return "", 0
+        size = len(content)
+        rule = self.rule(host, content_type)
+        encoded = (content_encoding or 'identity').strip().lower() != 'identity'
+        
+        if rule == 'skip' or rule == 0:
+            return self._count('skipped', size, 0, None), size
+        if rule == 'hash':
+            return self._count('hashed', size, 0, BodyDigest(hashlib.sha256(content).hexdigest())), size
+        
+        if encoded:
+            try:
+                prefix, size = decode_prefix(content, content_encoding, rule)
+            except Exception:
+                # 无法解压：按二进制处理，只记录原始字节的哈希
+                return self._count('undecodable', size, 0, BodyDigest(hashlib.sha256(content).hexdigest())), size
+        else:
+            prefix = memoryview(content)[:rule]
+        return self._to_text(content_type, prefix, size, content)
+
+    def open_stream(self, host, content_type, content_length=None, content_encoding=None):
+        """收到响应头时调用：需要流式转发时返回 BodyStream，否则返回 None
+
+        按规则跳过/只记录哈希的类型总是流式转发，其他类型在 Content-Length 超过
+        CAPTURE_STREAM_THRESHOLD 时流式转发（没有 Content-Length 的响应仍由 mitmproxy 缓冲）。
+        """
+        rule = self.rule(host, content_type)
+        if rule in ('skip', 'hash', 0) or (content_length is not None and content_length > CAPTURE_STREAM_THRESHOLD):
+            return BodyStream(rule, content_encoding)
+        return None
+
+    def capture_stream(self, content_type, stream):
+        """处理流式转发结束后的 BodyStream，返回值与 capture 相同"""
+        size = stream.wire_size
+        with self._lock:
+            self.streamed += 1
+            self.streamed_bytes += size
+        if not size:
+            return "", 0
+        if stream.rule == 'skip' or stream.rule == 0:
+            return self._count('skipped', size, 0, None), size
+        if stream.hasher is not None:
+            action = 'undecodable' if stream.failed else 'hashed'
+            return self._count(action, size, 0, BodyDigest(stream.hasher.hexdigest())), size
+        if stream.decoder is not None:
+            if stream.failed:
+                return self._count('undecodable', size, 0, None), size
+            return self._to_text(content_type, stream.decoder.prefix, stream.decoder.total)
+        return self._to_text(content_type, stream.kept, size)
+
+    def _to_text(self, content_type, prefix, size, content=None):
+        """把保留的前缀转换为文本，返回 (body, 真实大小)
+
+        未声明为文本的类型先嗅探是否为二进制，避免把乱码存为文本：
+        二进制内容改为只记录完整 body 的哈希（流式转发时没有完整 body，只记录大小）。
+        """
+        if b'\x00' in bytes(prefix[:CAPTURE_SNIFF_BYTES]) and not is_text_content_type(content_type):
+            if content is None:
+                return self._count('skipped', size, 0, None), size
+            return self._count('hashed', size, 0, BodyDigest(hashlib.sha256(content).hexdigest())), size
+        
+        text = str(prefix, 'utf-8', errors='ignore')
+        action = 'truncated' if size > len(prefix) else 'kept'
+        return self._count(action, size, len(prefix), text), size
+
+    def _count(self, action, seen, kept, result):
+        """更新统计信息并原样返回 result"""
+        with self._lock:
+            self.counts[action] += 1
+            self.bytes_seen += seen
+            self.bytes_kept += kept
+        return result
+
+    def stats(self):
+        """返回抓取策略统计信息"""
+        with self._lock:
+            stats = dict(self.counts)
+            stats.update({
+                'bytes_seen': self.bytes_seen,
+                'bytes_kept': self.bytes_kept,
+                'streamed': self.streamed,
+                'streamed_bytes': self.streamed_bytes,
+                'cached_rules': len(self._cache),
+                'brotli_available': BROTLI_AVAILABLE,
+                'zstd_available': ZSTD_AVAILABLE
+            })
+        return stats
+
+
+# 全局抓取策略
+capture_policy = CapturePolicy()
+
+
+def capture_flow_data(record):
+    """按抓取策略处理快照中的 body，返回 save_traffic 使用的 flow_data（可在代理工作进程中执行）"""
+    request_body, _ = capture_policy.capture(record.host, record.request_content_type,
+                                             record.request_content, record.request_encoding)
+    if isinstance(record.response_content, BodyStream):
+        response_body, response_size = capture_policy.capture_stream(record.content_type,
+                                                                     record.response_content)
+    else:
+        response_body, response_size = capture_policy.capture(record.host, record.content_type,
+                                                              record.response_content,
+                                                              record.response_encoding)
+    
+    return (
+        record.timestamp,
+        record.method,
+        record.url,
+        record.host,
+        record.path,
+        record.status_code,
+        record.request_headers,
+        record.response_headers,
+        request_body,
+        response_body,
+        record.content_type,
+        response_size,
+        record.device_id
+    )
+
+
+def store_flow_data(flow_data):
+    """保存一条 flow_data 并推送事件（只在持有数据库和事件中心的主进程中执行）"""
+    (ts_ms, method, url, host, path, status_code, _, _, _, _,
+     content_type, response_size, device_id) = flow_data
+    row_id = traffic_db.save_traffic(flow_data)
+    
+    # 推送到WebSocket客户端（线程安全，实际发送在WebSocket服务器的事件循环中完成）
+    event_hub.publish({
+        'id': row_id,
+        'timestamp': ms_to_iso(ts_ms),
+        'method': method,
+        'url': url,
+        'host': host,
+        'path': path,
+        'status_code': status_code,
+        'content_type': content_type,
+        'size': response_size,
+        'device_id': device_id
+    })
+
+
+def process_flow_record(record):
+    """工作线程：序列化并保存一条流量快照"""
+    store_flow_data(capture_flow_data(record))
+
+
+class CapturePipeline:
+    """抓包流水线
+
+    mitmproxy 钩子把 FlowRecord 放入有界队列后立即返回，
+    工作线程负责 JSON 序列化、body 解码和写库。
+    队列满时直接丢弃并计数（显式背压，绝不阻塞 mitmproxy 事件循环）。
+    """
+
+    _STOP = object()
+
+    def __init__(self, handler, workers=CAPTURE_WORKERS, max_queue=CAPTURE_QUEUE_MAXSIZE):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        
+        # 统计信息
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.hook_calls = 0
+        self.hook_total_us = 0.0
+        self.hook_max_us = 0.0
+        self.process_total_ms = 0.0
+        self.process_max_ms = 0.0
+        
+        self.threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._run, name=f'capture-worker-{index}')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, record):
+        """提交快照，队列满时丢弃并返回 False"""
+        try:
+            self.queue.put_nowait(record)
+            self.submitted += 1
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                print(f"⚠️ 抓包队列已满，已丢弃 {self.dropped} 条流量")
+            return False
 
-# 全局数据库实例
-traffic_db = TrafficDatabase()
+    def record_hook_latency(self, seconds):
+        """记录一次 mitmproxy 钩子耗时（即抓包给代理增加的延迟）"""
+        elapsed_us = seconds * 1_000_000
+        self.hook_calls += 1
+        self.hook_total_us += elapsed_us
+        self.hook_max_us = max(self.hook_max_us, elapsed_us)
 
-# 存储连接的WebSocket客户端
-websocket_clients = set()
+    def close(self, timeout=10):
+        """处理完队列中剩余的快照后停止工作线程"""
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.threads:
+            self.queue.put(self._STOP)
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """返回流水线统计信息"""
+        return {
+            'enabled': CAPTURE_PIPELINE_ENABLED,
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'hook_avg_us': round(self.hook_total_us / self.hook_calls, 1) if self.hook_calls else 0,
+            'hook_max_us': round(self.hook_max_us, 1),
+            'process_avg_ms': round(self.process_total_ms / self.processed, 3) if self.processed else 0,
+            'process_max_ms': round(self.process_max_ms, 3)
+        }
+
+    def _run(self):
+        """工作线程主循环"""
+        while True:
+            record = self.queue.get()
+            if record is self._STOP:
+                break
+            try:
+                self.handler(record)
+                self.processed += 1
+                # 从入队到处理完成的耗时
+                elapsed_ms = (time.perf_counter() - record.enqueued_at) * 1000
+                self.process_total_ms += elapsed_ms
+                self.process_max_ms = max(self.process_max_ms, elapsed_ms)
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ 处理流量数据时出错: {e}")
+
+
+# 全局抓包流水线（由 init_services 创建；代理工作进程中由 run_proxy_worker 创建转发用的流水线）
+capture_pipeline = None
+
+
+def init_services():
+    """创建数据库及依赖它的后台组件和抓包流水线（只在主进程中调用，重复调用无效果）"""
+    global traffic_db, retention_manager, timestamp_migration, capture_pipeline
+    if traffic_db is not None:
+        return
+    traffic_db = TrafficDatabase()
+    retention_manager = RetentionManager(traffic_db)
+    timestamp_migration = TimestampMigration(traffic_db, {'traffic_logs': TIMESTAMP_COLUMNS},
+                                             old_indexes=('idx_traffic_timestamp',))
+    capture_pipeline = CapturePipeline(process_flow_record)
 
 
 class TrafficCaptureAddon:
     """mitmproxy插件：捕获HTTP流量"""
     
+    def responseheaders(self, flow: http.HTTPFlow) -> None:
+        """收到响应头时决定是否流式转发（大响应和二进制类型不缓冲完整 body）
+
+        流式转发的响应仍在传输结束后触发 response 钩子，
+        此时 raw_content 为空，body 的计数和前缀从 flow.metadata 中的 BodyStream 读取。
+        """
+        if not CAPTURE_STREAM_ENABLED:
+            return
+        try:
+            response = flow.response
+            if response.stream:
+                return
+            length = response.headers.get('content-length', '').strip()
+            stream = capture_policy.open_stream(
+                flow.request.host,
+                response.headers.get('content-type', ''),
+                int(length) if length.isdigit() else None,
+                response.headers.get('content-encoding')
+            )
+            if stream is not None:
+                response.stream = stream
+                flow.metadata['capture_stream'] = stream
+        except Exception as e:
+            print(f"❌ 设置流式转发失败: {e}")
+    
     def response(self, flow: http.HTTPFlow) -> None:
-        """处理HTTP响应"""
+        """处理HTTP响应（只做快照和入队，不在事件循环中做序列化或磁盘I/O）"""
+        started = time.perf_counter()
         try:
-            # 构造流量数据
             request = flow.request
             response = flow.response
+            stream = flow.metadata.get('capture_stream')
             
-            # 安全地获取请求体和响应体
-            request_body = ""
-            response_body = ""
-            
-            try:
-                if request.content:
-                    request_body = request.content.decode('utf-8', errors='ignore')[:10000]  # 限制长度
-            except:
-                request_body = f"[二进制数据: {len(request.content)} bytes]"
-            
-            try:
-                if response and response.content:
-                    response_body = response.content.decode('utf-8', errors='ignore')[:10000]  # 限制长度
-            except:
-                response_body = f"[二进制数据: {len(response.content)} bytes]" if response else ""
-            
-            flow_data = (
-                datetime.now().isoformat(),
-                request.method,
-                request.pretty_url,
-                request.host,
-                request.path,
-                response.status_code if response else 0,
-                json.dumps(dict(request.headers)),
-                json.dumps(dict(response.headers)) if response else "{}",
-                request_body,
-                response_body,
-                response.headers.get('content-type', '') if response else '',
-                len(response.content) if response and response.content else 0
+            record = FlowRecord(
+                timestamp=now_ms(),
+                method=request.method,
+                url=request.pretty_url,
+                host=request.host,
+                path=request.path,
+                status_code=response.status_code if response else 0,
+                request_headers=request.headers.fields,
+                response_headers=response.headers.fields if response else (),
+                request_content=request.raw_content,
+                request_encoding=request.headers.get('content-encoding'),
+                response_content=stream if stream is not None else (response.raw_content if response else None),
+                response_encoding=response.headers.get('content-encoding') if response else None,
+                content_type=response.headers.get('content-type', '') if response else '',
+                request_content_type=request.headers.get('content-type', ''),
+                device_id=self.get_device_id(flow),
+                enqueued_at=started
             )
             
-            # 保存到数据库
-            traffic_db.save_traffic(flow_data)
-            
-            # 发送到WebSocket客户端
-            websocket_data = {
-                'timestamp': datetime.now().isoformat(),
-                'method': request.method,
-                'url': request.pretty_url,
-                'host': request.host,
-                'path': request.path,
-                'status_code': response.status_code if response else 0,
-                'content_type': response.headers.get('content-type', '') if response else '',
-                'size': len(response.content) if response and response.content else 0
-            }
-            
-            # 异步发送到所有WebSocket客户端
-            if websocket_clients:
-                asyncio.create_task(broadcast_to_websockets(websocket_data))
-            
+            if CAPTURE_PIPELINE_ENABLED:
+                capture_pipeline.submit(record)
+            else:
+                # 同步调用流水线的处理函数：主进程写库，代理工作进程转发给主进程
+                capture_pipeline.handler(record)
         except Exception as e:
             print(f"❌ 处理流量数据时出错: {e}")
-
-
-async def broadcast_to_websockets(data):
-    """向所有WebSocket客户端广播数据"""
-    if websocket_clients:
-        # 创建要移除的客户端列表
-        clients_to_remove = set()
-        
-        for client in websocket_clients.copy():
-            try:
-                await client.send(json.dumps(data))
-            except Exception:
-                clients_to_remove.add(client)
+        finally:
+            capture_pipeline.record_hook_latency(time.perf_counter() - started)
+    
+    def get_device_id(self, flow):
+        """根据客户端IP和User-Agent识别设备"""
+        client_conn = flow.client_conn
+        address = getattr(client_conn, 'peername', None) or getattr(client_conn, 'address', None)
+        client_ip = address[0] if address else 'unknown'
+        user_agent = flow.request.headers.get('User-Agent', '')
         
-        # 移除断开的客户端
-        for client in clients_to_remove:
-            websocket_clients.discard(client)
+        if 'TrafficCapture' in user_agent:
+            return f"android_{client_ip}"
+        return f"device_{client_ip}"
 
 
 async def websocket_handler(*args):
     """WebSocket连接处理器（兼容不同版本的websockets库）"""
     # 兼容性处理：支持 (websocket,) 和 (websocket, path) 两种参数形式
     websocket = args[0]
-    path = args[1] if len(args) > 1 else "/"
+    path = args[1] if len(args) > 1 else None
     
     print(f"🔗 新的WebSocket连接: {websocket.remote_address}")
-    websocket_clients.add(websocket)
     
     try:
-        # 发送最近的流量记录
+        # 推送方式由客户端在连接 URL 中协商，未指定参数时保持每个事件一帧的旧格式
+        options = parse_stream_options(get_websocket_path(websocket, path))
+        if options['negotiated']:
+            await websocket.send(json.dumps(dict(options, type='hello')))
+        
+        # 最近的流量记录（通常直接来自内存缓冲区）先于实时数据放入该客户端的发送队列，保证顺序
         recent_traffic = traffic_db.get_recent_traffic(50)
+        subscriber = event_hub.subscribe(websocket, options)
         for traffic in recent_traffic:
-            try:
-                await websocket.send(json.dumps({
-                    'timestamp': traffic['timestamp'],
-                    'method': traffic['method'],
-                    'url': traffic['url'],
-                    'host': traffic['host'],
-                    'path': traffic['path'],
-                    'status_code': traffic['status_code'],
-                    'content_type': traffic['content_type'],
-                    'size': traffic['size']
-                }))
-            except Exception as e:
-                print(f"⚠️ 发送历史数据失败: {e}")
-                break
+            subscriber.offer(EncodedEvent({
+                'id': traffic['id'],
+                'timestamp': traffic['timestamp'],
+                'method': traffic['method'],
+                'url': traffic['url'],
+                'host': traffic['host'],
+                'path': traffic['path'],
+                'status_code': traffic['status_code'],
+                'content_type': traffic['content_type'],
+                'size': traffic['size'],
+                'device_id': traffic['device_id']
+            }))
         
-        # 保持连接活跃
+        # 处理客户端的控制消息（订阅过滤条件可随时修改）
         async for message in websocket:
-            # 可以处理来自客户端的消息
-            pass
+            reply = handle_client_message(subscriber, message)
+            if reply is not None:
+                await websocket.send(json.dumps(reply))
     except Exception as e:
         print(f"❌ WebSocket连接异常: {e}")
     finally:
-        websocket_clients.discard(websocket)
+        event_hub.unsubscribe(websocket)
         print(f"🔌 WebSocket连接断开: {websocket.remote_address}")
 
 
 def start_websocket_server(port=8765, use_ssl=False):
     """启动WebSocket服务器"""
-    try:
-        # SSL 配置
-        ssl_context = None
-        if use_ssl:
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            # 优先使用 Let's Encrypt 证书
-            le_cert = '/etc/letsencrypt/live/bigjj.site/fullchain.pem'
-            le_key = '/etc/letsencrypt/live/bigjj.site/privkey.pem'
-            
-            if os.path.exists(le_cert) and os.path.exists(le_key):
-                ssl_context.load_cert_chain(le_cert, le_key)
-                print(f"✅ WebSocket服务器使用 Let's Encrypt 证书")
-                global WS_USE_SSL
-                WS_USE_SSL = True
-            else:
-                print(f"⚠️ Let's Encrypt 证书不存在，WebSocket将使用HTTP")
-                ssl_context = None
-                WS_USE_SSL = False
-        
-        async def run_server():
-            # 根据SSL状态决定协议
-            protocol = "wss" if ssl_context else "ws"
-            print(f"🚀 启动WebSocket服务器: {protocol}://0.0.0.0:{port}")
-            
-            server = await websockets.serve(
-                websocket_handler, 
-                "0.0.0.0", 
-                port,
-                ssl=ssl_context
-            )
-            
-            print(f"✅ WebSocket服务器启动成功: {protocol}://bigjj.site:{port}")
-            await server.wait_closed()
-        
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(run_server())
-    except Exception as e:
-        print(f"❌ WebSocket服务器启动失败: {e}")
-        traceback.print_exc()
+    global WS_USE_SSL
+    ssl_context = websocket_ssl_context() if use_ssl else None
+    WS_USE_SSL = ssl_context is not None
+    run_websocket_server(websocket_handler, event_hub, port, ssl_context)
+
+
+# API请求延迟统计
+api_metrics = RequestMetrics()
+
+# API响应缓存
+response_cache = ResponseCache()
 
 
-class APIHandler(BaseHTTPRequestHandler):
+class APIHandler(TrafficAPIHandler):
     """HTTP API处理器"""
     
-    def log_message(self, format, *args):
-        """禁用默认日志输出"""
-        pass
+    traffic_filters = TRAFFIC_FILTERS
+    response_cache = response_cache
+    
+    @property
+    def db(self):
+        """主进程的数据库实例（由 init_services 创建）"""
+        return traffic_db
     
     def do_GET(self):
         """处理GET请求"""
+        started = time.perf_counter()
+        self.response_status = 0
+        route = 'other'
         try:
             # 解析URL路径
             parsed_path = urllib.parse.urlparse(self.path)
             path = parsed_path.path
             
             if path == '/':
+                route = '/'
                 self.serve_status_page()
             elif path == '/api/status':
+                route = '/api/status'
                 self.serve_api_status()
             elif path == '/api/traffic':
-                self.serve_traffic_data()
+                route = '/api/traffic'
+                self.serve_traffic_data(urllib.parse.parse_qs(parsed_path.query))
+            elif path == '/api/search':
+                route = '/api/search'
+                self.serve_search(urllib.parse.parse_qs(parsed_path.query))
+            elif path == '/api/stats/timeseries':
+                route = '/api/stats/timeseries'
+                self.serve_timeseries(urllib.parse.parse_qs(parsed_path.query))
+            elif path.startswith('/api/traffic/'):
+                route = '/api/traffic/<id>'
+                self.serve_traffic_detail(path[len('/api/traffic/'):])
+            elif path.startswith('/api/body/'):
+                route = '/api/body/<hash>'
+                self.serve_body(path[len('/api/body/'):])
             else:
                 self.send_error(404, "Not Found")
         except Exception as e:
             print(f"❌ API请求处理失败: {e}")
             self.send_error(500, "Internal Server Error")
+        finally:
+            api_metrics.record(route, (time.perf_counter() - started) * 1000, self.response_status)
     
     def serve_status_page(self):
         """提供状态页面"""
@@ -345,12 +1686,19 @@ class APIHandler(BaseHTTPRequestHandler):
                     <h3>🔗 WebSocket连接</h3>
                     <div class="endpoint">WebSocket地址: <strong>{ws_scheme}://bigjj.site:8765</strong></div>
                     <div class="endpoint">实时流量推送: <strong>已启用</strong></div>
+                    <div class="endpoint">批量推送: <strong>?mode=batch&amp;interval_ms=100&amp;max_events=100&amp;encoding=json|msgpack</strong></div>
                 </div>
                 
                 <div class="info">
                     <h3>🛠 API接口</h3>
                     <div class="endpoint">状态接口: <strong>{api_scheme}://bigjj.site:5010/api/status</strong></div>
                     <div class="endpoint">流量数据: <strong>{api_scheme}://bigjj.site:5010/api/traffic</strong></div>
+                    <div class="endpoint">分页/过滤: <strong>?limit=&amp;before_id=&amp;after_id=&amp;host=&amp;method=&amp;status_code=&amp;content_type=&amp;device_id=&amp;since=&amp;until=</strong></div>
+                    <div class="endpoint">流式导出: <strong>?format=ndjson</strong> 或 <strong>?stream=1</strong>（chunked，limit 上限 {TRAFFIC_STREAM_MAX}）</div>
+                    <div class="endpoint">流量详情(含body): <strong>{api_scheme}://bigjj.site:5010/api/traffic/&lt;id&gt;</strong></div>
+                    <div class="endpoint">原始body: <strong>{api_scheme}://bigjj.site:5010/api/body/&lt;hash&gt;</strong></div>
+                    <div class="endpoint">时间序列: <strong>{api_scheme}://bigjj.site:5010/api/stats/timeseries?resolution=minute|hour&amp;group_by=&amp;since=&amp;until=</strong></div>
+                    <div class="endpoint">全文检索: <strong>{api_scheme}://bigjj.site:5010/api/search?q=&amp;fields=url,host,path,body&amp;order=rank|recent&amp;cursor=</strong></div>
                 </div>
                 
                 <div class="info">
@@ -367,14 +1715,14 @@ class APIHandler(BaseHTTPRequestHandler):
         </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(html_content.encode('utf-8'))
+        self.send_payload(html_content.encode('utf-8'), 'text/html; charset=utf-8')
     
     def serve_api_status(self):
-        """提供API状态信息"""
+        """提供API状态信息（按数据版本和时间片缓存）"""
+        self.send_cached(status_cache_version(traffic_db), self.build_api_status)
+    
+    def build_api_status(self):
+        """生成API状态响应体"""
         global WS_USE_SSL, API_USE_SSL
         
         # 确定协议
@@ -396,35 +1744,122 @@ class APIHandler(BaseHTTPRequestHandler):
             'ssl_enabled': {
                 'websocket': WS_USE_SSL,
                 'api': API_USE_SSL
-            }
+            },
+            'db_writer': traffic_db.writer.stats(),
+            'recent_buffer': traffic_db.recent.stats(),
+            'header_dictionary': traffic_db.headers.stats(),
+            'retention': retention_manager.stats(),
+            'timestamp_migration': timestamp_migration.stats(),
+            'event_hub': event_hub.stats(),
+            'capture_pipeline': capture_pipeline.stats(),
+            'capture_policy': capture_policy.stats(),
+            'proxy_workers': proxy_workers.stats(),
+            'api_server': api_metrics.stats(),
+            'response_cache': response_cache.stats()
         }
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(status_data, indent=2).encode('utf-8'))
+        return json.dumps(status_data, indent=2).encode('utf-8'), {}
     
-    def serve_traffic_data(self):
-        """提供流量数据"""
+    def serve_search(self, query):
+        """全文检索流量记录（按相关度或时间排序，游标分页，按数据版本缓存）"""
+        if not traffic_db.search_enabled:
+            self.send_error(503, "Search index unavailable")
+            return
         try:
-            traffic_data = traffic_db.get_recent_traffic(100)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(traffic_data, indent=2).encode('utf-8'))
+            match, limit, after, order = parse_search_query(query)
+        except ValueError as e:
+            self.send_error(400, f"Invalid query: {e}")
+            return
+        
+        def build():
+            results, next_cursor = traffic_db.search_traffic(match, limit, after, order)
+            headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+            result = {'query': match, 'order': order, 'results': results, 'next_cursor': next_cursor}
+            return json.dumps(result, indent=2).encode('utf-8'), headers
+        
+        try:
+            self.send_cached(traffic_db.writer.data_version, build)
+        except sqlite3.OperationalError as e:
+            self.send_error(400, f"Invalid search: {e}")
+        except Exception as e:
+            print(f"❌ 全文检索失败: {e}")
+            self.send_error(500, "Failed to search traffic")
+    
+    def serve_traffic_detail(self, traffic_id):
+        """提供单条流量详情（含请求体/响应体）"""
+        if not traffic_id.isdigit():
+            self.send_error(400, "Invalid traffic id")
+            return
+        
+        try:
+            record = traffic_db.get_traffic_detail(int(traffic_id))
         except Exception as e:
-            print(f"❌ 获取流量数据失败: {e}")
-            self.send_error(500, "Failed to get traffic data")
+            print(f"❌ 获取流量详情失败: {e}")
+            self.send_error(500, "Failed to get traffic detail")
+            return
+        
+        if record is None:
+            self.send_error(404, "Traffic not found")
+            return
+        
+        self.send_payload(json.dumps(record, indent=2).encode('utf-8'))
+    
+    def serve_body(self, digest):
+        """按内容哈希提供原始 body"""
+        try:
+            data = traffic_db.get_body(digest)
+        except Exception as e:
+            print(f"❌ 获取body失败: {e}")
+            self.send_error(500, "Failed to get body")
+            return
+        
+        if data is None:
+            self.send_error(404, "Body not found")
+            return
+        
+        # 内容寻址，内容永不变化
+        self.send_payload(data, 'application/octet-stream',
+                          headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+
+
+def parse_search_query(query):
+    """解析 /api/search 的查询参数，返回 (FTS5 表达式, limit, 游标, order)"""
+    def first(name):
+        values = query.get(name)
+        return values[0] if values else None
+    
+    order = first('order') or 'rank'
+    if order not in ('rank', 'recent'):
+        raise ValueError("order must be rank or recent")
+    fields = [field for field in (first('fields') or '').split(',') if field]
+    unknown = [field for field in fields if field not in SEARCH_FIELDS]
+    if unknown:
+        raise ValueError(f"fields must be among {', '.join(SEARCH_FIELDS)}")
+    try:
+        limit = int(first('limit') or SEARCH_PAGE_DEFAULT)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    
+    after = first('cursor') or None
+    if after is not None:
+        # 游标由上一页响应的 next_cursor 原样传回：rank 排序为 "rank:id"，recent 排序为 id
+        try:
+            if order == 'rank':
+                rank, row_id = after.rsplit(':', 1)
+                after = (float(rank), int(row_id))
+            else:
+                after = int(after)
+        except ValueError:
+            raise ValueError("cursor is invalid for this order")
+    return build_search_match(first('q'), fields), limit, after, order
 
 
 def start_api_server(port=5010, use_ssl=False):
     """启动HTTP API服务器"""
     try:
         # SSL配置
-        httpd = HTTPServer(('0.0.0.0', port), APIHandler)
+        httpd = ThreadPoolHTTPServer(('0.0.0.0', port), APIHandler)
         
         if use_ssl:
             # 尝试加载SSL证书
@@ -438,7 +1873,8 @@ def start_api_server(port=5010, use_ssl=False):
             if os.path.exists(le_cert) and os.path.exists(le_key):
                 try:
                     ssl_context.load_cert_chain(le_cert, le_key)
-                    httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True)
+                    httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True,
+                                                           do_handshake_on_connect=False)
                     cert_loaded = True
                     global API_USE_SSL
                     API_USE_SSL = True
@@ -457,7 +1893,8 @@ def start_api_server(port=5010, use_ssl=False):
                     if os.path.exists(cert_path) and os.path.exists(key_path):
                         try:
                             ssl_context.load_cert_chain(cert_path, key_path)
-                            httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True)
+                            httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True,
+                                                                   do_handshake_on_connect=False)
                             cert_loaded = True
                             API_USE_SSL = True
                             print(f"✅ API服务器使用证书: {cert_path}")
@@ -484,6 +1921,17 @@ def get_addon_instance():
     return TrafficCaptureAddon()
 
 
+def build_mitmproxy_options(listen_host, listen_port, confdir, **addon_options):
+    """创建 mitmproxy 选项
+
+    block_global、web_port、flow_detail 等由插件定义的选项在构造时还不存在，
+    通过 update_defer 延迟到 DumpMaster 加载插件后生效。
+    """
+    opts = options.Options(listen_host=listen_host, listen_port=listen_port, confdir=confdir)
+    opts.update_defer(**addon_options)
+    return opts
+
+
 def ensure_mitmproxy_config(confdir: str):
     """确保 mitmproxy 配置禁用 block_global"""
     try:
@@ -513,6 +1961,15 @@ def ensure_mitmproxy_config(confdir: str):
         print(f"⚠️ 写入 mitmproxy 配置失败(可忽略): {e}")
 
 
+def ensure_mitmproxy_ca(confdir: str):
+    """预先生成 mitmproxy CA 证书（多个工作进程首次同时启动时会各自生成不同的 CA）"""
+    try:
+        from mitmproxy import certs
+        certs.CertStore.from_store(os.path.expanduser(confdir), 'mitmproxy', 2048)
+    except Exception as e:
+        print(f"⚠️ 预生成 mitmproxy CA 证书失败(可忽略): {e}")
+
+
 async def run_mitmproxy_async(addon, opts):
     """异步运行mitmproxy"""
     if not MITMPROXY_AVAILABLE:
@@ -553,6 +2010,275 @@ async def run_mitmproxy_async(addon, opts):
         traceback.print_exc()
 
 
+class RecordForwarder:
+    """代理工作进程中把 flow_data 批量发送给主进程
+
+    抓包流水线的工作线程调用 submit，发送线程攒批后通过管道发送 (流水线统计, 记录列表)。
+    队列有上限：主进程处理不过来时 submit 阻塞，背压传递到抓包流水线（由其丢弃并计数）。
+    """
+
+    _STOP = object()
+
+    def __init__(self, conn, batch_size=PROXY_FORWARD_BATCH, interval=PROXY_FORWARD_INTERVAL):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=CAPTURE_QUEUE_MAXSIZE)
+        self.thread = threading.Thread(target=self._run, name='record-forwarder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, flow_data):
+        self.queue.put(flow_data)
+
+    def close(self, timeout=10):
+        """发送完队列中剩余的记录后停止"""
+        self.queue.put(self._STOP)
+        self.thread.join(timeout)
+
+    def _run(self):
+        """发送线程主循环"""
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self.conn.send((capture_pipeline.stats(), batch))
+            except Exception as e:
+                print(f"❌ 发送 {len(batch)} 条记录到主进程失败: {e}")
+                if isinstance(e, (BrokenPipeError, EOFError, OSError)):
+                    break
+
+
+def run_proxy_worker(index, conn, listen_host, listen_port, confdir, addon_options):
+    """代理工作进程入口（spawn 出的子进程中执行）：运行 mitmproxy 和抓包插件，记录经管道发回主进程
+
+    没能监听代理端口，或监听套接字未启用 SO_REUSEPORT 时以 PROXY_WORKER_FATAL_EXIT 退出。
+    """
+    global capture_pipeline
+    
+    # 抓包流水线处理完 body 后转发给主进程而不是写库
+    forwarder = RecordForwarder(conn)
+    capture_pipeline = CapturePipeline(lambda record: forwarder.submit(capture_flow_data(record)))
+    
+    # Ctrl+C 由主进程处理（主进程再向工作进程发送 SIGTERM）
+    def stop_worker(sig, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_worker)
+    
+    # mitmproxy 通过 asyncio.start_server 监听：在事件循环上为监听套接字打开 SO_REUSEPORT，
+    # 并记下创建的服务器，启动后检查套接字上确实启用了 SO_REUSEPORT
+    loop = asyncio.new_event_loop()
+    create_server = loop.create_server
+    servers = []
+    
+    async def create_server_reuse_port(*args, **kwargs):
+        if kwargs.get('sock') is None:
+            kwargs.setdefault('reuse_port', True)
+        server = await create_server(*args, **kwargs)
+        servers.append(server)
+        return server
+    loop.create_server = create_server_reuse_port
+    
+    async def check_reuse_port():
+        deadline = loop.time() + PROXY_LISTEN_CHECK_TIMEOUT
+        while not servers and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        sockets = [sock for server in servers for sock in server.sockets]
+        if sockets and all(sock.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT) for sock in sockets):
+            return
+        # mitmproxy 没有经 loop.create_server 监听，或者没能监听：各进程并没有共享端口
+        print(f"❌ 代理工作进程 {index} 未在 {listen_host}:{listen_port} 上以 SO_REUSEPORT 监听")
+        os._exit(PROXY_WORKER_FATAL_EXIT)
+    
+    opts = build_mitmproxy_options(listen_host, listen_port, confdir, **addon_options)
+    try:
+        print(f"✅ 代理工作进程 {index} 已启动 (pid {os.getpid()})")
+        loop.create_task(check_reuse_port())
+        loop.run_until_complete(run_mitmproxy_async(get_addon_instance(), opts))
+    except (SystemExit, KeyboardInterrupt):
+        pass
+    finally:
+        capture_pipeline.close()
+        forwarder.close()
+        conn.close()
+    if not servers:
+        # mitmproxy 没能监听就退出了（例如端口被未启用 SO_REUSEPORT 的进程占用）
+        print(f"❌ 代理工作进程 {index} 未能监听 {listen_host}:{listen_port}")
+        sys.exit(PROXY_WORKER_FATAL_EXIT)
+
+
+class ProxyWorkerPool:
+    """多进程代理：N 个 mitmproxy 工作进程通过 SO_REUSEPORT 共同监听代理端口
+
+    TLS 解密、抓包插件和 body 处理在工作进程中完成，记录经管道批量发回主进程；
+    主进程独占 SQLite 和 WebSocket 事件中心，每个工作进程一个接收线程调用 store_flow_data。
+    工作进程以 spawn 方式启动（全新的解释器，不继承主进程的线程和数据库连接），
+    因此可以在任何时候启动和重启。异常退出的工作进程按指数退避重启；监听套接字未启用
+    SO_REUSEPORT，或同一工作进程频繁退出时放弃重启，wait() 返回且 fatal 记录原因，
+    由主进程退出交给 systemd 重启整个服务。
+    """
+
+    def __init__(self, workers=PROXY_WORKERS):
+        self.size = workers
+        self.workers = []
+        self.started = False
+        self.stopping = False
+        self.fatal = None
+        self.context = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._args = None
+
+    def start(self, listen_host, listen_port, confdir, **addon_options):
+        """启动工作进程（参数同 build_mitmproxy_options，每个工作进程各自创建选项），返回是否已进入多进程模式"""
+        if self.size < 1:
+            return False
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            print("⚠️ 当前系统不支持 SO_REUSEPORT，使用单进程代理")
+            return False
+        
+        self._args = (listen_host, listen_port, confdir, addon_options)
+        for index in range(self.size):
+            worker = {'index': index, 'pid': None, 'alive': False, 'received': 0, 'batches': 0,
+                      'failed': 0, 'restarts': 0, 'exit_code': None, 'capture_pipeline': None,
+                      'crashes': deque()}
+            self.workers.append(worker)
+            self._spawn(worker)
+        
+        self.started = True
+        print(f"✅ 已启动 {self.size} 个代理工作进程 (SO_REUSEPORT)")
+        return True
+
+    def wait(self):
+        """阻塞直到 stop() 完成或工作进程无法恢复（短超时轮询，保证主线程能及时处理信号）"""
+        while not self._done.wait(0.5):
+            pass
+
+    def stop(self, timeout=10):
+        """通知工作进程退出，并等待其剩余记录全部写入"""
+        with self._lock:
+            if not self.started or self.stopping:
+                return
+            self.stopping = True
+        for worker in self.workers:
+            if worker['alive']:
+                worker['process'].terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker['thread'].join(max(0, deadline - time.monotonic()))
+        self._done.set()
+
+    def stats(self):
+        """返回多进程代理统计信息"""
+        return {
+            'workers': self.size if self.started else 1,
+            'alive': sum(1 for worker in self.workers if worker['alive']) if self.started else 1,
+            'received': sum(worker['received'] for worker in self.workers),
+            'failed': sum(worker['failed'] for worker in self.workers),
+            'restarts': sum(worker['restarts'] for worker in self.workers),
+            'fatal': self.fatal,
+            'per_worker': [{key: value for key, value in worker.items()
+                            if key not in ('thread', 'process', 'crashes')}
+                           for worker in self.workers]
+        }
+
+    def _spawn(self, worker):
+        """启动（或重启）一个工作进程及其接收线程"""
+        listen_host, listen_port, confdir, addon_options = self._args
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_proxy_worker, name=f"proxy-worker-{worker['index']}", daemon=True,
+            args=(worker['index'], writer, listen_host, listen_port, confdir, addon_options))
+        with self._lock:
+            if self.stopping:
+                reader.close()
+                writer.close()
+                return
+            process.start()
+        writer.close()
+        worker.update(process=process, pid=process.pid, alive=True)
+        thread = threading.Thread(target=self._receive, args=(worker, reader),
+                                  name=f"proxy-worker-{worker['index']}")
+        thread.daemon = True
+        worker['thread'] = thread
+        thread.start()
+
+    def _receive(self, worker, reader):
+        """接收线程：读取一个工作进程发来的记录并写库，管道关闭即工作进程已退出"""
+        while True:
+            try:
+                pipeline_stats, batch = reader.recv()
+            except (EOFError, OSError):
+                break
+            except Exception as e:
+                print(f"❌ 读取代理工作进程 {worker['index']} 的数据失败: {e}")
+                continue
+            worker['capture_pipeline'] = pipeline_stats
+            worker['batches'] += 1
+            for flow_data in batch:
+                try:
+                    store_flow_data(flow_data)
+                    worker['received'] += 1
+                except Exception as e:
+                    worker['failed'] += 1
+                    print(f"❌ 保存工作进程记录失败: {e}")
+        
+        reader.close()
+        worker['process'].join()
+        worker['alive'] = False
+        worker['exit_code'] = code = worker['process'].exitcode
+        if self.stopping:
+            return
+        self._restart(worker, code)
+
+    def _restart(self, worker, code):
+        """工作进程异常退出：按指数退避重启，无法恢复时记录原因并让 wait() 返回"""
+        index = worker['index']
+        if code == PROXY_WORKER_FATAL_EXIT:
+            self._fail(f"代理工作进程 {index} 未能以 SO_REUSEPORT 监听代理端口")
+            return
+        now = time.monotonic()
+        crashes = worker['crashes']
+        crashes.append(now)
+        while crashes and now - crashes[0] > PROXY_RESTART_WINDOW:
+            crashes.popleft()
+        if len(crashes) > PROXY_RESTART_LIMIT:
+            self._fail(f"代理工作进程 {index} 在 {PROXY_RESTART_WINDOW}s 内异常退出 {len(crashes)} 次")
+            return
+        delay = min(PROXY_RESTART_MAX_DELAY, PROXY_RESTART_DELAY * 2 ** (len(crashes) - 1))
+        print(f"⚠️ 代理工作进程 {index} (pid {worker['pid']}) 已退出，退出码 {code}，{delay:g}s 后重启")
+        if self._done.wait(delay):
+            return
+        worker['restarts'] += 1
+        self._spawn(worker)
+
+    def _fail(self, reason):
+        self.fatal = reason
+        print(f"❌ {reason}，停止多进程代理")
+        self._done.set()
+
+
+# 全局多进程代理（PROXY_WORKERS 大于 1 时在 main 中启动）
+proxy_workers = ProxyWorkerPool()
+
+
 def main():
     # 启动横幅
     print("🚀 bigjj.site 移动抓包远程代理服务器")
@@ -564,10 +2290,33 @@ def main():
         print("请运行: pip install mitmproxy")
         sys.exit(1)
     
+    # 创建数据库、保留策略和抓包流水线
+    init_services()
+    
     # 创建addon实例
     addon = get_addon_instance()
     print("✅ TrafficCaptureAddon 实例已创建")
     
+    # 配置mitmproxy选项
+    ensure_mitmproxy_config('~/.mitmproxy')
+    
+    # 创建 mitmproxy 选项（多进程模式下每个工作进程用同样的参数各自创建）
+    proxy_options = dict(
+        listen_host='0.0.0.0',
+        listen_port=8888,  # 统一使用8888端口
+        confdir='~/.mitmproxy',
+        web_host='0.0.0.0', 
+        web_port=8081,
+        web_open_browser=False,
+        block_global=False  # 确保不阻止外部访问
+    )
+    opts = build_mitmproxy_options(**proxy_options)
+    
+    # 多进程模式：启动代理工作进程（共用预先生成的 CA 证书）
+    if PROXY_WORKERS > 1:
+        ensure_mitmproxy_ca('~/.mitmproxy')
+        proxy_workers.start(**proxy_options)
+    
     # 启动HTTP API服务器 (线程) - 优先尝试启用HTTPS（若证书存在）
     api_use_ssl = any([
         os.path.exists('/etc/letsencrypt/live/bigjj.site/fullchain.pem') and os.path.exists('/etc/letsencrypt/live/bigjj.site/privkey.pem'),
@@ -587,6 +2336,10 @@ def main():
     ws_thread.daemon = True
     ws_thread.start()
     
+    # 启动数据保留策略和旧数据库的时间戳迁移
+    retention_manager.start()
+    timestamp_migration.start()
+    
     print("🌍 域名: bigjj.site")
     print("📡 代理服务器: bigjj.site:8888")  # 统一使用8888端口
     print(f"📱 WebSocket: {'wss' if ws_use_ssl else 'ws'}://bigjj.site:8765")
@@ -600,39 +2353,41 @@ def main():
     print("=" * 60)
     
     try:
-        # 配置mitmproxy选项
-        ensure_mitmproxy_config('~/.mitmproxy')
-        
-        # 创建 mitmproxy 选项
-        opts = options.Options(
-            listen_host='0.0.0.0',
-            listen_port=8888,  # 统一使用8888端口
-            web_host='0.0.0.0', 
-            web_port=8081,
-            web_open_browser=False,
-            block_global=False,  # 确保不阻止外部访问
-            confdir='~/.mitmproxy'
-        )
-        
         print("🔧 mitmproxy 配置:")
         print(f"   代理端口: {opts.listen_port}")
-        print(f"   Web界面端口: {opts.web_port}")
-        print(f"   外网访问: {'允许' if not opts.block_global else '阻止'}")
+        print(f"   Web界面端口: {opts.deferred.get('web_port')}")
+        print(f"   外网访问: {'阻止' if opts.deferred.get('block_global') else '允许'}")
+        print(f"   工作进程: {proxy_workers.stats()['workers']}")
         print("=" * 60)
         
         # 启动mitmproxy
         print("🚀 启动 mitmproxy...")
         
+        def shutdown(code):
+            proxy_workers.stop()
+            capture_pipeline.close()
+            retention_manager.stop()
+            timestamp_migration.stop()
+            traffic_db.close()
+            sys.exit(code)
+        
         # 设置信号处理
         def signal_handler(sig, frame):
             print("\n🛑 收到停止信号，正在关闭服务器...")
-            sys.exit(0)
+            shutdown(0)
         
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
         
-        # 运行 mitmproxy
-        asyncio.run(run_mitmproxy_async(addon, opts))
+        # 运行 mitmproxy（多进程模式下由工作进程运行，主进程负责重启异常退出的工作进程）
+        if proxy_workers.started:
+            proxy_workers.wait()
+            if proxy_workers.fatal:
+                # 以非零退出码退出，由 systemd 重启整个服务
+                print(f"❌ 多进程代理无法继续运行: {proxy_workers.fatal}")
+                shutdown(1)
+        else:
+            asyncio.run(run_mitmproxy_async(addon, opts))
         
     except KeyboardInterrupt:
         print("\n🛑 服务器正在关闭...")
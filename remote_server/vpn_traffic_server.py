@@ -1,12 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import asyncio
 import json
-import sqlite3
 import ssl
 import os
-import websockets
 import socket
 import traceback
 import sys
@@ -14,10 +11,22 @@ import threading
 import signal
 import time
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.parse
 import subprocess
 import ipaddress
+import atexit
+import struct
+import mmap
+import functools
+from collections import OrderedDict, namedtuple
+
+# 两个服务器共用的组件（common.py 与本脚本部署在同一目录）
+from common import (
+    SCHEMA_VERSION, ConnectionManager, BatchWriter, ms_to_iso, TrafficStore, RollupAccumulator,
+    EncodedEvent, parse_stream_options, get_websocket_path, EventHub, TimestampMigration,
+    handle_client_message, websocket_ssl_context, run_websocket_server, RequestMetrics, ResponseCache,
+    status_cache_version, ThreadPoolHTTPServer, TrafficAPIHandler, RetentionManager,
+)
 
 # WebSocket/API 是否启用 SSL（用于页面与状态展示）
 WS_USE_SSL = False
@@ -29,18 +38,100 @@ VPN_NETWORK = "10.66.66.0/24"
 SERVER_VPN_IP = "10.66.66.1"
 CLIENT_VPN_IP = "10.66.66.2"
 
+# WireGuard 节点状态轮询（后台线程定期读取 wg show dump，API 只读取缓存的快照）
+WG_POLL_INTERVAL = 5             # 轮询间隔（秒）
+WG_POLL_TIMEOUT = 5              # 单次 wg 命令的超时（秒）
+WG_PEER_ACTIVE_WINDOW = 180      # 最近一次握手在该秒数内视为在线（WireGuard 约每2分钟重新握手）
+
+# 数据包捕获配置（AF_PACKET 直接读取 wg0 上的 IP 包）
+CAPTURE_INTERFACE = WIREGUARD_INTERFACE
+CAPTURE_SNAPLEN = 2048                   # 每个包读取的最大字节数（头部 + DNS 应答 / TLS ClientHello）
+CAPTURE_SOCKET_BUFFER = 8 * 1024 * 1024  # 内核接收缓冲区大小，突发流量时避免丢包
+CAPTURE_POLL_TIMEOUT = 1.0               # recv 超时（秒），用于检查停止标志
+CAPTURE_PCAP_REPLAY = None               # 设置为 pcap 文件路径时回放该文件（离线测试），不实时抓包
+
+# IP -> 域名缓存（被动解析隧道内的 DNS 应答和 TLS ClientHello 中的 SNI）
+DOMAIN_CACHE_SIZE = 65536        # 缓存的 IP 数量上限，超出时淘汰最久未使用的
+DOMAIN_MIN_TTL = 60              # DNS TTL 的下限（应用往往在解析后稍晚才建立连接）
+DOMAIN_MAX_TTL = 86400           # DNS TTL 的上限
+DOMAIN_SNI_TTL = 3600            # 从 SNI 得到的映射的有效期（秒）
+
+# 连接跟踪流表（按五元组聚合数据包，每条连接只写一行）
+FLOW_TABLE_MAX = 65536           # 同时跟踪的连接数上限，超出时淘汰最久未活动的连接
+FLOW_TCP_IDLE_TIMEOUT = 300      # TCP 连接空闲超时（秒）
+FLOW_UDP_IDLE_TIMEOUT = 60       # UDP 等其他协议的空闲超时（秒）
+FLOW_INTERIM_INTERVAL = 60       # 长连接每隔多少秒更新一次数据库中的记录
+FLOW_SWEEP_INTERVAL = 1          # 检查空闲连接的间隔（秒）
+
+# 订阅过滤条件对应的事件字段（VPN记录用 domain 作为主机名，client_ip 作为设备标识，
+# protocol 充当内容类型，没有状态码）
+FILTER_FIELDS = {
+    'host': 'domain',
+    'device_id': 'client_ip',
+    'method': 'method',
+    'status_code': 'status_code',
+    'content_type': 'protocol',
+}
+
+# /api/traffic 过滤使用的索引
+TRAFFIC_INDEXES = [
+    ('idx_vpn_traffic_domain', 'domain'),
+    ('idx_vpn_traffic_client', 'client_ip'),
+    ('idx_vpn_traffic_method', 'method'),
+    ('idx_vpn_traffic_protocol', 'protocol'),
+    ('idx_vpn_traffic_ts', 'ts_ms'),
+]
+# epoch 毫秒列 -> API 输出的 ISO 字段（同名的字符串列只在旧版本数据库的未迁移记录中有值）
+TIMESTAMP_COLUMNS = {'ts_ms': 'timestamp', 'last_seen_ms': 'last_seen'}
+# API 过滤参数名 -> (vpn_traffic_logs 列名, 参数转换函数)（VPN记录没有状态码和内容类型）
+TRAFFIC_FILTERS = {
+    'host': ('domain', str),
+    'device_id': ('client_ip', str),
+    'method': ('method', str.upper),
+    'protocol': ('protocol', str.upper),
+}
+
+# 时间序列汇总表（按分钟/小时聚合；写入线程在每个批次的事务中增量更新）
+# 表名 -> 时间桶宽度（毫秒；时间桶为向下取整后的 epoch 毫秒）
+ROLLUP_TABLES = {
+    'minute': ('vpn_rollup_minute', 60 * 1000),
+    'hour': ('vpn_rollup_hour', 60 * 60 * 1000),
+}
+# VPN 连接没有状态码和内容类型，用协议和连接类型（HTTPS/DNS...）代替
+ROLLUP_DIMENSIONS = ('host', 'client_ip', 'protocol', 'connection_type')
+ROLLUP_MEASURES = ('flows', 'bytes_sent', 'bytes_received', 'packets')
 
-class TrafficDatabase:
+
+class TrafficDatabase(TrafficStore):
+    table = 'vpn_traffic_logs'
+    traffic_filters = TRAFFIC_FILTERS
+    timestamp_columns = TIMESTAMP_COLUMNS
+    rollup_tables = ROLLUP_TABLES
+    rollup_dimensions = ROLLUP_DIMENSIONS
+    rollup_measures = ROLLUP_MEASURES
+    # 长连接的记录按最后活动时间过期，不会因为连接建立得早而在活动期间被删除
+    retention_age_columns = ('last_seen_ms', 'ts_ms')
+    
     def __init__(self, db_path='vpn_traffic.db'):
         self.db_path = db_path
+        self.connections = ConnectionManager(db_path)
+        self.rollups = RollupAccumulator(ROLLUP_TABLES, ROLLUP_DIMENSIONS, ROLLUP_MEASURES)
         self.init_database()
+        self.writer = BatchWriter(self.connections.writer, on_flush=self.rollups.flush)
+        # 连接记录的 id 在进程内分配，长连接每次更新都换用新 id（见 save_flow）
+        self._id_lock = threading.Lock()
+        self._next_id = self._load_next_id()
+        atexit.register(self.close)
 
     def init_database(self):
         """初始化数据库表"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.connections.writer
             cursor = conn.cursor()
+            fresh = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'vpn_traffic_logs'").fetchone() is None
             
+            # timestamp / last_seen 是旧版本的 ISO 字符串列，新记录只写对应的毫秒列
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS vpn_traffic_logs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -73,91 +164,656 @@ class TrafficDatabase:
                 )
             ''')
             
+            # 连接跟踪新增的列，旧数据库按需补齐
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(vpn_traffic_logs)")}
+            for column, column_type in (('packets_sent', 'INTEGER'), ('packets_received', 'INTEGER'),
+                                        ('last_seen', 'TEXT'), ('flow_state', 'TEXT'),
+                                        ('ts_ms', 'INTEGER'), ('last_seen_ms', 'INTEGER')):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE vpn_traffic_logs ADD COLUMN {column} {column_type}")
+            client_columns = {row[1] for row in cursor.execute("PRAGMA table_info(vpn_clients)")}
+            if 'last_seen_ms' not in client_columns:
+                cursor.execute("ALTER TABLE vpn_clients ADD COLUMN last_seen_ms INTEGER")
+            if fresh:
+                cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            
+            # 过滤条件 + id 的复合索引，保证按游标分页时深页与首页代价相同
+            for name, column in TRAFFIC_INDEXES:
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON vpn_traffic_logs({column}, id)")
+            
+            # 汇总表：新建时用已有明细回填一次
+            for table, width in self.rollups.create_tables(cursor):
+                cursor.execute(f'''
+                    INSERT INTO {table} (bucket, host, client_ip, protocol, connection_type,
+                                         flows, bytes_sent, bytes_received, packets)
+                    SELECT COALESCE(ts_ms, CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000) / {width} * {width},
+                           COALESCE(domain, dst_ip, ''),
+                           COALESCE(client_ip, ''), COALESCE(protocol, ''), COALESCE(connection_type, ''),
+                           COUNT(*), COALESCE(SUM(bytes_sent), 0), COALESCE(SUM(bytes_received), 0),
+                           COALESCE(SUM(COALESCE(packets_sent, 0) + COALESCE(packets_received, 0)), 0)
+                    FROM vpn_traffic_logs WHERE ts_ms IS NOT NULL OR strftime('%s', timestamp) IS NOT NULL
+                    GROUP BY 1, 2, 3, 4, 5
+                ''')
+            
             conn.commit()
-            conn.close()
             print("✅ VPN流量数据库初始化完成")
         except Exception as e:
             print(f"❌ 数据库初始化失败: {e}")
 
-    def save_traffic(self, traffic_data):
-        """保存VPN流量数据到数据库"""
+    def allocate_id(self):
+        """分配一个新的记录 id"""
+        with self._id_lock:
+            row_id = self._next_id
+            self._next_id += 1
+            return row_id
+
+    def save_flow(self, row_id, flow_data, rollup_delta=None, replaces=None):
+        """写入一条连接记录
+
+        长连接的中间结果和最终结果每次都以新分配的 row_id 写入，并删除上一次写入的
+        replaces 行：按 after_id 轮询的客户端能看到每次更新，已被保留策略删除的记录
+        也不会以旧 id 重新出现。
+        flow_data 的两个时间（ts_ms、last_seen_ms）为 epoch 毫秒。
+        rollup_delta 是自上次写入以来的 (新连接数, 发送字节, 接收字节, 包数) 增量，
+        计入 last_seen 所在的时间桶。
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            if rollup_delta is not None:
+                self.rollups.add(flow_data[16], (flow_data[7] or flow_data[4], flow_data[1],
+                                                 flow_data[2], flow_data[13]), rollup_delta)
+            self.writer.submit('''
                 INSERT INTO vpn_traffic_logs 
-                (timestamp, client_ip, protocol, src_ip, dst_ip, src_port, dst_port, 
-                 domain, url, method, user_agent, bytes_sent, bytes_received, connection_type)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', traffic_data)
-            
-            conn.commit()
-            conn.close()
+                (id, ts_ms, client_ip, protocol, src_ip, dst_ip, src_port, dst_port, 
+                 domain, url, method, user_agent, bytes_sent, bytes_received, connection_type,
+                 packets_sent, packets_received, last_seen_ms, flow_state)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (row_id,) + tuple(flow_data))
+            if replaces is not None:
+                self.writer.submit("DELETE FROM vpn_traffic_logs WHERE id = ?", (replaces,))
         except Exception as e:
-            print(f"❌ 保存VPN流量数据失败: {e}")
+            print(f"❌ 保存VPN连接记录失败: {e}")
 
     def get_recent_traffic(self, limit=100):
         """获取最近的VPN流量记录"""
+        return self.get_traffic_page(limit)
+
+    def get_traffic_page(self, limit=100, before_id=None, after_id=None, filters=None):
+        """按 id 游标分页查询VPN流量记录（结果按 id 从新到旧排列）
+
+        before_id: 返回 id 小于该值的较旧记录
+        after_id:  返回 id 大于该值的较新记录
+        filters:   host(domain) / device_id(client_ip) / method / protocol / since / until（epoch 毫秒）
+        """
+        return self._query_traffic_page(limit, before_id, after_id, filters)
+
+    def update_client_stats(self, peers):
+        """按公钥批量更新客户端统计信息（同一批次内合并为一次 executemany）"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT * FROM vpn_traffic_logs 
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            ''', (limit,))
-            
-            rows = cursor.fetchall()
-            conn.close()
-            
-            # 转换为字典格式
-            columns = [description[0] for description in cursor.description]
-            result = []
-            for row in rows:
-                result.append(dict(zip(columns, row)))
-            
-            return result
+            for peer in peers:
+                self.writer.submit('''
+                    INSERT INTO vpn_clients (client_name, public_key, vpn_ip, last_seen_ms, total_bytes, status)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(public_key) DO UPDATE SET
+                        vpn_ip = excluded.vpn_ip,
+                        last_seen_ms = COALESCE(excluded.last_seen_ms, vpn_clients.last_seen_ms),
+                        total_bytes = excluded.total_bytes,
+                        status = excluded.status
+                ''', (peer_display_name(peer), peer.public_key, peer.vpn_ip,
+                      peer.latest_handshake * 1000 if peer.latest_handshake else None,
+                      peer.rx_bytes + peer.tx_bytes, 'active' if peer.connected else 'inactive'))
         except Exception as e:
-            print(f"❌ 获取VPN流量数据失败: {e}")
+            print(f"❌ 更新客户端统计失败: {e}")
+
+
+# 数据包解析
+ETH_P_ALL = 0x0003
+IP_PROTOCOL_NAMES = {1: 'ICMP', 6: 'TCP', 17: 'UDP', 58: 'ICMPv6'}
+IPV6_EXTENSION_HEADERS = {0, 43, 44, 60}
+# 根据端口推断连接类型（写入 connection_type 列）
+SERVICE_PORTS = {53: 'DNS', 80: 'HTTP', 443: 'HTTPS', 853: 'DoT', 8080: 'HTTP'}
+# 已知域名时用于生成 url 列的协议
+URL_SCHEMES = {80: 'http', 443: 'https', 8080: 'http', 8443: 'https'}
+DNS_RECORD_TYPES = {1: socket.AF_INET, 28: socket.AF_INET6}
+# pcap 链路层类型 -> IP 头之前的固定字节数（以太网和 SLL 需要额外检查协议类型）
+PCAP_LINK_HEADERS = {0: 4, 1: 14, 12: 0, 14: 0, 101: 0, 113: 16, 228: 0, 229: 0, 276: 20}
+IP_ETHERTYPES = {0x0800, 0x86DD}
+
+_U16 = struct.Struct('!H')
+_PORTS = struct.Struct('!HH')
+
+PacketInfo = namedtuple('PacketInfo', [
+    'timestamp', 'version', 'protocol', 'src_ip', 'dst_ip', 'src_port', 'dst_port',
+    'length', 'tcp_flags', 'payload'
+])
+
+
+@functools.lru_cache(maxsize=65536)
+def format_address(raw):
+    """把 4/16 字节的原始地址转换为字符串（同一会话的地址反复出现，结果缓存）"""
+    family = socket.AF_INET if len(raw) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, raw)
+
+
+@functools.lru_cache(maxsize=4096)
+def is_vpn_client(address):
+    """判断地址是否属于 VPN 客户端网段"""
+    try:
+        return ipaddress.ip_address(address) in ipaddress.ip_network(VPN_NETWORK)
+    except ValueError:
+        return False
+
+
+def parse_ip_packet(data, timestamp, wire_length=0):
+    """解析 IPv4/IPv6 以及 TCP/UDP 头部
+
+    data 是从 IP 头开始的 memoryview，所有字段用 struct.unpack_from 原地读取，
+    payload 也是 data 的切片（不复制），只在调用方处理这个包期间有效。
+    length 取 IP 头中的总长度，抓包被截断时仍是真实大小。无法解析时返回 None。
+    """
+    size = len(data)
+    if size < 20:
+        return None
+    version = data[0] >> 4
+    fragment = False
+    if version == 4:
+        offset = (data[0] & 0x0F) * 4
+        total_length = _U16.unpack_from(data, 2)[0]
+        fragment = bool(_U16.unpack_from(data, 6)[0] & 0x1FFF)
+        protocol = data[9]
+        src_ip = format_address(bytes(data[12:16]))
+        dst_ip = format_address(bytes(data[16:20]))
+    elif version == 6:
+        if size < 40:
+            return None
+        offset = 40
+        total_length = 40 + _U16.unpack_from(data, 4)[0]
+        protocol = data[6]
+        src_ip = format_address(bytes(data[8:24]))
+        dst_ip = format_address(bytes(data[24:40]))
+        # 跳过扩展头，找到真正的上层协议
+        while protocol in IPV6_EXTENSION_HEADERS and offset + 8 <= size:
+            if protocol == 44:
+                fragment = fragment or bool(_U16.unpack_from(data, offset + 2)[0] & 0xFFF8)
+                protocol, offset = data[offset], offset + 8
+            else:
+                protocol, offset = data[offset], offset + (data[offset + 1] + 1) * 8
+    else:
+        return None
+    
+    # TSO/GSO 发出的大包 IPv4 总长度可能为 0，退回使用抓到的长度
+    total_length = total_length or wire_length or size
+    src_port = dst_port = tcp_flags = 0
+    payload_start = offset
+    # 非首个分片没有传输层头部
+    if not fragment:
+        if protocol == 6 and offset + 20 <= size:
+            src_port, dst_port = _PORTS.unpack_from(data, offset)
+            tcp_flags = data[offset + 13]
+            payload_start = offset + (data[offset + 12] >> 4) * 4
+        elif protocol == 17 and offset + 8 <= size:
+            src_port, dst_port = _PORTS.unpack_from(data, offset)
+            payload_start = offset + 8
+    
+    end = min(size, total_length)
+    payload = data[payload_start:end] if payload_start < end else data[0:0]
+    return PacketInfo(timestamp, version, IP_PROTOCOL_NAMES.get(protocol, str(protocol)),
+                      src_ip, dst_ip, src_port, dst_port, total_length, tcp_flags, payload)
+
+
+def read_pcap(path):
+    """回放 pcap 文件，逐包生成 (timestamp, 从IP头开始的memoryview, 原始长度)
+
+    文件整体 mmap，数据包以切片形式返回，不逐包复制。
+    支持以太网、Linux cooked (SLL/SLL2)、loopback 和 raw IP 链路类型；pcapng 需先用
+    editcap -F pcap 转换。
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data = memoryview(mapped)
+    
+    magic = bytes(data[:4])
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise ValueError(f"{path} 不是 pcap 文件")
+    divisor = 1e9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e6
+    linktype = struct.unpack_from(endian + 'I', data, 20)[0] & 0x0FFFFFFF
+    if linktype not in PCAP_LINK_HEADERS:
+        raise ValueError(f"不支持的 pcap 链路类型: {linktype}")
+    
+    record = struct.Struct(endian + 'IIII')
+    offset = 24
+    while offset + 16 <= len(data):
+        seconds, fraction, captured, original = record.unpack_from(data, offset)
+        offset += 16
+        frame = data[offset:offset + captured]
+        offset += captured
+        
+        header = PCAP_LINK_HEADERS[linktype]
+        if linktype == 1:
+            ethertype_at = 12
+            # 跳过 802.1Q / 802.1ad VLAN 标签
+            while len(frame) >= ethertype_at + 2 and _U16.unpack_from(frame, ethertype_at)[0] in (0x8100, 0x88A8):
+                ethertype_at += 4
+            header = ethertype_at + 2
+            if len(frame) < header or _U16.unpack_from(frame, ethertype_at)[0] not in IP_ETHERTYPES:
+                continue
+        elif linktype in (113, 276):
+            ethertype_at = 14 if linktype == 113 else 0
+            if len(frame) < header or _U16.unpack_from(frame, ethertype_at)[0] not in IP_ETHERTYPES:
+                continue
+        yield seconds + fraction / divisor, frame[header:], original - header
+
+
+def _read_dns_name(data, offset):
+    """读取 DNS 报文中的域名（支持压缩指针），返回 (域名, 名字之后的偏移)"""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 16:
+                raise ValueError("DNS 压缩指针循环")
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(bytes(data[offset:offset + length]).decode('ascii', 'replace'))
+        offset += length
+    return '.'.join(labels).lower(), end if end is not None else offset
+
+
+def parse_dns_response(payload):
+    """解析 DNS 应答，返回 [(IP, 查询的域名, TTL)]
+
+    CNAME 链上的 A/AAAA 记录都归到问题中的域名（即应用实际请求的域名）。
+    报文不完整或不是成功的应答时返回空列表。
+    """
+    try:
+        if len(payload) < 12:
             return []
+        flags, questions, answers = struct.unpack_from('!HHH', payload, 2)
+        # 必须是应答（QR=1）且 RCODE=0
+        if not flags & 0x8000 or flags & 0x000F or questions != 1:
+            return []
+        name, offset = _read_dns_name(payload, 12)
+        offset += 4
+        results = []
+        for _ in range(answers):
+            _, offset = _read_dns_name(payload, offset)
+            record_type, _, ttl, length = struct.unpack_from('!HHIH', payload, offset)
+            offset += 10
+            family = DNS_RECORD_TYPES.get(record_type)
+            if family is not None and length in (4, 16) and offset + length <= len(payload):
+                results.append((format_address(bytes(payload[offset:offset + length])), name, ttl))
+            offset += length
+        return results
+    except (IndexError, ValueError, struct.error):
+        return []
+
+
+def parse_tls_sni(payload):
+    """从 TLS ClientHello 中取出 SNI 主机名，不是 ClientHello 或被截断时返回 None
+
+    只检查第一个 TCP 段：扩展很大（如后量子密钥交换）且 SNI 落在后续分段时取不到。
+    """
+    try:
+        # 记录类型 22 (handshake) + 握手类型 1 (ClientHello)
+        if len(payload) < 43 or payload[0] != 0x16 or payload[5] != 0x01:
+            return None
+        offset = 5 + 4 + 2 + 32                      # 记录头、握手头、版本、随机数
+        offset += 1 + payload[offset]                # session id
+        offset += 2 + _U16.unpack_from(payload, offset)[0]  # cipher suites
+        offset += 1 + payload[offset]                # compression methods
+        extensions_end = offset + 2 + _U16.unpack_from(payload, offset)[0]
+        offset += 2
+        while offset + 4 <= min(extensions_end, len(payload)):
+            extension_type, length = _PORTS.unpack_from(payload, offset)
+            offset += 4
+            if extension_type == 0:
+                # server_name 列表：列表长度(2) + 类型(1, 0=主机名) + 名字长度(2) + 名字
+                if payload[offset + 2] != 0:
+                    return None
+                name_length = _U16.unpack_from(payload, offset + 3)[0]
+                name = bytes(payload[offset + 5:offset + 5 + name_length])
+                if len(name) != name_length:
+                    return None
+                return name.decode('ascii', 'replace').lower()
+            offset += length
+    except (IndexError, struct.error):
+        pass
+    return None
+
+
+class DomainCache:
+    """IP -> 域名缓存（遵守 TTL，按条数上限做 LRU 淘汰，查找为 O(1)）
+
+    过期时间使用数据包的时间戳，回放 pcap 时同样有效。
+    """
+
+    def __init__(self, max_entries=DOMAIN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # IP -> (域名, 过期时间)
+        
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.dns_answers = 0
+        self.sni_names = 0
+
+    def put(self, address, domain, ttl, now):
+        """记录一个映射，TTL 限制在 [DOMAIN_MIN_TTL, DOMAIN_MAX_TTL] 之间"""
+        ttl = min(max(ttl, DOMAIN_MIN_TTL), DOMAIN_MAX_TTL)
+        self._entries[address] = (domain, now + ttl)
+        self._entries.move_to_end(address)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, address, now):
+        """返回 IP 对应的域名，未知或已过期时返回 None"""
+        entry = self._entries.get(address)
+        if entry is None:
+            self.misses += 1
+            return None
+        domain, expires_at = entry
+        if now > expires_at:
+            del self._entries[address]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(address)
+        self.hits += 1
+        return domain
+
+    def observe(self, packet):
+        """从数据包中学习映射，返回 ClientHello 中的 SNI（没有则返回 None）"""
+        payload = packet.payload
+        if not payload:
+            return None
+        if packet.protocol == 'UDP' and packet.src_port == 53:
+            for address, domain, ttl in parse_dns_response(payload):
+                self.put(address, domain, ttl, packet.timestamp)
+                self.dns_answers += 1
+        elif packet.protocol == 'TCP' and payload[0] == 0x16:
+            sni = parse_tls_sni(payload)
+            if sni:
+                self.put(packet.dst_ip, sni, DOMAIN_SNI_TTL, packet.timestamp)
+                self.sni_names += 1
+                return sni
+        return None
+
+    def stats(self):
+        """返回缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0,
+            'dns_answers': self.dns_answers,
+            'sni_names': self.sni_names
+        }
+
+
+class PacketCapture:
+    """AF_PACKET 实时抓包
+
+    wg0 是三层接口，SOCK_DGRAM 收到的数据直接从 IP 头开始。每个包只读取 snaplen
+    字节到同一个复用的缓冲区，配合 MSG_TRUNC 得到真实长度。需要 root 或 CAP_NET_RAW。
+    """
 
-    def update_client_stats(self, client_ip, bytes_transferred):
-        """更新客户端统计信息"""
+    def __init__(self, interface=CAPTURE_INTERFACE, snaplen=CAPTURE_SNAPLEN):
+        self.interface = interface
+        self.snaplen = snaplen
+        self.sock = None
+
+    def open(self):
+        """创建并绑定抓包套接字"""
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_ALL))
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                UPDATE vpn_clients 
-                SET last_seen = ?, total_bytes = total_bytes + ?
-                WHERE vpn_ip = ?
-            ''', (datetime.now().isoformat(), bytes_transferred, client_ip))
-            
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            print(f"❌ 更新客户端统计失败: {e}")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CAPTURE_SOCKET_BUFFER)
+            sock.bind((self.interface, 0))
+            sock.settimeout(CAPTURE_POLL_TIMEOUT)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def packets(self, running, on_idle=None):
+        """逐包生成 (timestamp, memoryview, 原始长度)，running() 返回 False 时结束
+
+        返回的 memoryview 指向复用的接收缓冲区，下一次迭代后内容即被覆盖。
+        超过 CAPTURE_POLL_TIMEOUT 没有数据包时调用 on_idle(当前时间)。
+        """
+        buffer = bytearray(self.snaplen)
+        view = memoryview(buffer)
+        while running():
+            try:
+                nbytes, _ = self.sock.recvfrom_into(buffer, 0, socket.MSG_TRUNC)
+            except socket.timeout:
+                if on_idle is not None:
+                    on_idle(time.time())
+                continue
+            yield time.time(), view[:min(nbytes, self.snaplen)], nbytes
+
+    def close(self):
+        """关闭抓包套接字"""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+# TCP 标志位
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+
+class FlowState:
+    """一条连接（五元组）的累计状态，方向以 VPN 客户端为准"""
+
+    __slots__ = ('key', 'protocol', 'client_ip', 'client_port', 'remote_ip', 'remote_port',
+                 'first_seen', 'last_seen', 'reported_at', 'bytes_sent', 'bytes_received',
+                 'packets_sent', 'packets_received', 'tcp_state', 'fin_sent', 'fin_received',
+                 'row_id', 'idle_timeout', 'domain', 'reported_totals')
+
+    def __init__(self, key, packet, outbound):
+        self.key = key
+        self.protocol = packet.protocol
+        if outbound:
+            self.client_ip, self.client_port = packet.src_ip, packet.src_port
+            self.remote_ip, self.remote_port = packet.dst_ip, packet.dst_port
+        else:
+            self.client_ip, self.client_port = packet.dst_ip, packet.dst_port
+            self.remote_ip, self.remote_port = packet.src_ip, packet.src_port
+        self.first_seen = self.last_seen = self.reported_at = packet.timestamp
+        self.bytes_sent = self.bytes_received = 0
+        self.packets_sent = self.packets_received = 0
+        self.tcp_state = 'SYN_SENT' if packet.protocol == 'TCP' else 'ACTIVE'
+        self.fin_sent = self.fin_received = False
+        self.row_id = None
+        self.idle_timeout = FLOW_TCP_IDLE_TIMEOUT if packet.protocol == 'TCP' else FLOW_UDP_IDLE_TIMEOUT
+        self.domain = None
+        # 已计入时间序列汇总的 (发送字节, 接收字节, 包数)
+        self.reported_totals = (0, 0, 0)
+
+    def update(self, packet, outbound):
+        """累加一个数据包；TCP 连接收到 RST 或双方都发出 FIN 后返回 True（连接结束）"""
+        self.last_seen = packet.timestamp
+        if outbound:
+            self.bytes_sent += packet.length
+            self.packets_sent += 1
+        else:
+            self.bytes_received += packet.length
+            self.packets_received += 1
+        
+        if self.protocol != 'TCP':
+            return False
+        flags = packet.tcp_flags
+        if flags & TCP_RST:
+            self.tcp_state = 'RESET'
+            return True
+        if flags & TCP_FIN:
+            if outbound:
+                self.fin_sent = True
+            else:
+                self.fin_received = True
+            self.tcp_state = 'CLOSED' if self.fin_sent and self.fin_received else 'FIN_WAIT'
+            return self.fin_sent and self.fin_received
+        if flags & TCP_SYN and flags & TCP_ACK:
+            self.tcp_state = 'ESTABLISHED'
+        elif self.tcp_state == 'SYN_SENT' and not flags & TCP_SYN:
+            # 抓包开始前已建立的连接没有握手，见到普通数据包即视为已建立
+            self.tcp_state = 'ESTABLISHED'
+        return False
+
+
+class FlowTable:
+    """按五元组聚合数据包的连接跟踪表
+
+    OrderedDict 按最近活动时间排序：每个包把所属连接移到末尾，因此空闲检查从头部
+    开始扫描即可，超出 max_flows 时淘汰头部最久未活动的连接。连接结束（FIN/RST、
+    空闲超时、被淘汰）时调用 emit(flow, True)；长连接每隔 FLOW_INTERIM_INTERVAL
+    秒调用 emit(flow, False) 更新中间结果。
+    """
+
+    def __init__(self, emit, max_flows=FLOW_TABLE_MAX, resolve=None):
+        self.emit = emit
+        self.max_flows = max_flows
+        # resolve(ip, now) 在新建连接时为远端地址查找域名
+        self.resolve = resolve
+        self.flows = OrderedDict()
+        self.last_sweep = 0
+        self.min_idle_timeout = min(FLOW_TCP_IDLE_TIMEOUT, FLOW_UDP_IDLE_TIMEOUT)
+        
+        # 统计信息
+        self.created = 0
+        self.closed = 0
+        self.expired = 0
+        self.evicted = 0
+        self.interim_updates = 0
+        self.orphan_packets = 0
+
+    def update(self, packet):
+        """把一个数据包计入所属连接，返回该连接（数据包被忽略时返回 None）"""
+        outbound = is_vpn_client(packet.src_ip)
+        if outbound:
+            key = (packet.protocol, packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port)
+        else:
+            key = (packet.protocol, packet.dst_ip, packet.dst_port, packet.src_ip, packet.src_port)
+        
+        flow = self.flows.get(key)
+        if flow is None:
+            # 已结束连接的尾包（最后的 ACK、重传的 FIN/RST）不新建连接
+            if packet.protocol == 'TCP' and not packet.tcp_flags & TCP_SYN and not packet.payload:
+                self.orphan_packets += 1
+                return None
+            flow = self.flows[key] = FlowState(key, packet, outbound)
+            if self.resolve is not None:
+                flow.domain = self.resolve(flow.remote_ip, packet.timestamp)
+            self.created += 1
+            if len(self.flows) > self.max_flows:
+                _, oldest = self.flows.popitem(last=False)
+                self._finish(oldest, 'EVICTED')
+                self.evicted += 1
+        else:
+            self.flows.move_to_end(key)
+        
+        if flow.update(packet, outbound):
+            del self.flows[key]
+            self._finish(flow, flow.tcp_state)
+            self.closed += 1
+        elif packet.timestamp - flow.reported_at >= FLOW_INTERIM_INTERVAL:
+            flow.reported_at = packet.timestamp
+            self.emit(flow, False)
+            self.interim_updates += 1
+        
+        if packet.timestamp - self.last_sweep >= FLOW_SWEEP_INTERVAL:
+            self.sweep(packet.timestamp)
+        return flow
+
+    def sweep(self, now):
+        """结束空闲超时的连接（从最久未活动的一端开始，遇到未超过最短超时的连接即停止）"""
+        self.last_sweep = now
+        expired = []
+        for flow in self.flows.values():
+            idle = now - flow.last_seen
+            if idle < self.min_idle_timeout:
+                break
+            if idle >= flow.idle_timeout:
+                expired.append(flow)
+        for flow in expired:
+            del self.flows[flow.key]
+            self._finish(flow, 'IDLE_TIMEOUT')
+            self.expired += 1
+
+    def flush(self, state='STOPPED'):
+        """结束全部连接（停止抓包或回放结束时调用）"""
+        while self.flows:
+            _, flow = self.flows.popitem(last=False)
+            self._finish(flow, state)
+
+    def _finish(self, flow, state):
+        flow.tcp_state = state
+        self.emit(flow, True)
+
+    def stats(self):
+        """返回流表统计信息"""
+        return {
+            'active_flows': len(self.flows),
+            'max_flows': self.max_flows,
+            'created': self.created,
+            'closed': self.closed,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'interim_updates': self.interim_updates,
+            'orphan_packets': self.orphan_packets
+        }
 
 
 # 全局数据库实例
 traffic_db = TrafficDatabase()
 
-# 存储连接的WebSocket客户端
-websocket_clients = set()
+# 数据保留策略
+retention_manager = RetentionManager(traffic_db)
+
+# 旧版本数据库的时间戳迁移
+timestamp_migration = TimestampMigration(traffic_db, {'vpn_traffic_logs': TIMESTAMP_COLUMNS, 'vpn_clients': {'last_seen_ms': 'last_seen'}},
+                                         old_indexes=('idx_vpn_traffic_timestamp',))
+
+# WebSocket 事件中心（生产者可在任意线程发布，投递在 WebSocket 服务器的事件循环中完成）
+event_hub = EventHub(FILTER_FIELDS)
 
 
 class VPNTrafficMonitor:
-    """VPN流量监控器"""
+    """VPN流量监控器（在 wg0 上实时抓包或回放 pcap 文件，按连接聚合后写库）"""
     
-    def __init__(self):
+    def __init__(self, pcap_path=CAPTURE_PCAP_REPLAY):
         self.running = False
         self.monitor_thread = None
+        self.pcap_path = pcap_path
+        self.capture = None
+        self.domains = DomainCache()
+        self.flow_table = FlowTable(self._emit_flow, resolve=self.domains.get)
+        
+        # 统计信息
+        self.packets = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.started_at = None
     
     def start_monitoring(self):
         """开始监控VPN流量"""
         self.running = True
+        self.started_at = time.time()
         self.monitor_thread = threading.Thread(target=self._monitor_loop)
         self.monitor_thread.daemon = True
         self.monitor_thread.start()
@@ -170,216 +826,416 @@ class VPNTrafficMonitor:
             self.monitor_thread.join()
         print("🛑 VPN流量监控器已停止")
     
+    def stats(self):
+        """返回抓包统计信息"""
+        elapsed = time.time() - self.started_at if self.started_at else 0
+        return {
+            'source': f'pcap:{self.pcap_path}' if self.pcap_path else f'live:{CAPTURE_INTERFACE}',
+            'running': self.running,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'skipped': self.skipped,
+            'packets_per_sec': round(self.packets / elapsed, 1) if elapsed else 0,
+            'flow_table': self.flow_table.stats(),
+            'domain_cache': self.domains.stats()
+        }
+    
     def _monitor_loop(self):
-        """监控循环"""
+        """监控循环：逐包解析后写库并推送"""
+        if self.pcap_path:
+            try:
+                print(f"📼 回放抓包文件: {self.pcap_path}")
+                for timestamp, data, wire_length in read_pcap(self.pcap_path):
+                    if not self.running:
+                        break
+                    self.handle_packet(timestamp, data, wire_length)
+                print(f"✅ 抓包文件回放完成，共 {self.packets} 个数据包")
+            except Exception as e:
+                print(f"❌ 回放抓包文件失败: {e}")
+            finally:
+                self.flow_table.flush()
+            return
+        
         while self.running:
             try:
-                # 获取WireGuard连接状态
-                wg_status = self._get_wireguard_status()
-                
-                # 监控网络流量
-                traffic_data = self._capture_network_traffic()
-                
-                if traffic_data:
-                    # 保存到数据库
-                    traffic_db.save_traffic(traffic_data)
-                    
-                    # 广播到WebSocket客户端
-                    if websocket_clients:
-                        asyncio.create_task(self._broadcast_traffic(traffic_data))
-                
-                time.sleep(1)  # 每秒监控一次
-                
+                self.capture = PacketCapture()
+                self.capture.open()
+                print(f"📡 开始在 {CAPTURE_INTERFACE} 上抓包")
+                for timestamp, data, wire_length in self.capture.packets(
+                        lambda: self.running, on_idle=self.flow_table.sweep):
+                    self.handle_packet(timestamp, data, wire_length)
+            except PermissionError:
+                print("❌ 抓包需要 root 权限或 CAP_NET_RAW")
+                break
             except Exception as e:
                 print(f"❌ 监控循环出错: {e}")
                 time.sleep(5)
+            finally:
+                if self.capture is not None:
+                    self.capture.close()
+        self.flow_table.flush()
     
-    def _get_wireguard_status(self):
-        """获取WireGuard连接状态"""
-        try:
-            result = subprocess.run(['wg', 'show', WIREGUARD_INTERFACE], 
-                                  capture_output=True, text=True)
-            return result.stdout if result.returncode == 0 else None
-        except Exception as e:
-            print(f"⚠️ 获取WireGuard状态失败: {e}")
-            return None
+    def handle_packet(self, timestamp, data, wire_length=0):
+        """解析一个数据包并计入连接跟踪表"""
+        packet = parse_ip_packet(data, timestamp, wire_length)
+        if packet is None:
+            self.skipped += 1
+            return
+        self.packets += 1
+        self.bytes += packet.length
+        
+        # 先学习 DNS 应答和 SNI，再计入连接；SNI 比按 IP 反查更准确（CDN 上多个域名共用 IP）
+        sni = self.domains.observe(packet)
+        flow = self.flow_table.update(packet)
+        if sni and flow is not None:
+            flow.domain = sni
     
-    def _capture_network_traffic(self):
-        """捕获网络流量（简化版本）"""
-        try:
-            # 这里是一个简化的实现
-            # 实际环境中可以使用 tcpdump, scapy 或者 eBPF 来捕获流量
-            
-            # 使用netstat获取连接信息作为示例
-            result = subprocess.run(['netstat', '-tuln'], 
-                                  capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                # 解析netstat输出并返回流量数据
-                # 这里返回一个示例数据结构
-                return (
-                    datetime.now().isoformat(),  # timestamp
-                    CLIENT_VPN_IP,               # client_ip
-                    'TCP',                       # protocol
-                    CLIENT_VPN_IP,               # src_ip
-                    '8.8.8.8',                   # dst_ip (示例)
-                    12345,                       # src_port
-                    80,                          # dst_port
-                    'example.com',               # domain
-                    'http://example.com/api',    # url
-                    'GET',                       # method
-                    'Android App',               # user_agent
-                    1024,                        # bytes_sent
-                    2048,                        # bytes_received
-                    'HTTP'                       # connection_type
-                )
-            
-        except Exception as e:
-            print(f"⚠️ 捕获流量失败: {e}")
+    def _emit_flow(self, flow, finished):
+        """连接结束或需要中间更新时写库并推送（每次写入换用新 id，替换上一次写入的记录）"""
+        previous_id = flow.row_id
+        new_flow = previous_id is None
+        flow.row_id = traffic_db.allocate_id()
+        flow_data = self._flow_to_record(flow)
         
-        return None
+        # 汇总表只累加与上次写入的差值，中间更新不会重复计数
+        totals = (flow.bytes_sent, flow.bytes_received, flow.packets_sent + flow.packets_received)
+        delta = (int(new_flow),) + tuple(now - before for now, before in zip(totals, flow.reported_totals))
+        flow.reported_totals = totals
+        
+        # 保存到数据库
+        traffic_db.save_flow(flow.row_id, flow_data, delta, replaces=previous_id)
+        # 广播到WebSocket客户端（监控线程中直接发布，由事件中心切换到WebSocket事件循环）
+        self._broadcast_traffic(flow.row_id, flow_data, previous_id)
     
-    async def _broadcast_traffic(self, traffic_data):
-        """广播流量数据到WebSocket客户端"""
-        if websocket_clients:
-            # 转换为WebSocket格式
-            ws_data = {
-                'timestamp': traffic_data[0],
-                'client_ip': traffic_data[1],
-                'protocol': traffic_data[2],
-                'src_ip': traffic_data[3],
-                'dst_ip': traffic_data[4],
-                'domain': traffic_data[7],
-                'url': traffic_data[8],
-                'method': traffic_data[9],
-                'bytes_total': traffic_data[11] + traffic_data[12]
-            }
-            
-            # 创建要移除的客户端列表
-            clients_to_remove = set()
-            
-            for client in websocket_clients.copy():
-                try:
-                    await client.send(json.dumps(ws_data))
-                except Exception:
-                    clients_to_remove.add(client)
-            
-            # 移除断开的客户端
-            for client in clients_to_remove:
-                websocket_clients.discard(client)
+    def _flow_to_record(self, flow):
+        """把连接状态转换为 vpn_traffic_logs 记录"""
+        url = None
+        scheme = URL_SCHEMES.get(flow.remote_port)
+        if flow.domain and scheme:
+            default_port = 443 if scheme == 'https' else 80
+            port = '' if flow.remote_port == default_port else f':{flow.remote_port}'
+            url = f'{scheme}://{flow.domain}{port}'
+        return (
+            int(flow.first_seen * 1000),                                  # ts_ms
+            flow.client_ip,                                               # client_ip
+            flow.protocol,                                                # protocol
+            flow.client_ip,                                               # src_ip
+            flow.remote_ip,                                               # dst_ip
+            flow.client_port,                                             # src_port
+            flow.remote_port,                                             # dst_port
+            flow.domain,                                                  # domain
+            url,                                                          # url
+            None,                                                         # method
+            None,                                                         # user_agent
+            flow.bytes_sent,                                              # bytes_sent
+            flow.bytes_received,                                          # bytes_received
+            SERVICE_PORTS.get(flow.remote_port, flow.protocol),           # connection_type
+            flow.packets_sent,                                            # packets_sent
+            flow.packets_received,                                        # packets_received
+            int(flow.last_seen * 1000),                                   # last_seen_ms
+            flow.tcp_state                                                # flow_state
+        )
+    
+    def _broadcast_traffic(self, row_id, traffic_data, replaces=None):
+        """广播流量数据到WebSocket客户端（replaces 为同一连接上一次推送的 id，新连接为 None）"""
+        # 转换为WebSocket格式
+        event_hub.publish({
+            'id': row_id,
+            'replaces': replaces,
+            'timestamp': ms_to_iso(traffic_data[0]),
+            'client_ip': traffic_data[1],
+            'protocol': traffic_data[2],
+            'src_ip': traffic_data[3],
+            'dst_ip': traffic_data[4],
+            'src_port': traffic_data[5],
+            'dst_port': traffic_data[6],
+            'domain': traffic_data[7],
+            'url': traffic_data[8],
+            'method': traffic_data[9],
+            'bytes_total': traffic_data[11] + traffic_data[12],
+            'packets_total': traffic_data[14] + traffic_data[15],
+            'last_seen': ms_to_iso(traffic_data[16]),
+            'flow_state': traffic_data[17]
+        })
 
 
 # 全局流量监控器
 traffic_monitor = VPNTrafficMonitor()
 
 
+WireGuardPeer = namedtuple('WireGuardPeer', [
+    'public_key', 'endpoint', 'allowed_ips', 'vpn_ip', 'latest_handshake', 'last_handshake_at',
+    'rx_bytes', 'tx_bytes', 'rx_rate', 'tx_rate', 'keepalive', 'connected'
+])
+
+
+def parse_wg_dump(output):
+    """解析 wg show <接口> dump 的输出，返回 (接口信息, [(公钥, endpoint, allowed_ips, 握手时间, rx, tx, keepalive)])
+
+    第一行是接口本身（私钥、公钥、监听端口、fwmark），之后每行一个节点，字段以制表符分隔。
+    """
+    lines = [line for line in output.splitlines() if line.strip()]
+    if not lines:
+        return None, []
+    fields = lines[0].split('\t')
+    interface = {
+        'public_key': fields[1] if len(fields) > 1 else None,
+        'listen_port': int(fields[2]) if len(fields) > 2 and fields[2].isdigit() else None
+    }
+    peers = []
+    for line in lines[1:]:
+        fields = line.split('\t')
+        if len(fields) < 8:
+            continue
+        public_key, _, endpoint, allowed_ips, handshake, rx, tx, keepalive = fields[:8]
+        peers.append((
+            public_key,
+            None if endpoint == '(none)' else endpoint,
+            [] if allowed_ips == '(none)' else allowed_ips.split(','),
+            int(handshake),
+            int(rx),
+            int(tx),
+            None if keepalive == 'off' else int(keepalive)
+        ))
+    return interface, peers
+
+
+def peer_display_name(peer):
+    """节点在客户端列表中的显示名称"""
+    if peer.vpn_ip == CLIENT_VPN_IP:
+        return 'Android Client'
+    return f'Peer {peer.public_key[:8]}'
+
+
+class WireGuardPoller:
+    """WireGuard 节点状态轮询器
+
+    后台线程每隔 interval 秒执行一次 wg show dump，解析为 WireGuardPeer 快照，
+    根据相邻两次计数器的差值计算每个节点的收发速率，并批量更新 vpn_clients。
+    API 请求只读取 snapshot，不再各自启动 wg 进程。
+    """
+
+    def __init__(self, interface=WIREGUARD_INTERFACE, interval=WG_POLL_INTERVAL):
+        self.interface = interface
+        self.interval = interval
+        self.running = False
+        self.thread = None
+        self._stop = threading.Event()
+        # 快照整体替换，读取方无需加锁
+        self.snapshot = {'interface': None, 'peers': [], 'polled_at': None, 'error': 'not polled yet'}
+        self.version = 0
+        self._previous = {}  # 公钥 -> (单调时间, rx, tx)
+        self._written = {}   # 公钥 -> 上次写入 vpn_clients 的 (rx, tx, 握手时间, 在线状态)
+        
+        # 统计信息
+        self.polls = 0
+        self.errors = 0
+        self.last_poll_ms = 0.0
+
+    def start(self):
+        """启动轮询线程"""
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='wg-poller')
+        self.thread.daemon = True
+        self.thread.start()
+        print(f"✅ WireGuard状态轮询已启动（每 {self.interval} 秒）")
+
+    def stop(self):
+        """停止轮询线程"""
+        self.running = False
+        self._stop.set()
+        if self.thread:
+            self.thread.join(self.interval + WG_POLL_TIMEOUT)
+
+    def peers(self):
+        """返回最近一次轮询得到的节点列表"""
+        return self.snapshot['peers']
+
+    def stats(self):
+        """返回轮询统计信息"""
+        return {
+            'interval': self.interval,
+            'polls': self.polls,
+            'errors': self.errors,
+            'last_poll_ms': round(self.last_poll_ms, 2),
+            'version': self.version
+        }
+
+    def _run(self):
+        while self.running:
+            self.poll()
+            self._stop.wait(self.interval)
+
+    def poll(self):
+        """执行一次轮询并替换快照"""
+        started = time.perf_counter()
+        self.polls += 1
+        try:
+            result = subprocess.run(['wg', 'show', self.interface, 'dump'],
+                                    capture_output=True, text=True, timeout=WG_POLL_TIMEOUT)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip() or 'WireGuard not running')
+            interface, raw_peers = parse_wg_dump(result.stdout)
+            peers = self._build_peers(raw_peers)
+            error = None
+        except Exception as e:
+            self.errors += 1
+            interface, peers, error = None, [], str(e)
+        
+        self.snapshot = {
+            'interface': interface,
+            'peers': peers,
+            'polled_at': datetime.now().isoformat(),
+            'error': error
+        }
+        self.version += 1
+        self.last_poll_ms = (time.perf_counter() - started) * 1000
+        
+        # 只写入有变化的节点，空闲时不产生写入（也不会让API响应缓存失效）
+        changed = []
+        for peer in peers:
+            state = (peer.rx_bytes, peer.tx_bytes, peer.latest_handshake, peer.connected)
+            if self._written.get(peer.public_key) != state:
+                self._written[peer.public_key] = state
+                changed.append(peer)
+        if changed:
+            traffic_db.update_client_stats(changed)
+
+    def _build_peers(self, raw_peers):
+        """根据与上次轮询的计数器差值计算速率（计数器变小说明接口重启，速率记为0）"""
+        now = time.monotonic()
+        wall_now = time.time()
+        previous = self._previous
+        self._previous = {}
+        peers = []
+        for public_key, endpoint, allowed_ips, handshake, rx, tx, keepalive in raw_peers:
+            self._previous[public_key] = (now, rx, tx)
+            rx_rate = tx_rate = 0.0
+            if public_key in previous:
+                last_time, last_rx, last_tx = previous[public_key]
+                elapsed = now - last_time
+                if elapsed > 0:
+                    rx_rate = max(0, rx - last_rx) / elapsed
+                    tx_rate = max(0, tx - last_tx) / elapsed
+            vpn_ip = allowed_ips[0].split('/')[0] if allowed_ips else None
+            peers.append(WireGuardPeer(
+                public_key=public_key,
+                endpoint=endpoint,
+                allowed_ips=allowed_ips,
+                vpn_ip=vpn_ip,
+                latest_handshake=handshake,
+                last_handshake_at=ms_to_iso(handshake * 1000) if handshake else None,
+                rx_bytes=rx,
+                tx_bytes=tx,
+                rx_rate=round(rx_rate, 1),
+                tx_rate=round(tx_rate, 1),
+                keepalive=keepalive,
+                connected=bool(handshake) and wall_now - handshake <= WG_PEER_ACTIVE_WINDOW
+            ))
+        return peers
+
+
+# 全局 WireGuard 状态轮询器
+wg_poller = WireGuardPoller()
+
+
 async def websocket_handler(*args):
     """WebSocket连接处理器"""
     websocket = args[0]
-    path = args[1] if len(args) > 1 else "/"
+    path = args[1] if len(args) > 1 else None
     
     print(f"🔗 新的WebSocket连接: {websocket.remote_address}")
-    websocket_clients.add(websocket)
     
     try:
-        # 发送最近的流量记录
+        # 推送方式由客户端在连接 URL 中协商，未指定参数时保持每个事件一帧的旧格式
+        options = parse_stream_options(get_websocket_path(websocket, path))
+        if options['negotiated']:
+            await websocket.send(json.dumps(dict(options, type='hello')))
+        
+        # 最近的流量记录先于实时数据放入该客户端的发送队列，保证顺序
         recent_traffic = traffic_db.get_recent_traffic(50)
+        subscriber = event_hub.subscribe(websocket, options)
         for traffic in recent_traffic:
-            try:
-                await websocket.send(json.dumps({
-                    'timestamp': traffic['timestamp'],
-                    'client_ip': traffic['client_ip'],
-                    'protocol': traffic['protocol'],
-                    'domain': traffic['domain'],
-                    'url': traffic['url'],
-                    'method': traffic['method'],
-                    'bytes_total': (traffic['bytes_sent'] or 0) + (traffic['bytes_received'] or 0)
-                }))
-            except Exception as e:
-                print(f"⚠️ 发送历史数据失败: {e}")
-                break
+            subscriber.offer(EncodedEvent({
+                'id': traffic['id'],
+                'timestamp': traffic['timestamp'],
+                'client_ip': traffic['client_ip'],
+                'protocol': traffic['protocol'],
+                'domain': traffic['domain'],
+                'url': traffic['url'],
+                'method': traffic['method'],
+                'bytes_total': (traffic['bytes_sent'] or 0) + (traffic['bytes_received'] or 0)
+            }))
         
-        # 保持连接活跃
+        # 处理客户端的控制消息（订阅过滤条件可随时修改）
         async for message in websocket:
-            # 可以处理来自客户端的消息
-            pass
+            reply = handle_client_message(subscriber, message)
+            if reply is not None:
+                await websocket.send(json.dumps(reply))
     except Exception as e:
         print(f"❌ WebSocket连接异常: {e}")
     finally:
-        websocket_clients.discard(websocket)
+        event_hub.unsubscribe(websocket)
         print(f"🔌 WebSocket连接断开: {websocket.remote_address}")
 
 
 def start_websocket_server(port=8765, use_ssl=False):
     """启动WebSocket服务器"""
-    try:
-        # SSL 配置
-        ssl_context = None
-        if use_ssl:
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            # 优先使用 Let's Encrypt 证书
-            le_cert = '/etc/letsencrypt/live/bigjj.site/fullchain.pem'
-            le_key = '/etc/letsencrypt/live/bigjj.site/privkey.pem'
-            
-            if os.path.exists(le_cert) and os.path.exists(le_key):
-                ssl_context.load_cert_chain(le_cert, le_key)
-                print(f"✅ WebSocket服务器使用 Let's Encrypt 证书")
-                global WS_USE_SSL
-                WS_USE_SSL = True
-            else:
-                print(f"⚠️ Let's Encrypt 证书不存在，WebSocket将使用HTTP")
-                ssl_context = None
-                WS_USE_SSL = False
-        
-        async def run_server():
-            # 根据SSL状态决定协议
-            protocol = "wss" if ssl_context else "ws"
-            print(f"🚀 启动WebSocket服务器: {protocol}://0.0.0.0:{port}")
-            
-            server = await websockets.serve(
-                websocket_handler, 
-                "0.0.0.0", 
-                port,
-                ssl=ssl_context
-            )
-            
-            print(f"✅ WebSocket服务器启动成功: {protocol}://bigjj.site:{port}")
-            await server.wait_closed()
-        
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(run_server())
-    except Exception as e:
-        print(f"❌ WebSocket服务器启动失败: {e}")
-        traceback.print_exc()
+    global WS_USE_SSL
+    ssl_context = websocket_ssl_context() if use_ssl else None
+    WS_USE_SSL = ssl_context is not None
+    run_websocket_server(websocket_handler, event_hub, port, ssl_context)
+
+
+# API请求延迟统计
+api_metrics = RequestMetrics()
 
+# API响应缓存
+response_cache = ResponseCache()
 
-class VPNAPIHandler(BaseHTTPRequestHandler):
+
+class VPNAPIHandler(TrafficAPIHandler):
     """VPN API处理器"""
     
-    def log_message(self, format, *args):
-        """禁用默认日志输出"""
-        pass
+    traffic_filters = TRAFFIC_FILTERS
+    response_cache = response_cache
+    
+    @property
+    def db(self):
+        """全局数据库实例"""
+        return traffic_db
     
     def do_GET(self):
         """处理GET请求"""
+        started = time.perf_counter()
+        self.response_status = 0
+        route = 'other'
         try:
             parsed_path = urllib.parse.urlparse(self.path)
             path = parsed_path.path
             
             if path == '/':
+                route = '/'
                 self.serve_status_page()
             elif path == '/api/status':
+                route = '/api/status'
                 self.serve_vpn_status()
             elif path == '/api/traffic':
-                self.serve_traffic_data()
+                route = '/api/traffic'
+                self.serve_traffic_data(urllib.parse.parse_qs(parsed_path.query))
+            elif path == '/api/stats/timeseries':
+                route = '/api/stats/timeseries'
+                self.serve_timeseries(urllib.parse.parse_qs(parsed_path.query))
             elif path == '/api/clients':
+                route = '/api/clients'
                 self.serve_client_list()
             else:
                 self.send_error(404, "Not Found")
         except Exception as e:
             print(f"❌ API请求处理失败: {e}")
             self.send_error(500, "Internal Server Error")
+        finally:
+            api_metrics.record(route, (time.perf_counter() - started) * 1000, self.response_status)
     
     def serve_status_page(self):
         """提供VPN状态页面"""
@@ -420,13 +1276,16 @@ class VPNAPIHandler(BaseHTTPRequestHandler):
                     <h3>🔗 监控接口</h3>
                     <div class="endpoint">WebSocket地址: <strong>{ws_scheme}://bigjj.site:8765</strong></div>
                     <div class="endpoint">实时流量推送: <strong>已启用</strong></div>
+                    <div class="endpoint">批量推送: <strong>?mode=batch&amp;interval_ms=100&amp;max_events=100&amp;encoding=json|msgpack</strong></div>
                 </div>
                 
                 <div class="info">
                     <h3>🛠 API接口</h3>
                     <div class="endpoint">状态接口: <strong>{api_scheme}://bigjj.site:5010/api/status</strong></div>
                     <div class="endpoint">流量数据: <strong>{api_scheme}://bigjj.site:5010/api/traffic</strong></div>
+                    <div class="endpoint">分页/过滤: <strong>?limit=&amp;before_id=&amp;after_id=&amp;host=&amp;device_id=&amp;method=&amp;protocol=&amp;since=&amp;until=</strong></div>
                     <div class="endpoint">客户端列表: <strong>{api_scheme}://bigjj.site:5010/api/clients</strong></div>
+                    <div class="endpoint">时间序列: <strong>{api_scheme}://bigjj.site:5010/api/stats/timeseries?resolution=minute|hour&amp;group_by=&amp;since=&amp;until=</strong></div>
                 </div>
                 
                 <div class="warning">
@@ -439,18 +1298,18 @@ class VPNAPIHandler(BaseHTTPRequestHandler):
         </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(html_content.encode('utf-8'))
+        self.send_payload(html_content.encode('utf-8'), 'text/html; charset=utf-8')
     
     def serve_vpn_status(self):
-        """提供VPN状态信息"""
+        """提供VPN状态信息（按数据版本和时间片缓存，WireGuard 状态来自轮询器的快照）"""
+        self.send_cached(status_cache_version(traffic_db), self.build_vpn_status)
+    
+    def build_vpn_status(self):
+        """生成VPN状态响应体"""
         global WS_USE_SSL, API_USE_SSL
         
-        # 获取WireGuard状态
-        wg_status = self._get_wireguard_status()
+        # WireGuard状态（轮询器的快照，不在请求中执行 wg 命令）
+        wg_snapshot = wg_poller.snapshot
         
         ws_scheme = "wss" if WS_USE_SSL else "ws"
         api_scheme = "https" if API_USE_SSL else "http"
@@ -469,72 +1328,66 @@ class VPNAPIHandler(BaseHTTPRequestHandler):
             'ws_url': f'{ws_scheme}://bigjj.site:8765',
             'api_scheme': api_scheme,
             'api_url': f'{api_scheme}://bigjj.site:5010',
-            'wireguard_status': wg_status,
+            'wireguard_status': wg_snapshot['error'] or 'running',
+            'wireguard': {
+                'interface': wg_snapshot['interface'],
+                'polled_at': wg_snapshot['polled_at'],
+                'peers': [peer._asdict() for peer in wg_snapshot['peers']],
+                'poller': wg_poller.stats()
+            },
             'ssl_enabled': {
                 'websocket': WS_USE_SSL,
                 'api': API_USE_SSL
-            }
+            },
+            'db_writer': traffic_db.writer.stats(),
+            'packet_capture': traffic_monitor.stats(),
+            'retention': retention_manager.stats(),
+            'timestamp_migration': timestamp_migration.stats(),
+            'event_hub': event_hub.stats(),
+            'api_server': api_metrics.stats(),
+            'response_cache': response_cache.stats()
         }
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(status_data, indent=2).encode('utf-8'))
-    
-    def serve_traffic_data(self):
-        """提供流量数据"""
-        try:
-            traffic_data = traffic_db.get_recent_traffic(100)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(traffic_data, indent=2).encode('utf-8'))
-        except Exception as e:
-            print(f"❌ 获取流量数据失败: {e}")
-            self.send_error(500, "Failed to get traffic data")
+        return json.dumps(status_data, indent=2).encode('utf-8'), {}
     
     def serve_client_list(self):
-        """提供客户端列表"""
+        """提供客户端列表（按轮询快照版本缓存）"""
         try:
-            # 这里可以返回连接的VPN客户端信息
-            clients_data = {
-                'connected_clients': 1,
-                'clients': [
-                    {
-                        'name': 'Android Client',
-                        'vpn_ip': CLIENT_VPN_IP,
-                        'status': 'connected',
-                        'last_seen': datetime.now().isoformat()
-                    }
-                ]
-            }
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(clients_data, indent=2).encode('utf-8'))
+            self.send_cached(wg_poller.version, self.build_client_list)
         except Exception as e:
             print(f"❌ 获取客户端列表失败: {e}")
             self.send_error(500, "Failed to get client list")
     
-    def _get_wireguard_status(self):
-        """获取WireGuard状态"""
-        try:
-            result = subprocess.run(['wg', 'show', WIREGUARD_INTERFACE], 
-                                  capture_output=True, text=True)
-            return result.stdout if result.returncode == 0 else "WireGuard not running"
-        except Exception:
-            return "WireGuard status unavailable"
+    def build_client_list(self):
+        """生成客户端列表响应体"""
+        peers = wg_poller.peers()
+        clients_data = {
+            'connected_clients': sum(1 for peer in peers if peer.connected),
+            'polled_at': wg_poller.snapshot['polled_at'],
+            'clients': [
+                {
+                    'name': peer_display_name(peer),
+                    'public_key': peer.public_key,
+                    'vpn_ip': peer.vpn_ip,
+                    'endpoint': peer.endpoint,
+                    'status': 'connected' if peer.connected else 'disconnected',
+                    'last_seen': peer.last_handshake_at,
+                    'rx_bytes': peer.rx_bytes,
+                    'tx_bytes': peer.tx_bytes,
+                    'rx_rate': peer.rx_rate,
+                    'tx_rate': peer.tx_rate
+                }
+                for peer in peers
+            ]
+        }
+        
+        return json.dumps(clients_data, indent=2).encode('utf-8'), {}
 
 
 def start_api_server(port=5010, use_ssl=False):
     """启动HTTP API服务器"""
     try:
-        httpd = HTTPServer(('0.0.0.0', port), VPNAPIHandler)
+        httpd = ThreadPoolHTTPServer(('0.0.0.0', port), VPNAPIHandler)
         
         if use_ssl:
             # SSL配置 (与之前相同)
@@ -548,7 +1401,8 @@ def start_api_server(port=5010, use_ssl=False):
             if os.path.exists(le_cert) and os.path.exists(le_key):
                 try:
                     ssl_context.load_cert_chain(le_cert, le_key)
-                    httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True)
+                    httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True,
+                                                           do_handshake_on_connect=False)
                     cert_loaded = True
                     global API_USE_SSL
                     API_USE_SSL = True
@@ -585,8 +1439,11 @@ def main():
         print("❌ WireGuard命令未找到，请先安装WireGuard")
         sys.exit(1)
     
-    # 启动流量监控器
+    # 启动流量监控器、WireGuard 状态轮询和数据保留策略
     traffic_monitor.start_monitoring()
+    wg_poller.start()
+    retention_manager.start()
+    timestamp_migration.start()
     
     # 启动HTTP API服务器 (线程)
     api_use_ssl = any([
@@ -623,6 +1480,10 @@ def main():
         def signal_handler(sig, frame):
             print("\n🛑 收到停止信号，正在关闭服务器...")
             traffic_monitor.stop_monitoring()
+            wg_poller.stop()
+            retention_manager.stop()
+            timestamp_migration.stop()
+            traffic_db.close()
             sys.exit(0)
         
         signal.signal(signal.SIGINT, signal_handler)
@@ -637,6 +1498,10 @@ def main():
     except KeyboardInterrupt:
         print("\n🛑 服务器正在关闭...")
         traffic_monitor.stop_monitoring()
+        wg_poller.stop()
+        retention_manager.stop()
+        timestamp_migration.stop()
+        traffic_db.close()
     except Exception as e:
         print(f"❌ 服务器运行失败: {e}")
         traceback.print_exc()
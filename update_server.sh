@@ -3,7 +3,7 @@
 echo "🔄 正在更新bigjj.site代理服务器..."
 
 # 上传新的代码文件
-scp -i ~/.ssh/id_rsa remote_server/mobile_proxy_server.py han@bigjj.site:/opt/mobile-proxy/
+scp -i ~/.ssh/id_rsa remote_server/mobile_proxy_server.py remote_server/common.py han@bigjj.site:/opt/mobile-proxy/
 
 echo "✅ 代码文件已上传"
 